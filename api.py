@@ -1,9 +1,25 @@
 import datetime
+import logging
 import re
 import urllib.parse
 from typing import Optional, List
 from xml.etree import ElementTree
 import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+
+class SourceAddressAdapter(HTTPAdapter):
+    """Binds connections to a local address, to pick the interface when several cards share one address"""
+
+    def __init__(self, source_address: str, **kwargs):
+        self._source_address = source_address
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["source_address"] = (self._source_address, 0)
+        super().init_poolmanager(*args, **kwargs)
 
 
 class ApiFile:
@@ -17,10 +33,13 @@ class ApiFile:
 
 
 class HttpClient:
-    def __init__(self, host: str, request_timeout=20):
+    def __init__(self, host: str, request_timeout=20, source_address: Optional[str] = None):
         self._host_name = host
         self._base_url = f"http://{host}"
         self._request_timeout = request_timeout
+        self._session = requests.Session()
+        if source_address is not None:
+            self._session.mount("http://", SourceAddressAdapter(source_address))
 
     def build_url(self, path: str, params: dict = None):
         url = f"{self._base_url}/{path}"
@@ -30,16 +49,28 @@ class HttpClient:
         return url
 
     def http_get(self, path: str, params: dict = None):
-        return requests.get(self.build_url(path, params), timeout=self._request_timeout)
+        return self._session.get(self.build_url(path, params), timeout=self._request_timeout)
 
     def stream_url_to_file(self, url: str, to_file: str):
-        with requests.get(url, stream=True, timeout=self._request_timeout) as r:
+        with self._session.get(url, stream=True, timeout=self._request_timeout) as r:
             r.raise_for_status()
             with open(to_file, 'wb') as f:
                 for chunk in r.iter_content(chunk_size=8192):
                     if chunk:  # filter out keep-alive new chunks
                         f.write(chunk)
 
+    def read_url_prefix(self, url: str, length: int) -> bytes:
+        # Cards that ignore the range answer with the whole file, the connection is closed after length bytes
+        headers = {"Range": f"bytes=0-{length - 1}"}
+        data = bytearray()
+        with self._session.get(url, headers=headers, stream=True, timeout=self._request_timeout) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=8192):
+                data.extend(chunk)
+                if len(data) >= length:
+                    break
+        return bytes(data[:length])
+
     def get_host(self) -> str:
         return self._host_name
 
@@ -63,6 +94,9 @@ class Api:
     def download_file(self, file: ApiFile, to_file: str):
         pass
 
+    def read_file_prefix(self, file: ApiFile, length: int) -> bytes:
+        pass
+
 
 class EzShareApi(Api):
     __max_dirs = 2
@@ -79,7 +113,7 @@ class EzShareApi(Api):
         return files
 
     def get_directories_to_process(self) -> List[str]:
-        print(f"Fetching directories to process...")
+        log.debug("Fetching directories to process...")
         res = self.client.http_get("client", {"command": "GetFolders"})
         directories = []
 
@@ -108,6 +142,10 @@ class EzShareApi(Api):
         url = self.client.build_url("download", {"fname": file.filename, "fdir": file.directory})
         self.client.stream_url_to_file(url, to_file)
 
+    def read_file_prefix(self, file: ApiFile, length: int) -> bytes:
+        url = self.client.build_url("download", {"fname": file.filename, "fdir": file.directory})
+        return self.client.read_url_prefix(url, length)
+
     def __parse_file(self, child: ElementTree.Element, directory: str) -> Optional[ApiFile]:
         filename = child.find("name").text
         if not filename.lower().endswith(".jpg"):
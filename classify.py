@@ -1,36 +1,99 @@
+import logging
+import threading
 from pathlib import Path
+from typing import Optional, TYPE_CHECKING
+
+import clock
 from database import Photo, Repository
 from inferencer import Inferencer
+from governor import InferenceGovernor
+from metrics import Metrics, StageTimer
+from result_cache import ResultCache
+
+log = logging.getLogger(__name__)
+
+if TYPE_CHECKING:
+    # Loads labels and numpy
+    from model_registry import ShadowEvaluator
 
 
 class FileClassifier:
-    def __init__(self, repository: Repository, inferencer: Inferencer, max_attempts: int = 2):
+    def __init__(self, repository: Repository, inferencer: Inferencer, max_attempts: int = 2, metrics: Metrics = None,
+                 cache: Optional[ResultCache] = None, governor: Optional[InferenceGovernor] = None,
+                 shadow: Optional['ShadowEvaluator'] = None, cancel: Optional[threading.Event] = None):
         self._repository = repository
         self._inferencer = inferencer
         self._max_attempts = max_attempts
+        self._metrics = metrics if metrics is not None else Metrics()
+        self._cache = cache
+        self._governor = governor
+        self._shadow = shadow
+        # Set by the watchdog of main.py, classification runs in an executor thread the signal does not reach
+        self._cancel = cancel
+
+    def run(self, limit: Optional[int] = None, deadline: Optional[float] = None):
+        with self._metrics.stage("classification") as stage:
+            stage.items = self.__classify_images(limit, deadline)
+
+        if self._governor is not None:
+            timer = StageTimer("throttle")
+            timer.items = self._governor.events
+            timer.wall_ms = int(self._governor.paused * 1000)
+            self._metrics.extend([timer])
 
-    def run(self):
-        self.__classify_images()
+    # Returns the number of images that were classified
+    def __classify_images(self, limit: Optional[int], deadline: Optional[float]) -> int:
+        classified = 0
+        log.info("Classifying %s image(s)...", self._repository.count_photos_to_inference())
+        for photo in self._repository.iter_photos_to_inference():
+            if limit is not None and classified >= limit:
+                log.info("Stop classifying, planned number of classifications (%s) reached", limit)
+                break
+
+            if deadline is not None and clock.monotonic() >= deadline:
+                log.info("Stop classifying, time budget for classification used")
+                break
+
+            if self._cancel is not None and self._cancel.is_set():
+                log.warning("Stop classifying, cycle cancelled")
+                break
 
-    def __classify_images(self):
-        photos = self._repository.get_photos_to_inference()
-        print(f"Classifying {len(photos)} image(s)...")
-        for photo in photos:
             local_file = Path(photo.local_file)
             try:
                 if local_file.is_file():
-                    res = self._inferencer.infer(local_file)
-                    print(f"Classification result: {res.name} with accuracy {res.accuracy} in {res.time}ms {local_file}")
-                    self._repository.update_photo_inference_success(photo.id, res, (photo.inference_attempt or 0) + 1)
+                    content_hash, res = self._cache.get(local_file) if self._cache is not None else (None, None)
+                    thermal = None
+                    busy = None
+                    if res is not None:
+                        log.debug("Classification cached: %s with accuracy %s %s", res.name, res.accuracy, local_file)
+                    else:
+                        started = clock.monotonic()
+                        res = self._inferencer.infer(local_file)
+                        if self._shadow is not None and self._shadow.sampled(photo.id):
+                            self._shadow.evaluate(photo.id, local_file, res)
+                        busy = clock.monotonic() - started
+                        thermal = self._governor.read() if self._governor is not None else None
+                        log.debug("Classification result: %s with accuracy %s in %sms %s",
+                                  res.name, res.accuracy, res.time, local_file)
+                        if content_hash is not None:
+                            self._cache.put(content_hash, res)
+                    self._repository.update_photo_inference_success(photo.id, res, (photo.inference_attempt or 0) + 1,
+                                                                    content_hash, thermal)
                     local_file.unlink()
+                    classified += 1
+
+                    if thermal is not None:
+                        self._governor.step(busy, thermal, deadline)
                 else:
-                    print(f"Cannot classify, file is missing: {local_file}")
+                    log.warning("Cannot classify, file is missing: %s", local_file)
                     self._repository.delete_photo(photo.id)
             except Exception as e:
-                print(f"Error classifying file {local_file} {e}")
+                log.error("Error classifying file %s %s", local_file, e)
                 attempt = (photo.inference_attempt or 0) + 1
                 status = Photo.Status.INFERENCE_ERROR if attempt >= self._max_attempts else Photo.Status.TODO
                 if local_file.is_file() and status == Photo.Status.INFERENCE_ERROR:
                     local_file.unlink()
 
                 self._repository.update_photo_inference_error(photo.id, e, attempt, status)
+
+        return classified
@@ -0,0 +1,89 @@
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+
+class Clock:
+    """Time source of a cycle, the deadlines, sleeps and stage metrics all go through the installed clock"""
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def now(self) -> datetime:
+        return datetime.now()
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    async def sleep_async(self, seconds: float):
+        await asyncio.sleep(seconds)
+
+    def wait(self, event: threading.Event, timeout: float) -> bool:
+        return event.wait(timeout)
+
+
+# Used by replays: sleeps, waits and the recorded response times of the card and modem return at once, but
+# still advance the clock, so deadlines and stage times come out as they would in the field while the
+# computation in between is measured for real.
+class VirtualClock(Clock):
+    def __init__(self, start: Optional[datetime] = None):
+        self._start = start or datetime.now()
+        self._origin = time.monotonic()
+        self._lock = threading.Lock()
+        self.skipped = 0.0
+
+    def advance(self, seconds: float):
+        if seconds > 0:
+            with self._lock:
+                self.skipped += seconds
+
+    def monotonic(self) -> float:
+        return time.monotonic() + self.skipped
+
+    def now(self) -> datetime:
+        return self._start + timedelta(seconds=self.monotonic() - self._origin)
+
+    def sleep(self, seconds: float):
+        self.advance(seconds)
+
+    async def sleep_async(self, seconds: float):
+        self.advance(seconds)
+        # Still a point where other tasks can run, like the real sleep
+        await asyncio.sleep(0)
+
+    def wait(self, event: threading.Event, timeout: float) -> bool:
+        if not event.is_set():
+            self.advance(timeout)
+        return event.is_set()
+
+
+_clock = Clock()
+
+
+def install(clock: Clock) -> Clock:
+    """Replaces the clock of this process, returns the one that was installed"""
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
+
+
+def monotonic() -> float:
+    return _clock.monotonic()
+
+
+def now() -> datetime:
+    return _clock.now()
+
+
+def sleep(seconds: float):
+    _clock.sleep(seconds)
+
+
+async def sleep_async(seconds: float):
+    await _clock.sleep_async(seconds)
+
+
+def wait(event: threading.Event, timeout: float) -> bool:
+    return _clock.wait(event, timeout)
@@ -1,3 +1,6 @@
+import asyncio
+
+
 class Communicator:
     def is_available(self) -> bool:
         """Check if this communicator is available"""
@@ -7,3 +10,6 @@ class Communicator:
         """Send payload"""
         pass
 
+    async def send_data_async(self, payload: bytearray) -> bool:
+        """Send payload without blocking the event loop"""
+        return await asyncio.get_running_loop().run_in_executor(None, self.send_data, payload)
@@ -1,58 +1,94 @@
+import asyncio
+import logging
+from typing import Callable, Optional
+
+import clock
 from communication import Communicator
-from rockBlock import RockBlock
+from rockBlock import AsyncRockBlock, SBDStatus
 from config import Config
 from gpiozero import LED
-from time import sleep
+import serial
 import warnings
 
+log = logging.getLogger(__name__)
+
 warnings.simplefilter('ignore')
 
 class SatelliteCommunicator(Communicator):
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, on_downlink: Optional[Callable[[bytes], None]] = None,
+                 open_serial: Optional[Callable] = None):
         self._config = config
+        self._on_downlink = on_downlink
+        # Opens the serial port like serial.Serial(port, baudrate, timeout=...), see Peripherals
+        self._open_serial = open_serial or serial.Serial
 
     def is_available(self) -> bool:
         return self._config.serial_port is not None
 
     def send_data(self, payload: bytearray) -> bool:
+        return asyncio.run(self.send_data_async(payload))
+
+    async def send_data_async(self, payload: bytearray) -> bool:
+        try:
+            return await asyncio.wait_for(self.__send_data(payload), self._config.rockblock_send_timeout)
+        except asyncio.TimeoutError:
+            log.warning("Sending via RockBlock cancelled after %s second(s)", self._config.rockblock_send_timeout)
+            return False
+
+    async def __send_data(self, payload: bytearray) -> bool:
         rockblock_pin2 = LED(26)
         rockblock_pin2.on()
 
-        sleep(10)
         try:
+            await clock.sleep_async(10)
             for _ in range(5):
                 try:
-                    return self.__do_send_data(payload)
+                    return await self.__do_send_data(payload)
+                except asyncio.CancelledError:
+                    raise
                 except Exception as e:
-                    sleep(5)
-                    print(f"Error communicating with RockBLOCK {e}")
+                    await clock.sleep_async(5)
+                    log.error("Error communicating with RockBLOCK %s", e)
         finally:
             rockblock_pin2.off()
             
         return False
 
-    def __do_send_data(self, payload: bytearray) -> bool:
+    async def __do_send_data(self, payload: bytearray) -> bool:
         rb = None
 
         try:
-            rb = RockBlock(self._config.serial_port,
-                           debug=self._config.rockblock_verbose,
-                           debug_serial=self._config.rockblock_verbose_serial,
-                           session_retry_attempts=self._config.rockblock_retry_attempts)
+            rb = await AsyncRockBlock.open(self._config.serial_port,
+                                           debug=self._config.rockblock_verbose,
+                                           debug_serial=self._config.rockblock_verbose_serial,
+                                           session_retry_attempts=self._config.rockblock_retry_attempts,
+                                           open_serial=self._open_serial)
 
-            status = rb.send_bytes(bytes(payload))
-            time = rb.network_time()
+            status = await rb.send_bytes(bytes(payload))
+            time = await rb.network_time()
             formatted_time = "Unknown"
 
             if time is not None:
                 formatted_time = time.strftime("%Y-%m-%dT%H:%M:%SZ")
 
-            print(f"Sending via RockBlock finished - "
-                  f"success: {status.mo_success}, "
-                  f"message_number: {status.mo_message_number}, "
-                  f"time: {formatted_time}, "
-                  f"status: {status.mo_status_message()}")
+            log.info("Sending via RockBlock finished - success: %s, message_number: %s, time: %s, status: %s",
+                     status.mo_success, status.mo_message_number, formatted_time, status.mo_status_message())
+
+            await self.__receive_downlink(rb, status)
             return status.mo_success
         finally:
             if rb is not None:
                 rb.close()
+
+    async def __receive_downlink(self, rb: AsyncRockBlock, status: SBDStatus):
+        # The SBDIX session that sent our payload also delivered the first queued MT message, if any
+        if status.mt_status_code != 1 or self._on_downlink is None:
+            return
+
+        try:
+            msg = await rb.receive_bytes_message()
+            log.info("Received downlink message %s (%s byte(s)), %s more queued",
+                     status.mt_message_number, len(msg), status.mt_queued)
+            self._on_downlink(msg)
+        except Exception as e:
+            log.error("Error receiving downlink message %s", e)
@@ -1,41 +1,299 @@
 import configparser
+import logging
+import os
+import pickle
 from pathlib import Path
+from typing import Optional, Callable, Any, Dict
+
+from log_buffer import level
+
+DEFAULT_CAMERA = "default"
+DEFAULT_HOST = "192.168.4.1"
+
+_REQUIRED = object()
+
+log = logging.getLogger(__name__)
+
+
+class ConfigException(Exception):
+    pass
+
+
+class CameraConfig:
+    def __init__(self, camera_id: str, host: str, source_address: Optional[str] = None):
+        self.camera_id = camera_id
+        self.host = host
+        # Local address of the Wi-Fi interface the card is reached through, when cards share an address
+        self.source_address = source_address
+
+    def __str__(self):
+        return f"{self.camera_id} ({self.host}" + (f" via {self.source_address})" if self.source_address else ")")
+
+
+class ModelConfig:
+    def __init__(self, name: str, model: str, labels: str):
+        self.name = name
+        self.model = model
+        self.labels = labels
+
+    @property
+    def key(self) -> str:
+        """Identifies the model in the database (cached results, inference_model, shadow results)"""
+        return Path(self.model).name
+
+    def __str__(self):
+        return f"{self.name} ({self.model})"
+
+
+class Setting:
+    def __init__(self, section: str, key: str, type: Callable[[str], Any] = str, fallback: Any = _REQUIRED,
+                 validate: Callable[[Any], bool] = None, description: str = ""):
+        self.section = section
+        self.key = key
+        self.type = type
+        self.fallback = fallback
+        self.validate = validate
+        self.description = description
+
+    def read(self, parser: configparser.ConfigParser):
+        if not parser.has_option(self.section, self.key):
+            if self.fallback is _REQUIRED:
+                raise ConfigException(f"[{self.section}] {self.key} must be specified in the config file")
+            return self.fallback
+
+        raw = parser.get(self.section, self.key)
+        try:
+            value = parser.getboolean(self.section, self.key) if self.type is bool else self.type(raw)
+        except ValueError:
+            raise ConfigException(f"[{self.section}] {self.key} = {raw} is not a valid {self.type.__name__}")
+
+        if self.validate is not None and not self.validate(value):
+            raise ConfigException(f"[{self.section}] {self.key} = {raw} is not allowed, {self.description}")
+
+        return value
+
+
+def _non_negative(value) -> bool:
+    return value >= 0
+
+
+# Attribute name -> setting, the sections with a variable set of keys (Cameras, Models, Mapping) are read separately
+SCHEMA: Dict[str, Setting] = {
+    "database_file": Setting("Database", "File", fallback="/home/htp/cameratrap.db"),
+
+    "sd_download_directory": Setting("SDCard", "DownloadFolder", Path, fallback=Path("/home/htp/camdata")),
+    "sd_max_per_day": Setting("SDCard", "MaxPerDay", int, 25, _non_negative, "must not be negative"),
+    "sd_staging_quota": Setting("SDCard", "StagingQuota", int, 0, _non_negative, "must not be negative"),
+    "sd_min_free_space": Setting("SDCard", "MinFreeSpace", int, 200, _non_negative, "must not be negative"),
+    "sd_read_exif": Setting("SDCard", "ReadExif", bool, False),
+    "sd_burst_gap": Setting("SDCard", "BurstGap", int, 0, _non_negative, "must not be negative"),
+    "sd_burst_max": Setting("SDCard", "BurstMax", int, 1, lambda v: v >= 1, "must be at least 1"),
+
+    "inference_command": Setting("Inference", "Command", fallback=None),
+
+    "tensorflow_lite_model": Setting("TensorFlowLite", "Model"),
+    "tensorflow_lite_labels": Setting("TensorFlowLite", "Labels"),
+
+    "classify_max_attempts": Setting("Classify", "MaxAttempts", int, 2, lambda v: v >= 1, "must be at least 1"),
+    "classify_cache_size": Setting("Classify", "CacheSize", int, 5000, _non_negative, "must not be negative"),
+    "classify_store_scores": Setting("Classify", "StoreScores", int, 0, lambda v: 0 <= v <= 255, "must be 0 to 255"),
+    "classify_threads": Setting("Classify", "Threads", int, 4, lambda v: v >= 1, "must be at least 1"),
+    "classify_model": Setting("Classify", "Model", fallback=None),
+    "classify_shadow_model": Setting("Classify", "ShadowModel", fallback=None),
+    "classify_shadow_fraction": Setting("Classify", "ShadowFraction", float, 0.1, lambda v: 0 <= v <= 1,
+                                        "must be 0 to 1"),
+
+    "governor_soc_temp": Setting("Governor", "SocTemp", float, 75, _non_negative, "must not be negative"),
+    "governor_hysteresis": Setting("Governor", "Hysteresis", float, 5, _non_negative, "must not be negative"),
+    "governor_ambient_temp": Setting("Governor", "AmbientTemp", float, 40, _non_negative, "must not be negative"),
+    "governor_batch": Setting("Governor", "Batch", int, 8, lambda v: v >= 1, "must be at least 1"),
+
+    "serial_port": Setting("RockBLOCK", "SerialPort"),
+    "rockblock_verbose": Setting("RockBLOCK", "Verbose", bool, False),
+    "rockblock_verbose_serial": Setting("RockBLOCK", "VerboseSerial", bool, False),
+    "rockblock_retry_attempts": Setting("RockBLOCK", "RetryAttempts", int, 15, lambda v: v >= 1, "must be at least 1"),
+    "rockblock_send_timeout": Setting("RockBLOCK", "SendTimeout", int, 10 * 60, _non_negative, "must not be negative"),
+
+    "log_file": Setting("Logging", "File", fallback="/home/htp/cameratrap.log"),
+    "log_level": Setting("Logging", "Level", level, "INFO"),
+    "log_console_level": Setting("Logging", "ConsoleLevel", level, "WARNING"),
+    "log_buffer_size": Setting("Logging", "BufferSize", int, 5000, lambda v: v >= 1, "must be at least 1"),
+    "log_max_kb": Setting("Logging", "MaxKB", int, 1024, lambda v: v >= 1, "must be at least 1"),
+    "log_backup_count": Setting("Logging", "BackupCount", int, 3, _non_negative, "must not be negative"),
+
+    "profile_enabled": Setting("Profile", "Enabled", bool, False),
+    "profile_mode": Setting("Profile", "Mode", str, "sample", lambda v: v in ("sample", "cprofile"),
+                            "must be sample or cprofile"),
+    "profile_interval": Setting("Profile", "IntervalMs", int, 10, lambda v: v >= 1, "must be at least 1"),
+    "profile_max_kb": Setting("Profile", "MaxKB", int, 2048, lambda v: v >= 1, "must be at least 1"),
+    "profile_directory": Setting("Profile", "Directory", Path, None),
+
+    "metrics_keep_cycles": Setting("Metrics", "KeepCycles", int, 500, lambda v: v >= 1, "must be at least 1"),
+
+    "planner_time_budget": Setting("Planner", "TimeBudget", int, 18 * 60, _non_negative, "must not be negative"),
+    "planner_low_voltage": Setting("Planner", "LowVoltage", int, 0, _non_negative, "must not be negative"),
+    "planner_critical_voltage": Setting("Planner", "CriticalVoltage", int, 0, _non_negative, "must not be negative"),
+    "planner_backlog_high": Setting("Planner", "BacklogHigh", int, 500, _non_negative, "must not be negative"),
+    "planner_history": Setting("Planner", "History", int, 10, lambda v: v >= 1, "must be at least 1"),
+
+    "pmp_wake_interval": Setting("PMP", "WakeInterval", int, None, _non_negative, "must not be negative"),
+
+    "upload_batch_size": Setting("Upload", "BatchSize", int, 50, lambda v: v >= 1, "must be at least 1"),
+    "upload_age_weight": Setting("Upload", "AgeWeight", float, 0.1, _non_negative, "must not be negative"),
+    "upload_aggregate_weight": Setting("Upload", "AggregateWeight", float, 0, _non_negative, "must not be negative"),
+    "upload_health_record": Setting("Upload", "HealthRecord", bool, False),
+}
 
 
 class Config:
+    """Validated, read-only settings. Use Config.load() to reuse the compiled result of earlier starts."""
+
+    # Increase when the attributes of Config change, to invalidate cached configs
+    CACHE_VERSION = 10
+
     def __init__(self, parser: configparser.ConfigParser):
-        self._parser = parser
-        self.database_file = parser.get("Database", "File", fallback="/home/htp/cameratrap.db")
+        # Overrides received over satellite take precedence over config.ini
+        self.downlink_file = parser.get("Downlink", "File", fallback="/home/htp/downlink.ini")
+        defaults = configparser.ConfigParser()
+        defaults.read_dict(parser)
+        parser.read(self.downlink_file)
+
+        for name, setting in SCHEMA.items():
+            setattr(self, name, setting.read(parser))
 
-        self.sd_download_directory = Path(parser.get("SDCard", "DownloadFolder", fallback="/home/htp/camdata"))
-        self.sd_download_directory.mkdir(exist_ok=True)
+        # Each camera is "<camera id> = <host>" or "<camera id> = <host>, <source address>"
+        self.cameras = {}
+        if parser.has_section("Cameras"):
+            for camera_id in parser["Cameras"]:
+                elements = [e.strip() for e in parser.get("Cameras", camera_id).split(",")]
+                if len(elements) > 2 or not elements[0]:
+                    raise ConfigException(f"Camera {camera_id} must be formatted as '<host>' or '<host>, <source address>'")
+                self.cameras[camera_id] = CameraConfig(camera_id, elements[0], elements[1] if len(elements) == 2 else None)
 
-        self.sd_max_per_day = parser.getint("SDCard", "MaxPerDay", fallback=25)
+        if not self.cameras:
+            self.cameras[DEFAULT_CAMERA] = CameraConfig(DEFAULT_CAMERA, DEFAULT_HOST)
 
-        self.inference_command = parser.get("Inference", "Command", fallback=None)
+        # Each model is "<name> = <model file>, <labels file>", [Classify] Model and ShadowModel pick from these
+        self.models = {}
+        if parser.has_section("Models"):
+            for name in parser["Models"]:
+                elements = [e.strip() for e in parser.get("Models", name).split(",")]
+                if len(elements) != 2 or not all(elements):
+                    raise ConfigException(f"Model {name} must be formatted as '<model file>, <labels file>'")
+                self.models[name] = ModelConfig(name, elements[0], elements[1])
 
-        self.tensorflow_lite_model = parser.get("TensorFlowLite", "Model")
-        self.tensorflow_lite_labels = parser.get("TensorFlowLite", "Labels")
+        self.model = self.__active_model(parser)
+        # What core falls back to when the labels of a model set over satellite do not load
+        self.default_model = self.__active_model(defaults)
 
-        self.classify_max_attempts = parser.getint("Classify", "MaxAttempts", fallback=2)
+        self.shadow_model = None
+        if self.classify_shadow_model:
+            self.shadow_model = self.__registered_model("ShadowModel", self.classify_shadow_model)
+            if self.shadow_model.key == self.model.key:
+                # Promoted, the shadow entry can stay until it is replaced by the next candidate
+                self.shadow_model = None
 
-        self.serial_port = parser.get("RockBLOCK", "SerialPort")
-        self.rockblock_verbose = parser.getboolean("RockBLOCK", "Verbose", fallback=False)
-        self.rockblock_verbose_serial = parser.getboolean("RockBLOCK", "VerboseSerial", fallback=False)
-        self.rockblock_retry_attempts = parser.getint("RockBLOCK", "RetryAttempts", fallback=15)
+        # Each module is "<module> = <level>", e.g. rockBlock = DEBUG
+        self.log_levels = {}
+        if parser.has_section("LogLevels"):
+            for module in parser["LogLevels"]:
+                try:
+                    self.log_levels[module] = level(parser.get("LogLevels", module))
+                except ValueError:
+                    raise ConfigException(f"Log level of {module} must be one of DEBUG, INFO, WARNING or ERROR")
 
-        if len(parser["Mapping"]) == 0:
-            raise Exception("Mappings must be specified in the config file")
+        if not parser.has_section("Mapping") or len(parser["Mapping"]) == 0:
+            raise ConfigException("Mappings must be specified in the config file")
 
+        # Each mapping is "<class id>" or "<class id>, <upload weight>"
         self.mapping = {}
+        self.class_weights = {}
+        keys_by_value = {}
         for key in parser["Mapping"]:
-            value = parser.getint("Mapping", key)
+            elements = parser.get("Mapping", key).split(",")
+            if len(elements) > 2:
+                raise ConfigException(f"Mapping {key} must be formatted as '<id>' or '<id>, <weight>'")
+
+            try:
+                value = int(elements[0])
+                weight = float(elements[1]) if len(elements) == 2 else 1.0
+            except ValueError:
+                raise ConfigException(f"Mapping {key} must be formatted as '<id>' or '<id>, <weight>'")
 
             if value < 1 or value > 255:
-                raise Exception(f"Mapping {key} with value {value} is not allowed, must be between 1 and 255")
+                raise ConfigException(f"Mapping {key} with value {value} is not allowed, must be between 1 and 255")
 
-            for k, v in self.mapping.items():
-                if value == v:
-                    raise Exception(f"Duplicate value ({v}) found for keys {k} and {key}")
+            if weight < 0:
+                raise ConfigException(f"Mapping {key} with weight {weight} is not allowed, must not be negative")
 
+            if value in keys_by_value:
+                raise ConfigException(f"Duplicate value ({value}) found for keys {keys_by_value[value]} and {key}")
+
+            keys_by_value[value] = key
             self.mapping[key] = value
+            self.class_weights[key] = weight
+
+        # Lookup tables shared by the inferencer, upload queue and encoder
+        self.class_ids = dict((k.lower(), v) for k, v in self.mapping.items())
+        self.class_weights_by_id = dict((self.mapping[k], w) for k, w in self.class_weights.items())
+
+        self._frozen = True
+
+    def __active_model(self, parser: configparser.ConfigParser) -> ModelConfig:
+        # Without [Classify] Model the model of [TensorFlowLite] is active, as before there were several
+        name = SCHEMA["classify_model"].read(parser)
+        if name:
+            return self.__registered_model("Model", name)
+        model = SCHEMA["tensorflow_lite_model"].read(parser)
+        return ModelConfig(Path(model).stem, model, SCHEMA["tensorflow_lite_labels"].read(parser))
+
+    def __registered_model(self, key: str, name: str) -> ModelConfig:
+        if name not in self.models:
+            raise ConfigException(f"[Classify] {key} = {name} is not one of [Models]")
+        return self.models[name]
+
+    def __setattr__(self, name, value):
+        if getattr(self, "_frozen", False):
+            raise AttributeError(f"Config is read-only, cannot set {name}")
+        super().__setattr__(name, value)
+
+    @staticmethod
+    def _file_key(path) -> Optional[tuple]:
+        try:
+            stat = os.stat(path)
+            return str(path), stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    @classmethod
+    def _cache_key(cls, config_file) -> tuple:
+        # The config module itself is part of the key, so code updates never read an incompatible cache
+        return cls.CACHE_VERSION, cls._file_key(__file__), cls._file_key(config_file)
+
+    @classmethod
+    def load(cls, config_file, cache_file=None) -> 'Config':
+        """Loads config_file, reusing the cached result when neither it nor the downlink overrides changed"""
+        cache_file = cache_file or f"{config_file}.cache"
+
+        try:
+            with open(cache_file, 'rb') as f:
+                key, downlink_key, config = pickle.load(f)
+            if key == cls._cache_key(config_file) and downlink_key == cls._file_key(config.downlink_file):
+                return config
+        except Exception:
+            pass
+
+        parser = configparser.ConfigParser()
+        if not parser.read(config_file):
+            raise ConfigException(f"Config file {config_file} could not be read")
+        config = cls(parser)
+
+        try:
+            tmp_file = f"{cache_file}.tmp"
+            with open(tmp_file, 'wb') as f:
+                pickle.dump((cls._cache_key(config_file), cls._file_key(config.downlink_file), config), f)
+            os.replace(tmp_file, cache_file)
+        except Exception as e:
+            log.warning("Could not cache config: %s", e)
+
+        return config
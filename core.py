@@ -1,66 +1,256 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
+import logging
+import signal
+import subprocess
+import threading
 from array import array
-import configparser
 from pathlib import Path
+from typing import List, Optional, TYPE_CHECKING
 from peewee import SqliteDatabase
-from api import EzShareApi
+import clock
 from classify import FileClassifier
 from communication import Communicator
-from communicator_rockblock import SatelliteCommunicator
-from config import Config
-from read_pmp import read_pmp
+from concurrent.futures import ThreadPoolExecutor
+from config import Config, CameraConfig, ModelConfig, DEFAULT_CAMERA, DEFAULT_HOST
+from downlink import DownlinkStore
+from pmp import PmpReading
 from database import Repository
+from datetime import datetime
+from metrics import Metrics, StageTimer
 from encoder import KEEP_ALIVE, SatelliteEncoder
-from ping import Ping
-from sync import FileSyncManager
-import subprocess
-from tensorflow_inferencer import TensorFlowLiteInferencer
+from governor import InferenceGovernor
+from health import HealthRecord
+from journal import Journal
+import log_buffer
+from peripherals import Peripherals
+from result_cache import ResultCache
+from staging import StagingArea, MB
+from planner import CyclePlan, CyclePlanner
+from profiler import StageProfiler
+from upload_queue import UploadQueue
 from uploader import Uploader
 
+log = logging.getLogger(__name__)
+
+# Heavy modules (requests, numpy, PIL, tflite_runtime, gpiozero) are imported in the stages that need them
+if TYPE_CHECKING:
+    from model_registry import ModelRegistry
+
 
 class SmartCameraTrap:
-    def __init__(self, config: Config, reachable: bool):
+    def __init__(self, config: Config, reachable: bool, boot_stages: List[StageTimer] = (),
+                 pmp_data: Optional[dict] = None, origin: Optional[float] = None, profile: bool = False,
+                 peripherals: Optional[Peripherals] = None):
         self._config = config
-        self._ping = Ping()
+        self._peripherals = peripherals if peripherals is not None else Peripherals()
         self._version = self.read_version()
-        self._pmp_data = read_pmp()
+        self._profiler = StageProfiler.create(config, self._version, profile)
+        self._metrics = Metrics(origin, self._profiler)
+        self._metrics.extend(boot_stages)
+        self._pmp_data = pmp_data if pmp_data is not None else {}
         self._activation = str(self._pmp_data.get("activation", "unknown")).lower()
         self._sdcard_reachable = reachable
+        # Stops the downloads and classification running in worker threads, see main.py Watchdog
+        self._cancel = threading.Event()
+
+    @property
+    def metrics(self) -> Metrics:
+        return self._metrics
+
+    @property
+    def cancel(self) -> threading.Event:
+        return self._cancel
 
-    def read_version(self) -> int:
+    @staticmethod
+    def read_version() -> int:
         try:
             with open("version.txt", mode='r') as f:
                 return int(f.read())
         except Exception as e:
-            print("Could get version", e)
+            log.warning("Could get version %s", e)
             return 0
 
-    def logrotate(self):
+    def run(self):
+        log_buffer.setup(self._config)
+        try:
+            self.run_cycle()
+        finally:
+            if self._profiler is not None:
+                self._profiler.close()
+            self.logrotate()
+            # Once per cycle, rotating the log file when it grew too large
+            log_buffer.flush()
+
+    @staticmethod
+    def logrotate():
+        # The console goes to syslog, the Pi is never up long enough for cron to rotate it (install.sh)
         try:
             subprocess.check_call(["logrotate", "/etc/logrotate.conf"])
         except Exception as e:
-            print("Error running logrotate", e)
+            log.error("Error running logrotate %s", e)
 
-    def run(self):
+    def run_cycle(self):
+        started = clock.now()
+        started_monotonic = clock.monotonic()
         repository = Repository(SqliteDatabase(self._config.database_file))
 
-        if self._sdcard_reachable:
-            FileSyncManager(self._config, repository, EzShareApi(), self._ping).run()
+        self.save_pmp_reading(repository, started)
+
+        with self._metrics.stage("reconcile"):
+            Journal(self._config, repository).reconcile()
+            staging = StagingArea(self._config, repository)
+            staging.enforce()
+
+        plan = CyclePlanner(self._config, repository).plan(self._pmp_data, started_monotonic)
+        log.info("Cycle plan: %s", plan)
 
-        inferencer = TensorFlowLiteInferencer(self._config)
-        FileClassifier(repository, inferencer, self._config.classify_max_attempts).run()
+        with self._metrics.stage("cycle", process_wide=True):
+            self.process(repository, plan, staging)
+
+        # Occupancy left for the next cycle
+        with self._metrics.stage("staging") as stage:
+            stage.items, stage.bytes = repository.get_staged_usage()
+        log.info("Staging: %s file(s), %sMB, %sMB free", stage.items, stage.bytes // MB, staging.free_bytes() // MB)
+
+        self.save_metrics(repository, started)
+        log.info("Done")
+
+    def process(self, repository: Repository, plan: CyclePlan, staging: Optional[StagingArea] = None):
+        from labels import LabelRegistry
+        from model_registry import ModelRegistry, ShadowEvaluator
+
+        # Fails before anything is downloaded when a label of the active model has no class id
+        registry = ModelRegistry(self._config)
+        model = self.select_model(registry)
+        repository.update_missing_class_ids(self._config.mapping, LabelRegistry.UNKNOWN_CLASS)
+
+        if plan.download:
+            self.sync_cameras(repository, plan, staging)
+
+        from communicator_rockblock import SatelliteCommunicator
+
+        classifier = None
+        if plan.classify:
+            inferencer = registry.inferencer(model)
+            governor = None
+            if self._config.governor_soc_temp > 0:
+                governor = InferenceGovernor(self._config, registry.set_threads, self._pmp_data)
+            cache = None
+            if self._config.classify_cache_size > 0:
+                cache = ResultCache(repository, model.model, self._config.classify_cache_size)
+            shadow = None
+            if self._config.shadow_model is not None and self._config.shadow_model.key != model.key and \
+                    self._config.classify_shadow_fraction > 0:
+                shadow = ShadowEvaluator(repository, registry, self._config.shadow_model,
+                                         self._config.classify_shadow_fraction)
+            classifier = FileClassifier(repository, inferencer, self._config.classify_max_attempts, self._metrics,
+                                        cache, governor, shadow, self._cancel)
 
         communicators: array[Communicator] = [
-            SatelliteCommunicator(self._config),
+            SatelliteCommunicator(self._config, DownlinkStore(self._config).handle_message, self._peripherals.serial),
         ]
 
-        encoder = SatelliteEncoder(self._config.mapping, self._pmp_data, self._version)
+        health = None
+        if self._config.upload_health_record:
+            health = HealthRecord.collect(self._pmp_data, self._version, repository, self._config.database_file,
+                                          self._activation == KEEP_ALIVE)
+
+        encoder = SatelliteEncoder(self._pmp_data, self._version, health,
+                                   list(self._config.cameras.keys()))
+
+        queue = UploadQueue(repository, self._config.class_weights_by_id, self._config.upload_age_weight,
+                            self._config.upload_aggregate_weight, self._config.upload_batch_size)
 
-        Uploader(communicators, repository, encoder, self._activation == KEEP_ALIVE).run()
+        uploader = Uploader(communicators, queue, encoder, self._activation == KEEP_ALIVE, self._metrics)
 
-        self.logrotate()
-        print("Done")
+        asyncio.run(self.classify_and_upload(repository, classifier, uploader, plan))
+
+    def select_model(self, registry: 'ModelRegistry') -> ModelConfig:
+        """The active model, or the one of config.ini when the labels of a model set over satellite do not load.
+        Failing the cycle would also stop the uploads a corrected downlink arrives with."""
+        model = self._config.model
+        try:
+            registry.labels(model)
+            return model
+        except Exception as e:
+            if model.key == self._config.default_model.key:
+                raise
+            log.error("Labels of model %s do not load %s, using %s", model, e, self._config.default_model)
+
+        registry.labels(self._config.default_model)
+        return self._config.default_model
+
+    def sync_cameras(self, repository: Repository, plan: CyclePlan, staging: Optional[StagingArea] = None):
+        cameras = list(self._config.cameras.values())
+        # The planned downloads are shared, classification and upload handle all cameras together
+        max_downloads = plan.max_downloads // len(cameras) if plan.max_downloads is not None else None
+
+        with ThreadPoolExecutor(max_workers=len(cameras)) as executor:
+            futures = [executor.submit(self.sync_camera, repository, camera, max_downloads, plan, staging)
+                       for camera in cameras]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    log.error("Error syncing camera %s", e)
+
+    def sync_camera(self, repository: Repository, camera: CameraConfig, max_downloads: Optional[int], plan: CyclePlan,
+                    staging: Optional[StagingArea] = None):
+        from api import EzShareApi
+        from sync import FileSyncManager
+
+        reachability = self._peripherals.reachability(camera.source_address)
+        if camera.camera_id == DEFAULT_CAMERA and camera.host == DEFAULT_HOST:
+            # Already probed by main.py
+            reachable = self._sdcard_reachable
+        else:
+            reachable = reachability.is_reachable(camera.host, deadline=10, cancel=self._cancel)
+
+        if not reachable:
+            log.warning("Camera %s not reachable, skipping sync", camera)
+            return
+
+        log.info("Syncing camera %s...", camera)
+        api = EzShareApi(self._peripherals.http_client(camera.host, camera.source_address))
+        FileSyncManager(self._config, repository, api, reachability, self._metrics, camera.camera_id, staging,
+                        self._cancel).run(max_downloads, plan.deadline - plan.upload_reserve)
+
+    def save_pmp_reading(self, repository: Repository, started: datetime):
+        if not self._pmp_data:
+            return
+
+        try:
+            repository.insert_pmp_reading(started, self._pmp_data)
+        except Exception as e:
+            log.error("Error saving PMP reading %s", e)
+
+    def save_metrics(self, repository: Repository, started: datetime):
+        log.info("Cycle metrics:")
+        self._metrics.print_summary()
+        try:
+            repository.insert_cycle_metrics(started, self._version, self._metrics.stages,
+                                            self._config.metrics_keep_cycles)
+        except Exception as e:
+            log.error("Error saving cycle metrics %s", e)
+
+    async def classify_and_upload(self, repository: Repository, classifier: Optional[FileClassifier],
+                                  uploader: Uploader, plan: CyclePlan):
+        loop = asyncio.get_running_loop()
+
+        if classifier is None:
+            await uploader.run_async(plan.deadline)
+        elif repository.has_photos_to_sync():
+            # A backlog is already waiting, send it over satellite while the new images are classified
+            await asyncio.gather(
+                loop.run_in_executor(None, classifier.run, plan.max_classifications, plan.deadline),
+                uploader.run_async(plan.deadline))
+        else:
+            # Nothing to send yet, classify first so the new images make it into this upload
+            await loop.run_in_executor(None, classifier.run, plan.max_classifications,
+                                       plan.deadline - plan.upload_reserve)
+            await uploader.run_async(plan.deadline)
 
 
 if __name__ == '__main__':
@@ -86,9 +276,34 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Smart Camera Trap Processing')
     parser.add_argument('--config', help='configuration file', type=file_path, default="config.ini")
     parser.add_argument('--reachable', help='if wifi SD card was reachable', type=str2bool, default="True")
+    parser.add_argument('--metrics', help='JSON encoded metrics of the boot stages', type=Metrics.from_json, default="[]")
+    parser.add_argument('--pmp', help='JSON encoded PMP values', type=PmpReading.from_json, default="{}")
+    parser.add_argument('--origin', help='boot clock time the cold start is measured from', type=float, default=None)
+    parser.add_argument('--profile', help='profile every stage, overrides [Profile] Enabled', action="store_true")
+    parser.add_argument('--record', help='record the card, modem and probe interactions to a trace file for replay.py',
+                        default=None)
 
     args = parser.parse_args()
 
-    parser = configparser.ConfigParser()
-    parser.read(args.config)
-    SmartCameraTrap(Config(parser), args.reachable).run()
+    config = Config.load(args.config)
+    recorder = None
+    if args.record is not None:
+        from cycle_trace import TraceRecorder
+        recorder = TraceRecorder.start(args.record, args.config, config, args.reachable, args.pmp.values)
+
+    trap = SmartCameraTrap(config, args.reachable, args.metrics, args.pmp.values, args.origin, args.profile,
+                           recorder.peripherals if recorder is not None else None)
+
+    def terminate(signum, frame):
+        # Sent by main.py when the cycle overran, the log of that cycle is the one most needed
+        log.warning("Terminated, the cycle took too long")
+        trap.cancel.set()
+        log_buffer.flush()
+        raise SystemExit(1)
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        trap.run()
+    finally:
+        if recorder is not None:
+            recorder.close(trap.metrics.stages)
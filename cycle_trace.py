@@ -0,0 +1,381 @@
+import fcntl
+import itertools
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import termios
+import threading
+import time
+import zipfile
+from collections import deque
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from api import HttpClient
+from clock import VirtualClock
+from config import Config
+from metrics import StageTimer
+from peripherals import Peripherals
+from reachability import Reachability
+
+log = logging.getLogger(__name__)
+
+# Increase when the layout of the trace changes, older traces are refused by the player
+TRACE_VERSION = 1
+
+# Members of the zip file
+TRACE_FILE = "trace.json"
+DATABASE_FILE = "database.sqlite"
+STAGED_DIR = "staged/"
+BLOB_DIR = "blobs/"
+
+_MISSING = object()
+
+
+class TraceException(Exception):
+    pass
+
+
+class ReplayedError(Exception):
+    """An error the card or modem returned when the cycle was recorded"""
+    pass
+
+
+# A trace is a zip file with the external interactions of one cycle. trace.json holds the start time,
+# PMP values, config and the events of every channel in order; a channel is a card URL, the probes of a
+# host or a serial port. The database and staged downloads the cycle started from and the bodies of the
+# responses are separate members. Each event keeps how long the interaction took in the field.
+class TraceRecorder:
+    def __init__(self, path, header: dict):
+        # Stored, the JPEGs do not compress
+        self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED)
+        self._header = header
+        self._events: Dict[str, List[dict]] = {}
+        # Shared by the sync threads of all cameras and the upload
+        self._lock = threading.Lock()
+        self._blobs = itertools.count()
+
+    @classmethod
+    def start(cls, path, config_file, config: Config, reachable: bool, pmp_data: dict) -> 'TraceRecorder':
+        downlink = Path(config.downlink_file)
+        recorder = cls(path, {
+            "started": datetime.now().isoformat(),
+            "reachable": reachable,
+            "pmp": pmp_data,
+            "config": Path(config_file).read_text(),
+            "downlink": downlink.read_text() if downlink.is_file() else None,
+            # Local files are stored resolved, see Repository.insert_photo
+            "download_directory": str(Path(config.sd_download_directory).resolve()),
+        })
+        recorder.__snapshot(config)
+        log.info("Recording cycle to %s", path)
+        return recorder
+
+    @property
+    def peripherals(self) -> Peripherals:
+        return RecordingPeripherals(self)
+
+    def record(self, channel: str, event: dict):
+        with self._lock:
+            self._events.setdefault(channel, []).append(event)
+
+    def add_blob(self, data: bytes) -> str:
+        with self._lock:
+            name = f"{BLOB_DIR}{next(self._blobs)}"
+            self._zip.writestr(name, data)
+        return name
+
+    def add_file(self, path) -> str:
+        with self._lock:
+            name = f"{BLOB_DIR}{next(self._blobs)}"
+            self._zip.write(path, name)
+        return name
+
+    def close(self, stages: List[StageTimer] = ()):
+        # The metrics of the recorded cycle, to compare replays with
+        self._header["stages"] = [s.to_dict() for s in stages]
+        with self._lock:
+            self._zip.writestr(TRACE_FILE, json.dumps({
+                "version": TRACE_VERSION,
+                "header": self._header,
+                "events": self._events,
+            }))
+            self._zip.close()
+
+    def __snapshot(self, config: Config):
+        # The database and staged downloads the cycle starts from
+        if os.path.isfile(config.database_file):
+            with tempfile.TemporaryDirectory() as directory:
+                copy = os.path.join(directory, DATABASE_FILE)
+                source = sqlite3.connect(config.database_file)
+                target = sqlite3.connect(copy)
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+                    source.close()
+                self._zip.write(copy, DATABASE_FILE)
+
+        download_directory = Path(config.sd_download_directory)
+        if download_directory.is_dir():
+            for f in sorted(download_directory.rglob("*")):
+                if f.is_file():
+                    self._zip.write(f, STAGED_DIR + f.relative_to(download_directory).as_posix())
+
+
+class TracePlayer:
+    def __init__(self, path):
+        self._zip = zipfile.ZipFile(path)
+        trace = json.loads(self._zip.read(TRACE_FILE))
+        if trace.get("version") != TRACE_VERSION:
+            raise TraceException(f"Trace version {trace.get('version')} is not supported, expected {TRACE_VERSION}")
+
+        self.header: dict = trace["header"]
+        self._events = dict((channel, deque(events)) for channel, events in trace["events"].items())
+        self._lock = threading.Lock()
+
+    def next(self, channel: str, default=_MISSING) -> Optional[dict]:
+        with self._lock:
+            events = self._events.get(channel)
+            if events:
+                return events.popleft()
+
+        if default is not _MISSING:
+            return default
+        raise TraceException(f"No recorded interaction left for {channel}, the replay diverged from the recording")
+
+    def peek(self, channel: str) -> Optional[dict]:
+        with self._lock:
+            events = self._events.get(channel)
+            return events[0] if events else None
+
+    def remaining(self) -> Dict[str, int]:
+        """Number of recorded interactions by channel that were not replayed"""
+        with self._lock:
+            return dict((channel, len(events)) for channel, events in self._events.items() if events)
+
+    def has(self, name: str) -> bool:
+        return name in self._zip.NameToInfo
+
+    def members(self, prefix: str) -> List[str]:
+        return [name for name in self._zip.namelist() if name.startswith(prefix) and not name.endswith("/")]
+
+    def read(self, name: str) -> bytes:
+        return self._zip.read(name)
+
+    def extract(self, name: str, to_file):
+        Path(to_file).parent.mkdir(parents=True, exist_ok=True)
+        with self._zip.open(name) as source, open(to_file, 'wb') as target:
+            shutil.copyfileobj(source, target)
+
+    def close(self):
+        self._zip.close()
+
+
+class RecordingPeripherals(Peripherals):
+    def __init__(self, recorder: TraceRecorder):
+        self._recorder = recorder
+
+    def http_client(self, host: str, source_address: Optional[str] = None):
+        return RecordingHttpClient(self._recorder, host, source_address)
+
+    def reachability(self, source_address: Optional[str] = None) -> Reachability:
+        return RecordingReachability(self._recorder, source_address=source_address)
+
+    def serial(self, port: str, baudrate: int, timeout: Optional[float] = None):
+        return RecordingSerial(self._recorder, port, super().serial(port, baudrate, timeout))
+
+
+class ReplayPeripherals(Peripherals):
+    def __init__(self, player: TracePlayer, clock: VirtualClock):
+        self._player = player
+        self._clock = clock
+
+    def http_client(self, host: str, source_address: Optional[str] = None):
+        return ReplayHttpClient(self._player, self._clock, host, source_address)
+
+    def reachability(self, source_address: Optional[str] = None) -> Reachability:
+        return ReplayReachability(self._player, self._clock, source_address=source_address)
+
+    def serial(self, port: str, baudrate: int, timeout: Optional[float] = None):
+        return ReplaySerial(self._player, self._clock, port)
+
+
+class RecordingHttpClient(HttpClient):
+    def __init__(self, recorder: TraceRecorder, host: str, source_address: Optional[str] = None):
+        super().__init__(host, source_address=source_address)
+        self._recorder = recorder
+
+    def http_get(self, path: str, params: dict = None):
+        return self.__record(f"get {self.build_url(path, params)}", partial(super().http_get, path, params),
+                             lambda res: {"status": res.status_code, "body": self._recorder.add_blob(res.content)})
+
+    def stream_url_to_file(self, url: str, to_file: str):
+        self.__record(f"download {url}", partial(super().stream_url_to_file, url, to_file),
+                      lambda _: {"file": self._recorder.add_file(to_file)})
+
+    def read_url_prefix(self, url: str, length: int) -> bytes:
+        return self.__record(f"prefix {url} {length}", partial(super().read_url_prefix, url, length),
+                             lambda data: {"data": self._recorder.add_blob(data)})
+
+    def __record(self, channel: str, call, describe):
+        started = time.monotonic()
+        try:
+            result = call()
+        except Exception as e:
+            self._recorder.record(channel, {"error": f"{type(e).__name__}: {e}", "elapsed": time.monotonic() - started})
+            raise
+
+        event = describe(result)
+        event["elapsed"] = time.monotonic() - started
+        self._recorder.record(channel, event)
+        return result
+
+
+class ReplayedResponse:
+    def __init__(self, status_code: int, content: bytes):
+        self.status_code = status_code
+        self.content = content
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise ReplayedError(f"HTTP status {self.status_code}")
+
+
+class ReplayHttpClient(HttpClient):
+    def __init__(self, player: TracePlayer, clock: VirtualClock, host: str, source_address: Optional[str] = None):
+        super().__init__(host, source_address=source_address)
+        self._player = player
+        self._clock = clock
+
+    def http_get(self, path: str, params: dict = None):
+        event = self.__replay(f"get {self.build_url(path, params)}")
+        return ReplayedResponse(event["status"], self._player.read(event["body"]))
+
+    def stream_url_to_file(self, url: str, to_file: str):
+        event = self.__replay(f"download {url}")
+        self._player.extract(event["file"], to_file)
+
+    def read_url_prefix(self, url: str, length: int) -> bytes:
+        event = self.__replay(f"prefix {url} {length}")
+        return self._player.read(event["data"])
+
+    def __replay(self, channel: str) -> dict:
+        event = self._player.next(channel)
+        self._clock.advance(event["elapsed"])
+        if "error" in event:
+            raise ReplayedError(event["error"])
+        return event
+
+
+class RecordingReachability(Reachability):
+    def __init__(self, recorder: TraceRecorder, **kwargs):
+        super().__init__(**kwargs)
+        self._recorder = recorder
+
+    def _probe_once(self, host: str) -> bool:
+        started = time.monotonic()
+        reachable = super()._probe_once(host)
+        self._recorder.record(f"probe {host}", {"reachable": reachable, "elapsed": time.monotonic() - started})
+        return reachable
+
+
+class ReplayReachability(Reachability):
+    def __init__(self, player: TracePlayer, clock: VirtualClock, **kwargs):
+        super().__init__(**kwargs)
+        self._player = player
+        self._clock = clock
+
+    def _probe_once(self, host: str) -> bool:
+        event = self._player.next(f"probe {host}", None)
+        if event is None:
+            # Probed more often than in the field, taken as the card having gone away
+            return False
+        self._clock.advance(event["elapsed"])
+        return event["reachable"]
+
+
+class RecordingSerial:
+    """Records what is written to the port together with what is read back until the next write"""
+
+    def __init__(self, recorder: TraceRecorder, port: str, serial):
+        self._recorder = recorder
+        self._channel = f"serial {port}"
+        self._serial = serial
+        self._exchange: Optional[dict] = None
+        self._written = time.monotonic()
+
+    def write(self, data: bytes) -> int:
+        self._written = time.monotonic()
+        self._exchange = {"write": data.hex(), "read": "", "elapsed": 0}
+        self._recorder.record(self._channel, self._exchange)
+        return self._serial.write(data)
+
+    def read(self, size: int = 1) -> bytes:
+        data = self._serial.read(size)
+        if data:
+            if self._exchange is None:
+                # Read before anything was written
+                self._exchange = {"write": None, "read": "", "elapsed": 0}
+                self._recorder.record(self._channel, self._exchange)
+            self._exchange["read"] += data.hex()
+            self._exchange["elapsed"] = time.monotonic() - self._written
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._serial, name)
+
+
+class ReplaySerial:
+    """Answers every write with what was read after it when recording, through a pipe the event loop can watch"""
+
+    def __init__(self, player: TracePlayer, clock: VirtualClock, port: str):
+        self._player = player
+        self._clock = clock
+        self._channel = f"serial {port}"
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+
+        preamble = player.peek(self._channel)
+        if preamble is not None and preamble["write"] is None:
+            self.__answer(player.next(self._channel))
+
+    def fileno(self) -> int:
+        return self._read_fd
+
+    @property
+    def in_waiting(self) -> int:
+        return struct.unpack("i", fcntl.ioctl(self._read_fd, termios.FIONREAD, b"\0\0\0\0"))[0]
+
+    def read(self, size: int = 1) -> bytes:
+        try:
+            return os.read(self._read_fd, size)
+        except BlockingIOError:
+            return b""
+
+    def write(self, data: bytes) -> int:
+        exchange = self._player.next(self._channel)
+        if exchange["write"] != data.hex():
+            log.warning("Replay diverged on %s, wrote %s where %s was recorded",
+                        self._channel, data.hex(), exchange["write"])
+        self.__answer(exchange)
+        return len(data)
+
+    def isOpen(self) -> bool:
+        return self._read_fd is not None
+
+    def close(self):
+        if self._read_fd is not None:
+            os.close(self._read_fd)
+            os.close(self._write_fd)
+            self._read_fd = self._write_fd = None
+
+    def __answer(self, exchange: dict):
+        self._clock.advance(exchange["elapsed"])
+        os.write(self._write_fd, bytes.fromhex(exchange["read"]))
@@ -1,13 +1,24 @@
+import json
+import logging
 import textwrap
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta
 from enum import Enum
 from pathlib import Path
-from typing import List
+from typing import List, Mapping, Dict, Iterable, Iterator, Optional, TYPE_CHECKING
 
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
 
-from api import ApiFile
+import clock
+from config import DEFAULT_CAMERA
 from inferencer import ClassificationResult
+from metrics import StageTimer
+
+log = logging.getLogger(__name__)
+
+if TYPE_CHECKING:
+    from api import ApiFile
+    from governor import ThermalState
 
 
 class EnumField(IntegerField):
@@ -28,6 +39,11 @@ class Photo(Model):
         INFERENCE_SUCCESS = 1
         INFERENCE_ERROR = 2
         SYNCED = 3
+        # Checkpoints, a cycle that was killed is reconciled from these by the Journal
+        DOWNLOADING = 4
+        UPLOADING = 5
+        # Not downloaded because of the max per day or burst limits, known from the EXIF header on the card
+        SKIPPED = 6
 
     id: int = AutoField()
     fingerprint: str = CharField(index=True, null=False)
@@ -39,58 +55,382 @@ class Photo(Model):
     local_file: str = CharField(null=False)
     status: Status = EnumField(choices=Status, index=True, null=False, default=Status.TODO)
     inference_class: str = CharField(null=True)
+    # Class id of [Mapping], what uploads rank and encode by
+    inference_class_id: int = SmallIntegerField(index=True, null=True)
     inference_attempt: int = IntegerField(null=True)
     inference_accuracy: float = FloatField(null=True)
+    inference_scores: bytes = BlobField(null=True)  # Top-k scores packed by labels.pack_scores
     inference_error: str = CharField(null=True)
     inference_time: int = IntegerField(null=True)
+    inference_model: str = CharField(index=True, null=True)  # ModelConfig.key
+    # SoC temperature, clock and InferenceGovernor level during the inference
+    inference_soc_temp: float = FloatField(null=True)
+    inference_cpu_mhz: int = SmallIntegerField(null=True)
+    inference_throttled: bool = BooleanField(null=True)
+    inference_governor_level: int = SmallIntegerField(null=True)
     exif_datetime: dt = DateTimeField(null=True)
+    camera_id: str = CharField(null=False, default=DEFAULT_CAMERA)
+    content_hash: str = CharField(index=True, null=True)  # See result_cache.hash_file
+
+    class Meta:
+        # Keyset pagination of the photos in a status, see Repository.iter_photos_by_status
+        indexes = ((('status', 'datetime', 'id'), False),)
+
+
+class PendingPhoto:
+    """The few columns of a Photo needed to classify or reconcile it, without a model instance per row"""
+    __slots__ = ("id", "datetime", "local_file", "size", "inference_attempt")
+
+    def __init__(self, id: int, datetime: dt, local_file: str, size: int, inference_attempt: Optional[int]):
+        self.id = id
+        self.datetime = datetime
+        self.local_file = local_file
+        self.size = size
+        self.inference_attempt = inference_attempt
+
+
+class CachedResult(Model):
+    id: int = AutoField()
+    content_hash: str = CharField(null=False)
+    model: str = CharField(null=False)
+    inference_class: str = CharField(null=True)
+    inference_class_id: int = SmallIntegerField(null=True)
+    inference_accuracy: float = FloatField(null=True)
+    inference_scores: bytes = BlobField(null=True)
+    exif_datetime: dt = DateTimeField(null=True)
+    last_used: dt = DateTimeField(index=True, null=False)
+    hits: int = IntegerField(null=False, default=0)
+
+    class Meta:
+        indexes = ((('content_hash', 'model'), True),)
+
+
+# A photo classified by a candidate model next to the active (baseline) one, see ShadowEvaluator
+class ShadowResult(Model):
+    id: int = AutoField()
+    photo_id: int = IntegerField(null=False)
+    datetime: dt = DateTimeField(null=False)
+    model: str = CharField(index=True, null=False)
+    baseline: str = CharField(null=False)
+    class_id: int = SmallIntegerField(null=True)
+    baseline_class_id: int = SmallIntegerField(null=True)
+    agree: bool = BooleanField(null=False)
+    accuracy: float = FloatField(null=True)
+    time: int = IntegerField(null=False)
+    baseline_time: int = IntegerField(null=False)
+
+
+class Cycle(Model):
+    id: int = AutoField()
+    started: dt = DateTimeField(null=False)
+    version: int = IntegerField(null=False, default=0)
+
+
+class StageMetric(Model):
+    id: int = AutoField()
+    cycle: int = ForeignKeyField(Cycle, backref="stages", on_delete="CASCADE", null=False)
+    name: str = CharField(null=False)
+    wall_ms: int = IntegerField(null=False)
+    cpu_ms: int = IntegerField(null=False)
+    peak_rss_kb: int = IntegerField(null=False)
+    items: int = IntegerField(null=False, default=0)
+    bytes: int = IntegerField(null=False, default=0)
+
+
+class PmpHistory(Model):
+    id: int = AutoField()
+    datetime: dt = DateTimeField(index=True, null=False)
+    stm32_temp: float = FloatField(null=True)
+    bridge_temp: float = FloatField(null=True)
+    bridge_hum: float = FloatField(null=True)
+    bridge_hpa: int = IntegerField(null=True)
+    bridge_volt: int = IntegerField(null=True)
+    activation: str = CharField(null=True)
+    data: str = CharField(null=True)
+    extra: str = TextField(null=True)  # JSON encoded values of keys without a column
 
 
 class Repository:
     def __init__(self, db: SqliteDatabase = SqliteDatabase('cameratrap.db')):
         self._db = db
-        self._db.bind([Photo])
-        self._db.create_tables([Photo])
+        models = [Photo, CachedResult, ShadowResult, Cycle, StageMetric, PmpHistory]
+        self._db.bind(models)
+        # Before the indexes of create_tables, which SQLite creates on a missing column as well
+        self._add_missing_columns(models)
+        self._db.create_tables(models)
+
+    def _add_missing_columns(self, models: List[Model]):
+        """Adds the columns of fields introduced after a database file was created"""
+        migrator = SqliteMigrator(self._db)
+        operations = []
+        for model in models:
+            if not self._db.table_exists(model._meta.table_name):
+                continue
+            existing = {c.name for c in self._db.get_columns(model._meta.table_name)}
+            for field in model._meta.sorted_fields:
+                if field.column_name not in existing:
+                    log.debug("Adding column %s.%s", model._meta.table_name, field.column_name)
+                    # Also creates the index of an indexed field
+                    operations.append(migrator.add_column(model._meta.table_name, field.column_name, field))
 
-    def get_fingerprint(self, file: ApiFile):
-        return f"{file.directory.strip('/')}/{file.filename}/{file.datetime.isoformat()}/{file.size}"
+        if operations:
+            with self._db.atomic():
+                migrate(*operations)
+
+    def get_fingerprint(self, file: 'ApiFile', camera_id: str = DEFAULT_CAMERA):
+        fingerprint = f"{file.directory.strip('/')}/{file.filename}/{file.datetime.isoformat()}/{file.size}"
+        # Fingerprints of the default camera are unchanged so existing databases stay valid
+        return fingerprint if camera_id == DEFAULT_CAMERA else f"{camera_id}/{fingerprint}"
 
     def format_day(self, datetime: dt):
         return datetime.strftime("%Y-%m-%d")
 
-    def insert_photo(self, remote_file: ApiFile, output_file: Path):
+    def insert_photo(self, remote_file: 'ApiFile', output_file: Path, status: Photo.Status = Photo.Status.TODO,
+                     camera_id: str = DEFAULT_CAMERA, exif_datetime: Optional[dt] = None) -> int:
         photo = Photo()
-        photo.fingerprint = self.get_fingerprint(remote_file)
+        photo.status = status
+        photo.camera_id = camera_id
+        photo.fingerprint = self.get_fingerprint(remote_file, camera_id)
         photo.filename = remote_file.filename
         photo.directory = remote_file.directory
         photo.size = remote_file.size
         photo.datetime = remote_file.datetime
-        photo.date = self.format_day(remote_file.datetime)
+        photo.exif_datetime = exif_datetime
+        # The day photos are counted by for the max per day, the capture time when it is known
+        photo.date = self.format_day(exif_datetime or remote_file.datetime)
         photo.local_file = str(output_file.resolve())
         photo.save(force_insert=True)
+        return photo.id
+
+    def get_photos_by_status(self, status: Photo.Status) -> List[Photo]:
+        return Photo.select().where(Photo.status == status)
+
+    def get_statuses_by_local_file(self, local_files: List[str]) -> Dict[str, set]:
+        statuses = {}
+        # Chunked to stay below the SQLite variable limit
+        for i in range(0, len(local_files), 500):
+            query = Photo.select(Photo.local_file, Photo.status).where(Photo.local_file.in_(local_files[i:i + 500]))
+            for photo in query:
+                statuses.setdefault(photo.local_file, set()).add(photo.status)
+        return statuses
+
+    def update_photo_status(self, photo_id: int, status: Photo.Status) -> int:
+        return Photo.update(status=status).where(Photo.id == photo_id).execute()
+
+    def update_photos_status(self, photo_ids: List[int], status: Photo.Status, from_status: Photo.Status = None):
+        # Chunked to stay below the SQLite variable limit
+        for i in range(0, len(photo_ids), 500):
+            query = Photo.update(status=status).where(Photo.id.in_(photo_ids[i:i + 500]))
+            if from_status is not None:
+                query = query.where(Photo.status == from_status)
+            query.execute()
+
+    def get_photo_by_day_count(self, datetime: dt, camera_id: Optional[str] = None) -> int:
+        query = Photo.select(fn.Count()).where(
+            (Photo.date == self.format_day(datetime)) & (Photo.status != Photo.Status.SKIPPED))
+        if camera_id is not None:
+            query = query.where(Photo.camera_id == camera_id)
+        return query.scalar()
 
-    def get_photo_by_day_count(self, datetime: dt) -> int:
-        return Photo.select(fn.Count()).where(Photo.date == self.format_day(datetime)).scalar()
+    def count_photos_captured_between(self, start: dt, end: dt, camera_id: str = DEFAULT_CAMERA) -> int:
+        captured = fn.COALESCE(Photo.exif_datetime, Photo.datetime)
+        # Narrowed by the indexed day column first
+        days = [self.format_day(start + timedelta(days=i)) for i in range((end.date() - start.date()).days + 1)]
+        return Photo.select(fn.Count()).where(
+            (Photo.camera_id == camera_id) & (Photo.status != Photo.Status.SKIPPED) & (Photo.date.in_(days)) &
+            (captured >= start) & (captured <= end)).scalar()
 
-    def get_photo_exists(self, remote_file: ApiFile) -> bool:
-        return Photo.select().where(Photo.fingerprint == self.get_fingerprint(remote_file)).exists()
+    def get_photo_exists(self, remote_file: 'ApiFile', camera_id: str = DEFAULT_CAMERA) -> bool:
+        return Photo.select().where(Photo.fingerprint == self.get_fingerprint(remote_file, camera_id)).exists()
 
-    def get_photos_to_inference(self) -> List[Photo]:
-        return Photo.select().where(Photo.status == Photo.Status.TODO).order_by(Photo.datetime)
+    def count_photos_to_inference(self) -> int:
+        return Photo.select(fn.Count()).where(Photo.status == Photo.Status.TODO).scalar()
 
-    def get_photos_to_sync(self) -> List[Photo]:
-        return Photo.select().where(Photo.status == Photo.Status.INFERENCE_SUCCESS).order_by(Photo.datetime).limit(50)
+    def iter_photos_by_status(self, status: Photo.Status, page_size: int = 100) -> Iterator[PendingPhoto]:
+        """Streams the photos in a status oldest first, holding one page of rows at a time. Rows may change
+        status while iterating, pages continue after the last (datetime, id) seen instead of an offset."""
+        last = None
+        while True:
+            query = (Photo
+                     .select(Photo.id, Photo.datetime, Photo.local_file, Photo.size, Photo.inference_attempt)
+                     .where(Photo.status == status))
+            if last is not None:
+                query = query.where((Photo.datetime > last.datetime) |
+                                    ((Photo.datetime == last.datetime) & (Photo.id > last.id)))
 
-    def update_photo_inference_success(self, photo_id: int, result: ClassificationResult, attempt: int) -> int:
+            page = [PendingPhoto(*row) for row in query.order_by(Photo.datetime, Photo.id).limit(page_size).tuples()]
+            yield from page
+
+            if len(page) < page_size:
+                return
+            last = page[-1]
+
+    def move_local_files(self, from_directory: str, to_directory: str) -> int:
+        """Points the local files below from_directory to the same paths below to_directory"""
+        return Photo.update(local_file=fn.REPLACE(Photo.local_file, from_directory, to_directory)) \
+            .where(Photo.local_file.startswith(from_directory)).execute()
+
+    def get_staged_usage(self) -> tuple:
+        """Number and bytes of the downloaded files waiting for classification"""
+        files, size = Photo.select(fn.Count(), fn.SUM(Photo.size)).where(
+            Photo.status.in_([Photo.Status.TODO, Photo.Status.DOWNLOADING])).scalar(as_tuple=True)
+        return files, size or 0
+
+    def get_photos_to_evict(self, limit: int = 1000) -> List[PendingPhoto]:
+        """Unclassified photos in reverse classification order, the ones that failed before first"""
+        query = (Photo
+                 .select(Photo.id, Photo.datetime, Photo.local_file, Photo.size, Photo.inference_attempt)
+                 .where(Photo.status == Photo.Status.TODO)
+                 .order_by(fn.COALESCE(Photo.inference_attempt, 0).desc(), Photo.datetime.desc(), Photo.id.desc())
+                 .limit(limit))
+        return [PendingPhoto(*row) for row in query.tuples()]
+
+    def iter_photos_to_inference(self, page_size: int = 100) -> Iterator[PendingPhoto]:
+        return self.iter_photos_by_status(Photo.Status.TODO, page_size)
+
+    def has_photos_to_sync(self) -> bool:
+        return Photo.select().where(Photo.status == Photo.Status.INFERENCE_SUCCESS).exists()
+
+    def get_photos_to_sync(self, limit: int = 50, class_weights: Mapping[int, float] = None, age_weight: float = 0,
+                           exclude_classes: Iterable[int] = ()) -> List[Photo]:
+        query = Photo.select().where(Photo.status == Photo.Status.INFERENCE_SUCCESS)
+
+        exclude_classes = list(exclude_classes)
+        if exclude_classes:
+            query = query.where(Photo.inference_class_id.not_in(exclude_classes))
+
+        if class_weights is None:
+            return query.order_by(Photo.datetime).limit(limit)
+
+        # priority = class weight * confidence * (1 + age weight * days waiting)
+        weight = Case(Photo.inference_class_id, list(class_weights.items()), 1.0)
+        age = fn.MAX(0, fn.julianday('now') - fn.julianday(Photo.datetime))
+        priority = weight * fn.COALESCE(Photo.inference_accuracy, 0) * (1 + age_weight * age)
+
+        return query.order_by(priority.desc(), Photo.datetime).limit(limit)
+
+    def get_photo_ids_to_sync_by_class(self, class_ids: Iterable[int]) -> Dict[int, List[int]]:
+        class_ids = list(class_ids)
+        if not class_ids:
+            return {}
+
+        query = (Photo
+                 .select(Photo.id, Photo.inference_class_id)
+                 .where((Photo.status == Photo.Status.INFERENCE_SUCCESS) &
+                        (Photo.inference_class_id.in_(class_ids))))
+
+        ids = {}
+        for photo_id, class_id in query.tuples():
+            ids.setdefault(class_id, []).append(photo_id)
+        return ids
+
+    def update_missing_class_ids(self, class_ids: Mapping[str, int], unknown_class: int = 0) -> int:
+        """Fills in the class id of photos classified before the column existed"""
+        class_id = Case(fn.LOWER(Photo.inference_class), [(k.lower(), v) for k, v in class_ids.items()], unknown_class)
+        return Photo.update(inference_class_id=class_id).where(
+            Photo.inference_class_id.is_null() & Photo.inference_class.is_null(False)).execute()
+
+    def update_photo_inference_success(self, photo_id: int, result: ClassificationResult, attempt: int,
+                                       content_hash: Optional[str] = None,
+                                       thermal: Optional['ThermalState'] = None) -> int:
         return Photo.update(
             status=Photo.Status.INFERENCE_SUCCESS,
+            content_hash=content_hash,
             inference_time=result.time,
+            inference_model=result.model,
+            inference_soc_temp=thermal.soc_temp if thermal is not None else None,
+            inference_cpu_mhz=thermal.cpu_mhz if thermal is not None else None,
+            inference_throttled=thermal.throttled if thermal is not None else None,
+            inference_governor_level=thermal.level if thermal is not None else None,
             inference_class=result.name,
+            inference_class_id=result.class_id,
+            inference_scores=result.scores,
             inference_accuracy=result.accuracy,
             exif_datetime=result.exif_datetime,
             inference_attempt=attempt,
         ).where(Photo.id == photo_id).execute()
 
+    def get_photo_scores(self, statuses: Iterable[Photo.Status]) -> List[tuple]:
+        """Returns (id, class id, packed scores) of the photos that have scores"""
+        return list(Photo
+                    .select(Photo.id, Photo.inference_class_id, Photo.inference_scores)
+                    .where(Photo.status.in_(list(statuses)) & Photo.inference_scores.is_null(False))
+                    .order_by(Photo.id)
+                    .tuples())
+
+    def update_photos_inference_class(self, rows: List[tuple]):
+        """Updates the classification of (id, class name, class id, accuracy) rows in one transaction"""
+        with self._db.atomic():
+            # Batched to stay below the SQLite variable limit
+            Photo.bulk_update([Photo(id=photo_id, inference_class=name, inference_class_id=class_id,
+                                     inference_accuracy=accuracy) for photo_id, name, class_id, accuracy in rows],
+                              [Photo.inference_class, Photo.inference_class_id, Photo.inference_accuracy],
+                              batch_size=100)
+
+    def get_cached_result(self, content_hash: str, model: str) -> Optional[ClassificationResult]:
+        cached = CachedResult.get_or_none((CachedResult.content_hash == content_hash) & (CachedResult.model == model))
+        if cached is None:
+            return None
+
+        CachedResult.update(last_used=clock.now(), hits=CachedResult.hits + 1).where(
+            CachedResult.id == cached.id).execute()
+        return ClassificationResult(cached.inference_class, cached.inference_accuracy, 0, cached.exif_datetime,
+                                    cached.inference_class_id, cached.inference_scores, model)
+
+    def insert_cached_result(self, content_hash: str, model: str, result: ClassificationResult, max_entries: int):
+        with self._db.atomic():
+            CachedResult.replace(
+                content_hash=content_hash,
+                model=model,
+                inference_class=result.name,
+                inference_class_id=result.class_id,
+                inference_accuracy=result.accuracy,
+                inference_scores=result.scores,
+                exif_datetime=result.exif_datetime,
+                last_used=clock.now(),
+            ).execute()
+
+            # Evict the least recently used results
+            excess = CachedResult.select(fn.Count()).scalar() - max_entries
+            if excess > 0:
+                oldest = CachedResult.select(CachedResult.id).order_by(CachedResult.last_used).limit(excess)
+                CachedResult.delete().where(CachedResult.id.in_(oldest)).execute()
+
+    def insert_shadow_result(self, photo_id: int, baseline: ClassificationResult, result: ClassificationResult,
+                             keep_rows: int = 20000):
+        shadow = ShadowResult.create(
+            photo_id=photo_id,
+            datetime=clock.now(),
+            model=result.model,
+            baseline=baseline.model,
+            class_id=result.class_id,
+            baseline_class_id=baseline.class_id,
+            agree=result.class_id == baseline.class_id,
+            accuracy=result.accuracy,
+            time=result.time,
+            baseline_time=baseline.time,
+        )
+        ShadowResult.delete().where(ShadowResult.id <= shadow.id - keep_rows).execute()
+
+    def get_shadow_stats(self) -> List[dict]:
+        """Per candidate and baseline model: photos compared, agreement rate and mean inference times"""
+        return list(ShadowResult.select(
+            ShadowResult.model, ShadowResult.baseline,
+            fn.COUNT(ShadowResult.id).alias("photos"),
+            fn.AVG(ShadowResult.agree).alias("agreement"),
+            fn.AVG(ShadowResult.time).alias("time"),
+            fn.AVG(ShadowResult.baseline_time).alias("baseline_time"),
+        ).group_by(ShadowResult.model, ShadowResult.baseline).dicts())
+
+    def get_model_stats(self) -> List[dict]:
+        """Per model that classified photos: photos and mean inference time, cached results left out"""
+        return list(Photo.select(
+            Photo.inference_model.alias("model"),
+            fn.COUNT(Photo.id).alias("photos"),
+            fn.AVG(Photo.inference_time).alias("time"),
+        ).where(Photo.inference_model.is_null(False) & (Photo.inference_time > 0))
+            .group_by(Photo.inference_model).dicts())
+
     def update_photo_inference_error(self, photo_id: int, exception: Exception, attempt: int,
                                      status: Photo.Status) -> int:
         return Photo.update(
@@ -106,3 +446,53 @@ class Repository:
         return Photo.update(
             status=Photo.Status.SYNCED,
         ).where(Photo.id == photo_id).execute()
+
+    def update_photos_synced(self, photo_ids: List[int]):
+        self.update_photos_status(photo_ids, Photo.Status.SYNCED)
+
+    def insert_cycle_metrics(self, started: dt, version: int, stages: List[StageTimer], keep_cycles: int = 500):
+        with self._db.atomic():
+            cycle = Cycle.create(started=started, version=version)
+            StageMetric.insert_many([dict(
+                cycle=cycle.id,
+                name=s.name,
+                wall_ms=s.wall_ms,
+                cpu_ms=s.cpu_ms,
+                peak_rss_kb=s.peak_rss_kb,
+                items=s.items,
+                bytes=s.bytes,
+            ) for s in stages]).execute()
+
+            # Keep a ring buffer of the most recent cycles
+            oldest = cycle.id - keep_cycles
+            StageMetric.delete().where(StageMetric.cycle <= oldest).execute()
+            Cycle.delete().where(Cycle.id <= oldest).execute()
+
+    def get_stage_metrics(self, cycles: int) -> List[dict]:
+        oldest = (Cycle.select(fn.MAX(Cycle.id)).scalar() or 0) - cycles
+        return list(StageMetric.select().where(StageMetric.cycle > oldest).order_by(StageMetric.id).dicts())
+
+    def get_last_stage_metric(self, name: str) -> Optional[dict]:
+        """Wall time, items and bytes of the stage in the last cycle it ran, added up over its rows (one per
+        camera for listing and download)"""
+        last = StageMetric.select(fn.MAX(StageMetric.cycle)).where(StageMetric.name == name).scalar()
+        if last is None:
+            return None
+        return StageMetric.select(
+            fn.SUM(StageMetric.wall_ms).alias("wall_ms"),
+            fn.SUM(StageMetric.items).alias("items"),
+            fn.SUM(StageMetric.bytes).alias("bytes"),
+        ).where((StageMetric.cycle == last) & (StageMetric.name == name)).dicts().get()
+
+    def get_backlog_count(self) -> int:
+        return Photo.select(fn.Count()).where(
+            Photo.status.in_([Photo.Status.TODO, Photo.Status.INFERENCE_SUCCESS])).scalar()
+
+    def insert_pmp_reading(self, datetime: dt, values: dict):
+        columns = set(PmpHistory._meta.fields) - {"id", "datetime", "extra"}
+        extra = {k: v for k, v in values.items() if k not in columns}
+        PmpHistory.create(
+            datetime=datetime,
+            extra=json.dumps(extra) if extra else None,
+            **{k: v for k, v in values.items() if k in columns},
+        )
@@ -0,0 +1,164 @@
+import configparser
+import logging
+import os
+from pathlib import Path
+from typing import List, Tuple
+
+from config import Config
+
+log = logging.getLogger(__name__)
+
+
+class DownlinkException(Exception):
+    pass
+
+
+# Remote reconfiguration received as mobile terminated (MT) SBD message
+#
+# Message layout: version (1) followed by any number of commands, each an opcode (1) and its arguments:
+#   0x01 max per day     - count (2, little endian), 0 disables the limit
+#   0x02 class weight    - class id (1) | weight in tenths (1)
+#   0x03 model           - name length (1) | ascii name of a model in [Models], or of <name>.tflite/<name>.txt
+#                          next to the active model
+#   0x04 wake interval   - minutes (2, little endian)
+#   0xFF reset           - drops every override received so far
+class DownlinkCommand:
+    VERSION = 1
+
+    SET_MAX_PER_DAY = 0x01
+    SET_CLASS_WEIGHT = 0x02
+    SET_MODEL = 0x03
+    SET_WAKE_INTERVAL = 0x04
+    RESET = 0xFF
+
+    def __init__(self, opcode: int, args: tuple):
+        self.opcode = opcode
+        self.args = args
+
+    def __str__(self):
+        return f"0x{self.opcode:02x} {self.args}"
+
+    @classmethod
+    def decode(cls, msg: bytes) -> List['DownlinkCommand']:
+        if len(msg) == 0 or msg[0] != cls.VERSION:
+            raise DownlinkException(f"Unsupported downlink message {msg.hex()}")
+
+        commands = []
+        i = 1
+        while i < len(msg):
+            opcode = msg[i]
+            i += 1
+
+            if opcode == cls.SET_MAX_PER_DAY or opcode == cls.SET_WAKE_INTERVAL:
+                args = (int.from_bytes(cls.__take(msg, i, 2), byteorder='little'),)
+                i += 2
+            elif opcode == cls.SET_CLASS_WEIGHT:
+                class_id, weight = cls.__take(msg, i, 2)
+                args = (class_id, weight / 10)
+                i += 2
+            elif opcode == cls.SET_MODEL:
+                length = cls.__take(msg, i, 1)[0]
+                args = (cls.__take(msg, i + 1, length).decode('ascii'),)
+                i += 1 + length
+            elif opcode == cls.RESET:
+                args = ()
+            else:
+                raise DownlinkException(f"Unknown downlink opcode 0x{opcode:02x}")
+
+            commands.append(cls(opcode, args))
+
+        return commands
+
+    @staticmethod
+    def __take(msg: bytes, start: int, length: int) -> bytes:
+        if start + length > len(msg):
+            raise DownlinkException(f"Downlink message truncated {msg.hex()}")
+        return msg[start:start + length]
+
+
+# Persists downlink commands as config overrides, Config reads them on top of config.ini at startup
+class DownlinkStore:
+    def __init__(self, config: Config):
+        self._config = config
+
+    def handle_message(self, msg: bytes):
+        try:
+            commands = DownlinkCommand.decode(msg)
+        except DownlinkException as e:
+            log.warning("Ignoring downlink message %s", e)
+            return
+
+        overrides = configparser.ConfigParser()
+        overrides.read(self._config.downlink_file)
+
+        for command in commands:
+            try:
+                self.__apply(overrides, command)
+                log.debug("Applied downlink command %s", command)
+            except DownlinkException as e:
+                log.warning("Ignoring downlink command %s: %s", command, e)
+
+        self.__write(overrides)
+
+    def __apply(self, overrides: configparser.ConfigParser, command: DownlinkCommand):
+        if command.opcode == DownlinkCommand.SET_MAX_PER_DAY:
+            self.__set(overrides, "SDCard", "MaxPerDay", str(command.args[0]))
+        elif command.opcode == DownlinkCommand.SET_CLASS_WEIGHT:
+            class_id, weight = command.args
+            name = self.__class_name(class_id)
+            self.__set(overrides, "Mapping", name, f"{class_id}, {weight}")
+        elif command.opcode == DownlinkCommand.SET_MODEL:
+            name = command.args[0]
+            if name in self._config.models:
+                # Promotes a registered model, or rolls back to one
+                self.__check_labels(self._config.models[name].labels)
+                self.__set(overrides, "Classify", "Model", name)
+            else:
+                model, labels = self.__model_files(name)
+                self.__check_labels(labels)
+                self.__set(overrides, "TensorFlowLite", "Model", str(model))
+                self.__set(overrides, "TensorFlowLite", "Labels", str(labels))
+                self.__set(overrides, "Classify", "Model", "")
+        elif command.opcode == DownlinkCommand.SET_WAKE_INTERVAL:
+            self.__set(overrides, "PMP", "WakeInterval", str(command.args[0]))
+        elif command.opcode == DownlinkCommand.RESET:
+            for section in overrides.sections():
+                overrides.remove_section(section)
+
+    def __class_name(self, class_id: int) -> str:
+        for name, value in self._config.mapping.items():
+            if value == class_id:
+                return name
+        raise DownlinkException(f"No mapping for class id {class_id}")
+
+    def __model_files(self, name: str) -> Tuple[Path, Path]:
+        # Only allow switching between models that are already installed
+        directory = Path(self._config.model.model).parent
+        model = directory / f"{Path(name).name}.tflite"
+        labels = directory / f"{Path(name).name}.txt"
+
+        if not model.is_file() or not labels.is_file():
+            raise DownlinkException(f"Model {model} or labels {labels} not installed")
+
+        return model, labels
+
+    def __check_labels(self, labels_file):
+        # A model whose labels do not load would be set on every later cycle
+        from labels import LabelRegistry
+
+        try:
+            LabelRegistry.load(labels_file, self._config.mapping)
+        except Exception as e:
+            raise DownlinkException(f"Labels {labels_file} do not match [Mapping]: {e}")
+
+    @staticmethod
+    def __set(overrides: configparser.ConfigParser, section: str, key: str, value: str):
+        if not overrides.has_section(section):
+            overrides.add_section(section)
+        overrides.set(section, key, value)
+
+    def __write(self, overrides: configparser.ConfigParser):
+        tmp_file = f"{self._config.downlink_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            overrides.write(f)
+        os.replace(tmp_file, self._config.downlink_file)
@@ -1,43 +1,99 @@
 from datetime import datetime
-from typing import List, Tuple, Mapping
+from typing import List, Tuple, Mapping, Optional, TYPE_CHECKING
 
 from database import Photo
+from health import HealthRecord
+
+if TYPE_CHECKING:
+    import numpy as np
 
 KEEP_ALIVE = "alive"
 
 # Encodes image classifications 
+#
+# Payload layout (little endian):
+#   message type (1) | message version (1)
+#   health record (HealthRecord.SIZE), only for MESSAGE_TYPE_IMAGE_CLASSIFICATION_HEALTH
+#   aggregate count (1)
+#   aggregate count x [class id (1) | photo count (2)]
+#   image x [seconds since SAT_EPOCH (4) | class id (1) | accuracy 0..255 (1)]
+#   message version 2 appends a camera index (1) to every image, used when more than one camera is configured
 class SatelliteEncoder:
     SAT_EPOCH = datetime(2010, 1, 1, 0, 0, 0)
     MESSAGE_TYPE_IMAGE_CLASSIFICATION = (1).to_bytes(1, byteorder='little')
+    MESSAGE_TYPE_IMAGE_CLASSIFICATION_HEALTH = (2).to_bytes(1, byteorder='little')
     MESSAGE_VERSION = (1).to_bytes(1, byteorder='little')
+    MESSAGE_VERSION_CAMERAS = (2).to_bytes(1, byteorder='little')
     BYTES_PER_IMAGE = 6
+    BYTES_PER_AGGREGATE = 3
+    MAX_PAYLOAD = 340
+    UNKNOWN_CLASS = 0
+
+    IMAGE_FIELDS = [('seconds', '<u4'), ('class_id', 'u1'), ('accuracy', 'u1')]
+    IMAGE_FIELDS_CAMERAS = IMAGE_FIELDS + [('camera', 'u1')]
 
-    def __init__(self, class_mapping: Mapping[str, int], pmp_data: dict, version: int):
-        # Convert keys to lower case to make mapping case insensitive
-        self._class_mapping = dict((k.lower(), v) for k, v in class_mapping.items())
-    
+    def __init__(self, pmp_data: dict, version: int, health: Optional[HealthRecord] = None,
+                 camera_ids: List[str] = ()):
         self._pmp_data = pmp_data
         self._version = version
         self._activation = str(self._pmp_data.get("activation", "unknown")).lower()
+        self._health = health
+        self._camera_indexes = {camera_id: i for i, camera_id in enumerate(camera_ids)} if len(camera_ids) > 1 else {}
+        self._message_version = self.MESSAGE_VERSION_CAMERAS if self._camera_indexes else self.MESSAGE_VERSION
 
-    def encode_images(self, images: List[Photo]) -> Tuple[bytearray, List[Photo]]:
+    def encode_images(self, images: List[Photo], aggregates: Mapping[int, int] = None) \
+            -> Tuple[bytearray, List[Photo], List[int]]:
         payload = bytearray()
-        # TODO Encode information into byte array in a format you want to read it in the backend
+        if self._health is None:
+            payload.extend(self.MESSAGE_TYPE_IMAGE_CLASSIFICATION)
+            payload.extend(self._message_version)
+        else:
+            payload.extend(self.MESSAGE_TYPE_IMAGE_CLASSIFICATION_HEALTH)
+            payload.extend(self._message_version)
+            payload.extend(self._health.encode())
 
-        images_to_send = []
+        aggregate_count_index = len(payload)
+        payload.append(0)
 
-        for image in images:
-            append = self.encode_image(image)
+        aggregates_to_send = []
 
-            if len(payload) + len(append) > 340:
+        for class_id, count in (aggregates or {}).items():
+            if len(payload) + self.BYTES_PER_AGGREGATE > self.MAX_PAYLOAD or len(aggregates_to_send) == 255:
                 break
-            else:
-                payload.extend(append)
-                images_to_send.append(image)
+            payload.extend(self.encode_aggregate(class_id, count))
+            aggregates_to_send.append(class_id)
+
+        payload[aggregate_count_index] = len(aggregates_to_send)
+
+        # Every image has the same size, so the number that fits is known before encoding
+        bytes_per_image = self.BYTES_PER_IMAGE + (1 if self._camera_indexes else 0)
+        images_to_send = images[:max(0, (self.MAX_PAYLOAD - len(payload)) // bytes_per_image)]
+        payload.extend(self.encode_image_array(images_to_send).tobytes())
+
+        return payload, images_to_send, aggregates_to_send
 
-        return payload, images_to_send
+    def encode_aggregate(self, class_id: int, count: int) -> bytes:
+        return bytes([class_id]) + min(count, 0xFFFF).to_bytes(2, byteorder='little')
+
+    def encode_image_array(self, images: List[Photo]) -> 'np.ndarray':
+        import numpy as np
+
+        encoded = np.zeros(len(images), dtype=self.IMAGE_FIELDS_CAMERAS if self._camera_indexes else self.IMAGE_FIELDS)
+        if not images:
+            return encoded
+
+        epoch = np.datetime64(self.SAT_EPOCH, 's')
+        taken = np.array([image.exif_datetime or image.datetime for image in images], dtype='datetime64[s]')
+        seconds = (taken - epoch).astype(np.int64)
+        accuracy = np.array([image.inference_accuracy or 0 for image in images], dtype=np.float64)
+        class_ids = np.array([image.inference_class_id for image in images], dtype=object)
+
+        encoded['seconds'] = np.clip(seconds, 0, 0xFFFFFFFF)
+        encoded['class_id'] = np.where(class_ids == None, self.UNKNOWN_CLASS, class_ids).astype(np.uint8)
+        encoded['accuracy'] = np.clip(np.round(accuracy * 255), 0, 255)
+        if self._camera_indexes:
+            encoded['camera'] = [self._camera_indexes.get(image.camera_id, 0xFF) for image in images]
+        return encoded
 
     def encode_image(self, image: Photo) -> bytes:
-        payload = bytearray()
-        # TODO Encode image information into byte array in a format you want to read it in the backend
-        return payload
+        return self.encode_image_array([image]).tobytes()
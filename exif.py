@@ -0,0 +1,127 @@
+import struct
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Optional
+
+# Reads DateTimeOriginal and the embedded thumbnail from the APP1 segment at the start of a JPEG,
+# so metadata is known from a few KB of the file instead of decoding (or downloading) the whole image.
+
+# Enough for the IFDs of common cameras, the thumbnail may need up to the end of the APP1 segment
+HEADER_BYTES = 16 * 1024
+MAX_HEADER_BYTES = 128 * 1024
+
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_THUMBNAIL_OFFSET = 0x0201
+TAG_THUMBNAIL_LENGTH = 0x0202
+
+
+class ExifHeader:
+    def __init__(self, datetime_original: Optional[datetime] = None, thumbnail: Optional[bytes] = None):
+        self.datetime_original = datetime_original
+        self.thumbnail = thumbnail
+
+    def __str__(self):
+        return f"{self.datetime_original} thumbnail {len(self.thumbnail) if self.thumbnail else 0} bytes"
+
+
+def find_app1(data: bytes) -> Optional[tuple]:
+    """Returns (start, end) of the TIFF data in the Exif APP1 segment, end may lie beyond data"""
+    if data[:2] != b'\xff\xd8':
+        return None
+
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # Fill byte
+            pos += 1
+            continue
+        if marker == 0xDA:  # Start of scan, no metadata follows
+            return None
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        if marker == 0xE1 and data[pos + 4:pos + 10] == b'Exif\x00\x00':
+            return pos + 10, pos + 2 + length
+        pos += 2 + length
+    return None
+
+
+def parse(data: bytes) -> Optional[ExifHeader]:
+    """Parses the start of a JPEG, values outside of a truncated header are None"""
+    app1 = find_app1(data)
+    if app1 is None:
+        return None
+
+    tiff = data[app1[0]:app1[1]]
+    header = ExifHeader()
+    try:
+        order = {b'II': '<', b'MM': '>'}[tiff[:2]]
+        ifd0 = struct.unpack(order + 'I', tiff[4:8])[0]
+
+        entries, ifd1 = _read_ifd(tiff, order, ifd0)
+        if TAG_EXIF_IFD in entries:
+            exif_entries, _ = _read_ifd(tiff, order, _value(tiff, order, entries[TAG_EXIF_IFD]))
+            if TAG_DATETIME_ORIGINAL in exif_entries:
+                header.datetime_original = _datetime(tiff, order, exif_entries[TAG_DATETIME_ORIGINAL])
+
+        if ifd1:
+            thumbnail_entries, _ = _read_ifd(tiff, order, ifd1)
+            if TAG_THUMBNAIL_OFFSET in thumbnail_entries and TAG_THUMBNAIL_LENGTH in thumbnail_entries:
+                offset = _value(tiff, order, thumbnail_entries[TAG_THUMBNAIL_OFFSET])
+                length = _value(tiff, order, thumbnail_entries[TAG_THUMBNAIL_LENGTH])
+                if offset + length <= len(tiff):
+                    header.thumbnail = bytes(tiff[offset:offset + length])
+    except (KeyError, IndexError, ValueError, struct.error):
+        pass
+
+    return header
+
+
+def read(read_prefix: Callable[[int], bytes], thumbnail: bool = False) -> Optional[ExifHeader]:
+    """Reads the header through read_prefix(length), which returns the first length bytes of the file"""
+    data = read_prefix(HEADER_BYTES)
+    app1 = find_app1(data)
+    if app1 is None:
+        return None
+
+    if thumbnail and len(data) < app1[1] <= MAX_HEADER_BYTES:
+        data = read_prefix(app1[1])
+
+    return parse(data)
+
+
+def read_file(path: Path, thumbnail: bool = False) -> Optional[ExifHeader]:
+    def read_prefix(length: int) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read(length)
+
+    return read(read_prefix, thumbnail)
+
+
+def _read_ifd(tiff: bytes, order: str, offset: int) -> tuple:
+    """Returns ({tag: (type, count, value or offset bytes)}, offset of the next IFD)"""
+    count = struct.unpack(order + 'H', tiff[offset:offset + 2])[0]
+    entries = {}
+    for i in range(count):
+        start = offset + 2 + i * 12
+        tag, type, values = struct.unpack(order + 'HHI', tiff[start:start + 8])
+        entries[tag] = (type, values, tiff[start + 8:start + 12])
+    end = offset + 2 + count * 12
+    next_ifd = struct.unpack(order + 'I', tiff[end:end + 4])[0] if end + 4 <= len(tiff) else 0
+    return entries, next_ifd
+
+
+def _value(tiff: bytes, order: str, entry: tuple) -> int:
+    type, _, raw = entry
+    # SHORT values are left aligned in the 4 value bytes
+    return struct.unpack(order + 'H', raw[:2])[0] if type == 3 else struct.unpack(order + 'I', raw)[0]
+
+
+def _datetime(tiff: bytes, order: str, entry: tuple) -> Optional[datetime]:
+    _, count, raw = entry
+    offset = struct.unpack(order + 'I', raw)[0]
+    text = tiff[offset:offset + count].split(b'\x00')[0].decode('ascii')
+    if len(text) < 19:
+        return None
+    return datetime.strptime(text[:19], '%Y:%m:%d %H:%M:%S')
@@ -0,0 +1,132 @@
+import logging
+from pathlib import Path
+from typing import Callable, Optional
+
+import clock
+from config import Config
+
+log = logging.getLogger(__name__)
+
+# Bits of get_throttled that are active now: frequency capped, throttled, soft temperature limit
+THROTTLED_NOW = 0x2 | 0x4 | 0x8
+
+
+class ThermalState:
+    """SoC temperature, clock and governor level an image was classified at, stored with its inference_time"""
+
+    def __init__(self, level: int, soc_temp: Optional[float], cpu_mhz: Optional[int], throttled: bool = False):
+        self.level = level
+        self.soc_temp = soc_temp
+        self.cpu_mhz = cpu_mhz
+        # Set when the firmware reported throttling or the clock was below its maximum
+        self.throttled = throttled
+
+    def __str__(self):
+        soc_temp = f"{self.soc_temp:.1f}C" if self.soc_temp is not None else "unknown"
+        cpu_mhz = f"{self.cpu_mhz}MHz" if self.cpu_mhz is not None else "unknown"
+        return f"level {self.level}, SoC {soc_temp} at {cpu_mhz}" + (", throttled" if self.throttled else "")
+
+
+# Keeps classification at a sustainable pace instead of running the SoC into its thermal limit, after which the
+# firmware throttles hard and throughput collapses for the rest of the cycle. Every batch of images the SoC
+# temperature and clock are read and the level goes up (slower) when the SoC is hot or throttled, and down again
+# below the temperature limit minus the hysteresis. A hot enclosure (PMP bridge_temp) starts one level up.
+class InferenceGovernor:
+    # (interpreter threads, fraction of the time spent classifying) per level
+    LEVELS = [(4, 1.0), (3, 1.0), (2, 0.8), (1, 0.6), (1, 0.4)]
+
+    THERMAL_ZONE = Path("/sys/class/thermal/thermal_zone0/temp")
+    CPU_FREQ = Path("/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq")
+    CPU_MAX_FREQ = Path("/sys/devices/system/cpu/cpu0/cpufreq/cpuinfo_max_freq")
+    GET_THROTTLED = Path("/sys/devices/platform/soc/soc:firmware/get_throttled")
+
+    def __init__(self, config: Config, set_threads: Callable[[int], None], pmp_data: Optional[dict] = None):
+        # Inferencer.set_threads of the models in use
+        self._set_threads = set_threads
+        self._soc_limit = config.governor_soc_temp
+        self._hysteresis = config.governor_hysteresis
+        self._batch = config.governor_batch
+        self._levels = [(min(threads, config.classify_threads), duty) for threads, duty in self.LEVELS]
+        self._max_mhz = self.__read_mhz(self.CPU_MAX_FREQ)
+
+        self._level = 0
+        bridge_temp = (pmp_data or {}).get("bridge_temp")
+        ambient_limit = config.governor_ambient_temp
+        if ambient_limit > 0 and bridge_temp is not None and bridge_temp >= ambient_limit:
+            log.info("Enclosure at %sC, starting inference at reduced speed", bridge_temp)
+            self._level = 1
+
+        self._busy = 0.0
+        self._count = 0
+        # Number of times the level went up and seconds idled, reported with the cycle metrics
+        self.events = 0
+        self.paused = 0.0
+        self.__apply()
+
+    @property
+    def batch(self) -> int:
+        """Images classified between two readings, fewer as the level goes up so it reacts sooner"""
+        return max(1, self._batch >> self._level)
+
+    def read(self) -> ThermalState:
+        temp = self.__read_int(self.THERMAL_ZONE)
+        mhz = self.__read_mhz(self.CPU_FREQ)
+        soc_temp = temp / 1000 if temp is not None else None
+        flags = self.__read_int(self.GET_THROTTLED, 16)
+        if flags is not None:
+            throttled = flags & THROTTLED_NOW != 0
+        else:
+            # Without the firmware flags a lower clock only counts near the limit, ondemand scaling lowers it too
+            throttled = mhz is not None and self._max_mhz is not None and mhz < self._max_mhz and \
+                        soc_temp is not None and soc_temp >= self._soc_limit - self._hysteresis
+        return ThermalState(self._level, soc_temp, mhz, throttled)
+
+    def step(self, busy: float, state: ThermalState, deadline: Optional[float] = None):
+        """Called after each inference that took busy seconds with the state read after it, regulates at the end
+        of every batch"""
+        self._busy += busy
+        self._count += 1
+        if self._count < self.batch:
+            return
+
+        previous = self._level
+        hot = state.soc_temp is not None and state.soc_temp >= self._soc_limit
+        if (hot or state.throttled) and self._level < len(self._levels) - 1:
+            self._level += 1
+            self.events += 1
+        elif not state.throttled and state.soc_temp is not None and \
+                state.soc_temp < self._soc_limit - self._hysteresis and self._level > 0:
+            self._level -= 1
+
+        if self._level != previous:
+            threads, duty = self._levels[self._level]
+            log.warning("Inference governor to level %s (%s thread(s), %.0f%% duty), %s",
+                        self._level, threads, duty * 100, state)
+            self.__apply()
+
+        # Idle in proportion to the time spent, so the SoC cools down in between
+        _, duty = self._levels[self._level]
+        pause = self._busy * (1 - duty) / duty
+        if deadline is not None:
+            pause = min(pause, max(0.0, deadline - clock.monotonic()))
+        if pause > 0:
+            clock.sleep(pause)
+            self.paused += pause
+
+        self._busy = 0.0
+        self._count = 0
+
+    def __apply(self):
+        threads, _ = self._levels[self._level]
+        self._set_threads(threads)
+
+    @staticmethod
+    def __read_int(path: Path, base: int = 10) -> Optional[int]:
+        try:
+            return int(path.read_text().strip(), base)
+        except (OSError, ValueError):
+            return None
+
+    def __read_mhz(self, path: Path) -> Optional[int]:
+        khz = self.__read_int(path)
+        return khz // 1000 if khz is not None else None
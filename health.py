@@ -0,0 +1,76 @@
+import logging
+import os
+from typing import Optional
+
+from database import Repository
+
+log = logging.getLogger(__name__)
+
+
+# Fixed size, bit-packed unit health summary sent in front of the classifications
+class HealthRecord:
+    # (name, bits, scale, offset), encoded = round((value - offset) * scale). All ones means unknown.
+    FIELDS = [
+        ("version", 12, 1, 0),
+        ("stm32_temp", 8, 2, -40),  # -40..87 C in 0.5 C steps
+        ("bridge_temp", 8, 2, -40),
+        ("bridge_hum", 7, 1, 0),  # %
+        ("bridge_hpa", 9, 1, 600),  # 600..1110 hPa
+        ("bridge_volt", 16, 1, 0),
+        ("cycle_seconds", 10, 0.5, 0),  # Previous cycle, in 2 second steps
+        ("download_kbps", 10, 1, 0),  # Previous download throughput
+        ("backlog", 12, 1, 0),  # Photos waiting for classification or upload
+        ("database_mb", 9, 1, 0),
+        ("keep_alive", 1, 1, 0),
+    ]
+    SIZE = (sum(f[1] for f in FIELDS) + 7) // 8
+
+    def __init__(self, **values):
+        self.values = values
+
+    @classmethod
+    def collect(cls, pmp_data: dict, version: int, repository: Repository, database_file: str,
+                keep_alive: bool) -> 'HealthRecord':
+        values = dict((k, pmp_data.get(k)) for k in ("stm32_temp", "bridge_temp", "bridge_hum", "bridge_hpa",
+                                                      "bridge_volt"))
+        values["version"] = version
+        values["keep_alive"] = int(keep_alive)
+
+        try:
+            cycle = repository.get_last_stage_metric("cycle")
+            download = repository.get_last_stage_metric("download")
+            values["cycle_seconds"] = cycle["wall_ms"] / 1000 if cycle is not None else None
+            values["download_kbps"] = download["bytes"] / download["wall_ms"] \
+                if download is not None and download["wall_ms"] > 0 else None
+            values["backlog"] = repository.get_backlog_count()
+            values["database_mb"] = os.path.getsize(database_file) / (1024 * 1024)
+        except Exception as e:
+            log.error("Error collecting health record %s", e)
+
+        return cls(**values)
+
+    @staticmethod
+    def _encode_field(value: Optional[float], bits: int, scale: float, offset: float) -> int:
+        unknown = (1 << bits) - 1
+        if value is None:
+            return unknown
+
+        try:
+            encoded = int(round((float(value) - offset) * scale))
+        except (TypeError, ValueError):
+            return unknown
+
+        # Clamp, keeping the all ones value for unknown
+        return min(max(encoded, 0), unknown - 1) if bits > 1 else min(max(encoded, 0), 1)
+
+    def encode(self) -> bytes:
+        packed = 0
+        total_bits = 0
+        for name, bits, scale, offset in self.FIELDS:
+            packed = (packed << bits) | self._encode_field(self.values.get(name), bits, scale, offset)
+            total_bits += bits
+
+        return (packed << (self.SIZE * 8 - total_bits)).to_bytes(self.SIZE, byteorder='big')
+
+    def __str__(self):
+        return str(self.values)
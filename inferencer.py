@@ -3,8 +3,14 @@ import datetime
 
 
 class ClassificationResult:
-    def __init__(self, _name: str, _accuracy: float, _time: int, _exif_datetime: datetime.datetime = None):
+    def __init__(self, _name: str, _accuracy: float, _time: int, _exif_datetime: datetime.datetime = None,
+                 _class_id: int = None, _scores: bytes = None, _model: str = None):
         self.name = _name
+        # ModelConfig.key of the model that produced the result
+        self.model = _model
+        self.class_id = _class_id
+        # Packed top-k scores, see labels.pack_scores
+        self.scores = _scores
         self.accuracy = _accuracy
         self.time = _time
         self.exif_datetime = _exif_datetime
@@ -16,3 +22,7 @@ class ClassificationResult:
 class Inferencer:
     def infer(self, local_file: Path) -> ClassificationResult:
         pass
+
+    def set_threads(self, threads: int):
+        """Number of threads the next inferences may use, see InferenceGovernor"""
+        pass
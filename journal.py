@@ -0,0 +1,64 @@
+import logging
+import os
+from pathlib import Path
+
+from config import Config
+from database import Photo, Repository
+
+log = logging.getLogger(__name__)
+
+
+# Resumes the work of a cycle that was killed, based on the checkpoints the stages write to the Photo status:
+# - DOWNLOADING: complete files continue to classification, partial ones are removed to be downloaded again
+# - UPLOADING: back to INFERENCE_SUCCESS, the payload may not have left the modem (delivery is at least once)
+# - files in the download folder that are no longer needed are removed
+class Journal:
+    def __init__(self, config: Config, repository: Repository):
+        self._config = config
+        self._repository = repository
+
+    def reconcile(self):
+        resumed, dropped = self.reconcile_downloads()
+        uploads = self.reconcile_uploads()
+        removed = self.reconcile_files()
+
+        if resumed or dropped or uploads or removed:
+            log.info("Reconciled interrupted cycle: %s download(s) resumed, %s partial download(s) dropped, "
+                     "%s upload(s) requeued, %s orphaned file(s) removed", resumed, dropped, uploads, removed)
+
+    def reconcile_downloads(self):
+        resumed = 0
+        dropped = 0
+        for photo in self._repository.iter_photos_by_status(Photo.Status.DOWNLOADING):
+            local_file = Path(photo.local_file)
+            if local_file.is_file() and local_file.stat().st_size == photo.size:
+                self._repository.update_photo_status(photo.id, Photo.Status.TODO)
+                resumed += 1
+            else:
+                if local_file.is_file():
+                    local_file.unlink()
+                # The next sync finds it on the card again
+                self._repository.delete_photo(photo.id)
+                dropped += 1
+
+        return resumed, dropped
+
+    def reconcile_uploads(self) -> int:
+        photo_ids = [photo.id for photo in self._repository.iter_photos_by_status(Photo.Status.UPLOADING)]
+        self._repository.update_photos_status(photo_ids, Photo.Status.INFERENCE_SUCCESS)
+        return len(photo_ids)
+
+    def reconcile_files(self) -> int:
+        local_files = []
+        for directory, _, filenames in os.walk(self._config.sd_download_directory):
+            local_files.extend(str(Path(directory, filename).resolve()) for filename in filenames)
+
+        # Only photos waiting for classification still need their file, files without any photo are adopted by
+        # the next sync without downloading them again
+        removed = 0
+        for local_file, statuses in self._repository.get_statuses_by_local_file(local_files).items():
+            if Photo.Status.TODO not in statuses and Photo.Status.DOWNLOADING not in statuses:
+                os.remove(local_file)
+                removed += 1
+
+        return removed
@@ -0,0 +1,75 @@
+from typing import List, Mapping
+
+import numpy as np
+
+
+class LabelException(Exception):
+    pass
+
+
+# Maps model output indexes straight to the class ids of [Mapping], so classification results and
+# the satellite payload use the same small integers without looking up label strings per photo.
+class LabelRegistry:
+    UNKNOWN_CLASS = 0
+
+    def __init__(self, labels: List[str], mapping: Mapping[str, int]):
+        class_ids = dict((k.lower(), v) for k, v in mapping.items())
+
+        missing = [label for label in labels if label.lower() not in class_ids]
+        if missing:
+            raise LabelException(f"Model label(s) {', '.join(missing)} have no class id in [Mapping]")
+
+        self.labels = labels
+        # Model output index -> class id
+        self.class_ids = np.array([class_ids[label.lower()] for label in labels], dtype=np.uint8)
+        self._names = dict((v, k) for k, v in mapping.items())
+        for label in labels:
+            self._names[class_ids[label.lower()]] = label
+
+    @classmethod
+    def load(cls, labels_file, mapping: Mapping[str, int]) -> 'LabelRegistry':
+        with open(labels_file, 'r') as f:
+            labels = [line.strip() for line in f.readlines()]
+        # Indexes follow the model outputs, so only a trailing empty line is dropped
+        while labels and not labels[-1]:
+            labels.pop()
+        return cls(labels, mapping)
+
+    def name(self, class_id: int) -> str:
+        return self._names.get(class_id, str(class_id))
+
+    def __len__(self):
+        return len(self.labels)
+
+
+# Scores of a photo are packed as: format (1) | count (1) | count x [class id (1) | score 0..255 (1)]
+# sorted by descending score. Keeping every label stores the full output vector of the model.
+SCORES_FORMAT = 1
+
+
+def pack_scores(class_ids: 'np.ndarray', scores: 'np.ndarray') -> bytes:
+    order = np.argsort(-scores, kind='stable')
+    packed = np.empty((len(order), 2), dtype=np.uint8)
+    packed[:, 0] = class_ids[order]
+    packed[:, 1] = np.clip(np.round(scores[order] * 255), 0, 255)
+    return bytes([SCORES_FORMAT, len(order)]) + packed.tobytes()
+
+
+def unpack_scores(blobs: List[bytes]) -> 'np.ndarray':
+    """Returns a (photos x 256) matrix of scores 0..1 indexed by class id, NaN where a class was not kept"""
+    matrix = np.full((len(blobs), 256), np.nan, dtype=np.float32)
+
+    # Blobs of the same length decode as one array, normally that is all of them
+    by_length = {}
+    for row, blob in enumerate(blobs):
+        if blob and blob[0] == SCORES_FORMAT:
+            by_length.setdefault(len(blob), []).append(row)
+
+    for length, rows in by_length.items():
+        count = (length - 2) // 2
+        if count == 0:
+            continue
+        packed = np.frombuffer(b''.join(blobs[row] for row in rows), dtype=np.uint8).reshape(len(rows), length)
+        pairs = packed[:, 2:2 + count * 2].reshape(len(rows), count, 2)
+        matrix[np.array(rows)[:, None], pairs[:, :, 0]] = pairs[:, :, 1] / 255
+    return matrix
@@ -0,0 +1,117 @@
+import atexit
+import json
+import logging
+import os
+import sys
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from config import Config
+
+LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+
+_buffer: Optional['RingBufferHandler'] = None
+
+
+# Keeps the records of a cycle in memory and writes them as JSON lines in batches, so leaving debug
+# logging enabled does not mean a write to the SD card per line. The records are written at the end of
+# every stage and whenever half the buffer is used, the oldest are only dropped when writing fails.
+# The file is rotated in process when it grows beyond max_bytes.
+class RingBufferHandler(logging.Handler):
+    def __init__(self, path: str, capacity: int = 5000, max_bytes: int = 1024 * 1024, backup_count: int = 3):
+        super().__init__()
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._records = deque(maxlen=capacity)
+        self._flush_at = max(1, capacity // 2)
+        self._dropped = 0
+        self._write_lock = threading.Lock()
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            line = {"t": round(record.created, 3), "l": record.levelname[0], "m": record.name,
+                    "msg": record.getMessage()}
+            if record.exc_info:
+                line["exc"] = logging.Formatter().formatException(record.exc_info)
+            if len(self._records) == self._records.maxlen:
+                self._dropped += 1
+            self._records.append(line)
+            if len(self._records) >= self._flush_at:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        with self._write_lock:
+            lines = []
+            while self._records:
+                lines.append(json.dumps(self._records.popleft(), separators=(',', ':')))
+            if self._dropped:
+                lines.append(json.dumps({"l": "W", "m": __name__, "msg": f"{self._dropped} record(s) dropped"}))
+                self._dropped = 0
+            if not lines:
+                return
+
+            try:
+                with open(self._path, 'a') as f:
+                    f.write("\n".join(lines) + "\n")
+                if os.path.getsize(self._path) > self._max_bytes:
+                    self.rotate()
+            except OSError as e:
+                sys.stderr.write(f"Could not write log {self._path}: {e}\n")
+
+    def rotate(self):
+        for i in range(self._backup_count - 1, 0, -1):
+            if os.path.exists(f"{self._path}.{i}"):
+                os.replace(f"{self._path}.{i}", f"{self._path}.{i + 1}")
+        if self._backup_count > 0:
+            os.replace(self._path, f"{self._path}.1")
+        else:
+            os.remove(self._path)
+
+
+def level(value: str) -> str:
+    if value.upper() not in LEVELS:
+        raise ValueError(value)
+    return value.upper()
+
+
+def setup_console(console_level: str = "INFO"):
+    """Logging of main.py, the output goes to syslog through logger"""
+    logging.basicConfig(level=console_level, stream=sys.stdout, format="%(name)s: %(message)s")
+
+
+def setup(config: 'Config'):
+    """Logs records of config.log_level and up to the ring buffer, and those of the console level to stdout"""
+    global _buffer
+
+    root = logging.getLogger()
+    if not root.handlers:
+        setup_console()
+    for handler in list(root.handlers):
+        if isinstance(handler, RingBufferHandler):
+            root.removeHandler(handler)
+        else:
+            handler.setLevel(config.log_console_level)
+
+    _buffer = RingBufferHandler(config.log_file, config.log_buffer_size, config.log_max_kb * 1024,
+                                config.log_backup_count)
+    root.addHandler(_buffer)
+    atexit.register(_buffer.flush)
+
+    # Loggers drop records below their level before any formatting, that keeps disabled debug calls cheap
+    root.setLevel(config.log_level)
+    # Config keys are lower case, loggers are named after the modules
+    modules = dict((p.stem.lower(), p.stem) for p in Path(__file__).parent.glob("*.py"))
+    for name, module_level in config.log_levels.items():
+        logging.getLogger(modules.get(name, name)).setLevel(module_level)
+
+
+def flush():
+    """Writes the buffered records, at the end of each stage and of the cycle"""
+    if _buffer is not None:
+        _buffer.flush()
@@ -1,119 +1,275 @@
 #!/usr/bin/env python3
 import argparse
+import logging
 import re
-from time import sleep
 import os
+import signal
 import subprocess
+import threading
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
 from gpiozero import LED
 import serial
+import log_buffer
+from metrics import Metrics
+from pmp import PmpParser, PmpReading
+from reachability import Reachability
+
+log = logging.getLogger(__name__)
 
 warnings.simplefilter('ignore')
 
 
+class Watchdog:
+    """Interrupts the main thread and sets cancel when the timeout expires, the worker threads stop on cancel.
+    Calls on_hard_timeout if core does not stop in time."""
+
+    def __init__(self, timeout: int, on_hard_timeout: Callable[[], None], grace: int = 60,
+                 cancel: Optional[threading.Event] = None):
+        self._timers = [
+            threading.Timer(timeout, self._interrupt),
+            threading.Timer(timeout + grace, self._hard_timeout),
+        ]
+        self._on_hard_timeout = on_hard_timeout
+        self._cancel = cancel
+        self.expired = False
+
+    def __enter__(self):
+        for timer in self._timers:
+            timer.daemon = True
+            timer.start()
+        return self
+
+    def __exit__(self, *args):
+        for timer in self._timers:
+            timer.cancel()
+
+    def _interrupt(self):
+        log.warning("Watchdog expired, interrupting core")
+        self.expired = True
+        if self._cancel is not None:
+            self._cancel.set()
+        # A real signal also interrupts blocking system calls such as serial reads
+        os.kill(os.getpid(), signal.SIGINT)
+
+    def _hard_timeout(self):
+        log.warning("Core did not stop after watchdog expired")
+        try:
+            self._on_hard_timeout()
+        finally:
+            log_buffer.flush()
+            os._exit(1)
+
+
+class BootState:
+    """Readiness shared by the boot probes that run concurrently"""
+
+    def __init__(self):
+        self.pmp_detected: Optional[bool] = None
+        self.card_reachable: Optional[bool] = None
+        # Set when the cycle is aborted so the remaining probes stop early
+        self.aborted = threading.Event()
+
+    def __str__(self):
+        return f"PMP detected: {self.pmp_detected}, card reachable: {self.card_reachable}"
+
+
 class SmartCameraTrapMain:
     __HOST = "192.168.4.1"
-    __PMP_DATA_FILE = f"serial.log"
     __CORE_TIMEOUT = 20 * 60  # 20 minutes timeout
+    __CORE_GRACE = 30  # seconds core gets to write its log after SIGTERM
+    __REACHABLE_DEADLINE = 30
 
     __status_pin = LED(18)
 
+    def __init__(self, in_process: bool = False, profile: bool = False, record: Optional[str] = None):
+        self._profile = profile
+        self._record = record
+        self._metrics = Metrics(profiler=self.create_profiler())
+        self._in_process = in_process
+        self._pmp_reading: Optional[PmpReading] = None
+
+    def create_profiler(self):
+        # Only read for the profile settings here, core loads the config again
+        from config import Config
+        from profiler import StageProfiler
+
+        try:
+            config = Config.load("config.ini")
+        except Exception as e:
+            log.warning("Could not read config, boot stages are not profiled %s", e)
+            return None
+        if not (self._profile or config.profile_enabled):
+            return None
+
+        from core import SmartCameraTrap
+        return StageProfiler.create(config, SmartCameraTrap.read_version(), force=True)
+
     def run(self, skip_pmp: bool):
         self.set_status_pin(True)
         should_halt = not skip_pmp
-        
-        if not skip_pmp:
-            if not self.detect_pmp():
-                # If PMP not detected retry once more, otherwise RPi is booted without the PMP and then don't run the normal program.
-                if not self.detect_pmp():
-                    self.set_status_pin(False)
-                    print("PMP not detected aborting image processing")
-                    return
+        state = BootState()
+
+        # PMP detection and the card probe both mostly wait on I/O, run them side by side
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            card = executor.submit(self.probe_card, state)
+
+            if not skip_pmp and not self.probe_pmp(state):
+                state.aborted.set()
+                self.set_status_pin(False)
+                log.warning("PMP not detected aborting image processing")
+                return
+
+            reachable = card.result()
+
+        log.info("Boot probes finished %s", state)
 
         try:
-            reachable = self.is_reachable(self.__HOST)
             if reachable:
                 self.upgrade_if_needed()
-            self.run_core(reachable)
+            if self._in_process:
+                self.run_core_in_process(reachable, should_halt)
+            else:
+                self.run_core(reachable)
         except Exception as e:
-            print("Main error", e)
+            log.error("Main error %s", e)
         finally:
             self.set_status_pin(False)
+            if self._metrics.profiler is not None:
+                self._metrics.profiler.close()
 
         if should_halt:
             self.halt()
 
+    def probe_pmp(self, state: BootState) -> bool:
+        with self._metrics.stage("detect_pmp"):
+            detected = self.detect_pmp()
+            if not detected:
+                # If PMP not detected retry once more, otherwise RPi is booted without the PMP and then don't run the normal program.
+                detected = self.detect_pmp()
+
+        state.pmp_detected = detected
+        return detected
+
+    def probe_card(self, state: BootState) -> bool:
+        with self._metrics.stage("ping"):
+            reachable = Reachability().is_reachable(self.__HOST, deadline=self.__REACHABLE_DEADLINE,
+                                                    cancel=state.aborted)
+
+        state.card_reachable = reachable
+        return reachable
+
     def set_status_pin(self, on: bool):
         if on:
-            print("Raising status pin")
+            log.info("Raising status pin")
             self.__status_pin.on()
         else:
-            print("Lowering status pin")
+            log.info("Lowering status pin")
             self.__status_pin.off()
 
     def halt(self):
-        print("Shutting down the system")
+        log.info("Shutting down the system")
         subprocess.check_call(["halt"])
 
     def run_core(self, reachable: bool):
-        subprocess.check_call(["python3", "-u", "core.py", "--reachable", str(reachable)], timeout=self.__CORE_TIMEOUT)
+        pmp = self._pmp_reading.to_json() if self._pmp_reading is not None else "{}"
+        args = ["python3", "-u", "core.py", "--reachable", str(reachable),
+                "--metrics", self._metrics.to_json(),
+                "--origin", str(self._metrics.origin),
+                "--pmp", pmp]
+        if self._profile:
+            args.append("--profile")
+        if self._record is not None:
+            args.extend(["--record", self._record])
+        core = subprocess.Popen(args)
+        try:
+            core.wait(timeout=self.__CORE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            # SIGTERM first, core writes its buffered log before it exits
+            core.terminate()
+            try:
+                core.wait(timeout=self.__CORE_GRACE)
+            except subprocess.TimeoutExpired:
+                core.kill()
+                core.wait()
+            raise
+
+        if core.returncode != 0:
+            raise subprocess.CalledProcessError(core.returncode, args)
+
+    def run_core_in_process(self, reachable: bool, should_halt: bool):
+        from config import Config
+        from core import SmartCameraTrap
+
+        def on_hard_timeout():
+            self.set_status_pin(False)
+            if should_halt:
+                self.halt()
+
+        pmp_data = self._pmp_reading.values if self._pmp_reading is not None else {}
+        config = Config.load("config.ini")
+        recorder = None
+        if self._record is not None:
+            from cycle_trace import TraceRecorder
+            recorder = TraceRecorder.start(self._record, "config.ini", config, reachable, pmp_data)
+
+        core = SmartCameraTrap(config, reachable, self._metrics.stages, pmp_data, self._metrics.origin, self._profile,
+                               recorder.peripherals if recorder is not None else None)
+
+        with Watchdog(self.__CORE_TIMEOUT, on_hard_timeout, cancel=core.cancel) as watchdog:
+            try:
+                core.run()
+            except KeyboardInterrupt:
+                if not watchdog.expired:
+                    raise
+                raise TimeoutError(f"Core did not finish within {self.__CORE_TIMEOUT} seconds")
+            finally:
+                if recorder is not None:
+                    recorder.close(core.metrics.stages)
 
     def detect_pmp(self) -> bool:
-        print("Detecting PMP...")
+        log.info("Detecting PMP...")
         ser = None
 
-        if os.path.exists(self.__PMP_DATA_FILE):
-            os.remove(self.__PMP_DATA_FILE)
-
         try:
             ser = serial.Serial('/dev/ttyAMA0', baudrate=115200, stopbits=1, parity="N", timeout=10)
-            with open(self.__PMP_DATA_FILE, 'w') as pmp_data_file:
-                start_token_seen = False
-                while True:
-                    line = ser.readline().decode('ascii').strip()
-                    if len(line) == 0:  # When we reach the first timeout
-                        print("PMP not detected.")
-                        break
-
-                    if line == "START VALUES":
-                        start_token_seen = True
-                        continue
-
-                    if start_token_seen and line == "END VALUES":
-                        print("PMP detected")
-                        return True
-
-                    if start_token_seen:
-                        print("-> ", line)
-                        pmp_data_file.write(line)
-                        pmp_data_file.write('\n')
+            parser = PmpParser()
+            while True:
+                line = ser.readline().decode('ascii').strip()
+                if len(line) == 0:  # When we reach the first timeout
+                    log.warning("PMP not detected.")
+                    break
+
+                log.debug("-> %s", line)
+                reading = parser.feed(line)
+                if reading is None:
+                    continue
+
+                if reading.checksum_valid:
+                    log.info("PMP detected %s", reading)
+                    self._pmp_reading = reading
+                    return True
+
+                log.warning("PMP values checksum mismatch")
+                break
 
         except Exception as e:
-            print("Error detecting PMP", e)
+            log.error("Error detecting PMP %s", e)
         finally:
             if ser is not None:
                 ser.close()
 
         return False
 
-    def is_reachable(self, host: str, attempts: int = 30, delay: int = 1, verbose: bool = False):
-        print(f"Testing if {host} is reachable...")
-        for _ in range(attempts):
-            try:
-                if subprocess.call(['ping', '-c', '1', host], stdout=subprocess.STDOUT if verbose else subprocess.DEVNULL, stderr=subprocess.STDOUT if verbose else subprocess.DEVNULL, timeout=20) == 0:
-                    print(f"Host {host} reached.")
-                    return True
-            except Exception as e:
-                print("Error pinging", e)
-            sleep(delay)
-
-        print(f"Host {host} not reachable.")
-        return False
-
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Smart Camera Trap Main')
     parser.add_argument('--skip-pmp', help='skip PMP detection', action="store_true")
+    parser.add_argument('--in-process', help='run core in this process with a watchdog instead of a subprocess',
+                        action="store_true")
+    parser.add_argument('--profile', help='profile every stage, overrides [Profile] Enabled', action="store_true")
+    parser.add_argument('--record', help='record the cycle to a trace file for replay.py', default=None)
     args = parser.parse_args()
 
-    SmartCameraTrapMain().run(args.skip_pmp)
+    log_buffer.setup_console()
+    SmartCameraTrapMain(args.in_process, args.profile, args.record).run(args.skip_pmp)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import os
+import resource
+import time
+from contextlib import contextmanager
+from typing import List, Optional, Dict, TYPE_CHECKING
+
+import clock
+import log_buffer
+
+if TYPE_CHECKING:
+    from profiler import StageProfiler
+
+log = logging.getLogger(__name__)
+
+
+class StageTimer:
+    def __init__(self, name: str):
+        self.name = name
+        self.wall_ms = 0
+        # CPU time of the thread that ran the stage, of the whole process for a process wide stage
+        self.cpu_ms = 0
+        # Peak RSS of the process so far, memory is not accounted per stage
+        self.peak_rss_kb = 0
+        self.items = 0
+        self.bytes = 0
+
+    def throughput(self) -> Optional[float]:
+        """Bytes per second"""
+        return self.bytes * 1000 / self.wall_ms if self.bytes and self.wall_ms else None
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_dict(cls, values: dict) -> 'StageTimer':
+        timer = cls(values["name"])
+        timer.__dict__.update(values)
+        return timer
+
+    def __str__(self):
+        throughput = self.throughput()
+        return f"{self.name}: {self.wall_ms}ms wall, {self.cpu_ms}ms cpu, {self.peak_rss_kb}kB peak rss, " \
+               f"{self.items} item(s)" + (f", {throughput / 1024:.1f}kB/s" if throughput else "")
+
+
+def boot_clock() -> float:
+    """Seconds since the system booted, shared by every process"""
+    return time.clock_gettime(time.CLOCK_BOOTTIME)
+
+
+def process_start_time() -> Optional[float]:
+    """Boot clock time at which this process was started, so interpreter startup is included"""
+    try:
+        with open("/proc/self/stat") as f:
+            # starttime is the 22nd field, the 2nd field (comm) may contain spaces
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        return start_ticks / os.sysconf("SC_CLK_TCK")
+    except Exception as e:
+        log.warning("Could not get process start time %s", e)
+        return None
+
+
+# Collects wall time and CPU time per stage of a wake cycle, with the peak RSS of the process
+class Metrics:
+    def __init__(self, origin: Optional[float] = None, profiler: Optional['StageProfiler'] = None):
+        self.stages: List[StageTimer] = []
+        self.profiler = profiler
+        # Boot clock time the cold start is measured from
+        self.origin = origin if origin is not None else process_start_time()
+        self._marks = set()
+
+    def mark_once(self, name: str):
+        """Records the time since the cold start origin, only the first time it is called for a name"""
+        if name in self._marks or self.origin is None:
+            return
+
+        self._marks.add(name)
+        timer = StageTimer(name)
+        timer.wall_ms = int((boot_clock() - self.origin) * 1000)
+        timer.peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.stages.append(timer)
+        log.info("Cold start to %s: %.1fs", name, timer.wall_ms / 1000)
+
+    @contextmanager
+    def stage(self, name: str, process_wide: bool = False):
+        """Stages run on one thread while others run concurrently, so only their own thread's CPU time is counted.
+        A process wide stage spans the threads it starts and counts the CPU time of all threads."""
+        cpu_time = time.process_time if process_wide else time.thread_time
+        timer = StageTimer(name)
+        wall = clock.monotonic()
+        cpu = cpu_time()
+        try:
+            if self.profiler is not None:
+                with self.profiler.profile(name, process_wide):
+                    yield timer
+            else:
+                yield timer
+        finally:
+            timer.wall_ms = int((clock.monotonic() - wall) * 1000)
+            timer.cpu_ms = int((cpu_time() - cpu) * 1000)
+            timer.peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.stages.append(timer)
+            # What was logged so far survives the cycle being killed
+            log_buffer.flush()
+
+    def extend(self, stages: List[StageTimer]):
+        self.stages.extend(stages)
+
+    def to_json(self) -> str:
+        return json.dumps([s.to_dict() for s in self.stages])
+
+    @staticmethod
+    def from_json(value: str) -> List[StageTimer]:
+        return [StageTimer.from_dict(s) for s in json.loads(value)]
+
+    def print_summary(self):
+        for stage in self.stages:
+            log.info(" - %s", stage)
+
+
+def totals(stages: List[dict]) -> Dict[str, dict]:
+    """Stages by name, those that ran more than once in a cycle (listing and download per camera) added up"""
+    by_name = {}
+    for s in stages:
+        total = by_name.setdefault(s["name"], {"wall_ms": 0, "cpu_ms": 0, "items": 0, "bytes": 0, "peak_rss_kb": 0})
+        for key in ("wall_ms", "cpu_ms", "items", "bytes"):
+            total[key] += s[key]
+        total["peak_rss_kb"] = max(total["peak_rss_kb"], s["peak_rss_kb"])
+    return by_name
+
+
+def summarize(rows: List[dict], cycles: int):
+    rows_by_cycle: Dict[int, List[dict]] = {}
+    for row in rows:
+        rows_by_cycle.setdefault(row["cycle"], []).append(row)
+    by_cycle = dict((cycle_id, totals(stages)) for cycle_id, stages in rows_by_cycle.items())
+
+    cycle_ids = sorted(by_cycle)[-cycles:]
+    names = []
+    for cycle_id in cycle_ids:
+        for name in by_cycle[cycle_id]:
+            if name not in names:
+                names.append(name)
+
+    print("cycle".ljust(8) + "".join(n[:14].rjust(15) for n in names))
+    for cycle_id in cycle_ids:
+        stages = by_cycle[cycle_id]
+        print(str(cycle_id).ljust(8) + "".join(
+            (f"{stages[n]['wall_ms'] / 1000:.1f}s" if n in stages else "-").rjust(15) for n in names))
+
+    print()
+    print("stage".ljust(16) + "mean".rjust(10) + "max".rjust(10) + "per item".rjust(10) + "cpu".rjust(8) +
+          "kB/s".rjust(8) + "trend".rjust(8))
+    for name in names:
+        stages = [by_cycle[c][name] for c in cycle_ids if name in by_cycle[c]]
+        walls = [s["wall_ms"] for s in stages]
+        items = sum(s["items"] for s in stages)
+        transferred = sum(s["bytes"] for s in stages)
+        mean = sum(walls) / len(walls)
+        cpu = sum(s["cpu_ms"] for s in stages) / max(1, sum(walls))
+
+        # Compare the most recent half of the cycles with the older half
+        half = len(walls) // 2
+        trend = "-"
+        if half > 0 and sum(walls[:half]) > 0:
+            trend = f"{(sum(walls[-half:]) / sum(walls[:half]) - 1) * 100:+.0f}%"
+
+        print(name[:15].ljust(16) +
+              f"{mean / 1000:.1f}s".rjust(10) +
+              f"{max(walls) / 1000:.1f}s".rjust(10) +
+              (f"{sum(walls) / items / 1000:.2f}s" if items else "-").rjust(10) +
+              f"{cpu * 100:.0f}%".rjust(8) +
+              (f"{transferred / sum(walls):.0f}" if transferred and sum(walls) else "-").rjust(8) +
+              trend.rjust(8))
+
+    peaks = [by_cycle[c][n]["peak_rss_kb"] for c in cycle_ids for n in by_cycle[c]]
+    if peaks:
+        print()
+        print(f"Peak RSS of the process {max(peaks) // 1024}MB")
+
+
+if __name__ == '__main__':
+    from peewee import SqliteDatabase
+    from config import Config
+    from database import Repository
+
+    parser = argparse.ArgumentParser(description='Summarise wake cycle metrics')
+    parser.add_argument('--config', help='configuration file', default="config.ini")
+    parser.add_argument('--cycles', help='number of recent cycles to summarise', type=int, default=20)
+    args = parser.parse_args()
+
+    config = Config.load(args.config)
+
+    summarize(Repository(SqliteDatabase(config.database_file)).get_stage_metrics(args.cycles), args.cycles)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import logging
+from pathlib import Path
+from typing import Dict, Optional
+
+from config import Config, ModelConfig
+from database import Repository
+from inferencer import ClassificationResult, Inferencer
+from labels import LabelRegistry
+
+log = logging.getLogger(__name__)
+
+
+# The models of [Models] and [TensorFlowLite], each with its own labels. A model is only loaded when it is
+# first used, so a shadow model costs nothing in the cycles where no photo is sampled for it.
+class ModelRegistry:
+    def __init__(self, config: Config):
+        self._config = config
+        self._labels: Dict[str, LabelRegistry] = {}
+        self._inferencers: Dict[str, Inferencer] = {}
+        self._threads = config.classify_threads
+
+    def labels(self, model: ModelConfig) -> LabelRegistry:
+        """Fails when a label of the model has no class id in [Mapping]"""
+        if model.key not in self._labels:
+            self._labels[model.key] = LabelRegistry.load(model.labels, self._config.mapping)
+        return self._labels[model.key]
+
+    def inferencer(self, model: ModelConfig) -> Inferencer:
+        if model.key not in self._inferencers:
+            from tensorflow_inferencer import TensorFlowLiteInferencer
+            inferencer = TensorFlowLiteInferencer(self._config, self.labels(model), model)
+            inferencer.set_threads(self._threads)
+            self._inferencers[model.key] = inferencer
+        return self._inferencers[model.key]
+
+    def set_threads(self, threads: int):
+        """Applies to the models loaded so far and those loaded later, see InferenceGovernor"""
+        self._threads = threads
+        for inferencer in self._inferencers.values():
+            inferencer.set_threads(threads)
+
+
+# Runs a candidate model on a sample of the photos next to the active one and stores both results, so
+# agreement and latency are known before the candidate is promoted with [Classify] Model.
+class ShadowEvaluator:
+    # Failures after which the candidate is left alone for the rest of the cycle
+    MAX_FAILURES = 3
+
+    def __init__(self, repository: Repository, registry: ModelRegistry, model: ModelConfig, fraction: float):
+        self._repository = repository
+        self._registry = registry
+        self._model = model
+        self._fraction = fraction
+        self._failures = 0
+
+    def sampled(self, photo_id: int) -> bool:
+        """The same photos are sampled on every run, so replays and retries compare alike"""
+        if self._failures >= self.MAX_FAILURES:
+            return False
+        # Knuth's multiplicative hash spreads consecutive ids evenly
+        return (photo_id * 2654435761) % 2 ** 32 < self._fraction * 2 ** 32
+
+    def evaluate(self, photo_id: int, local_file: Path,
+                 baseline: ClassificationResult) -> Optional[ClassificationResult]:
+        try:
+            result = self._registry.inferencer(self._model).infer(local_file)
+            self._repository.insert_shadow_result(photo_id, baseline, result)
+        except Exception as e:
+            # The active result stands, a broken candidate only loses its evaluation
+            self._failures += 1
+            log.error("Error classifying %s with shadow model %s %s", local_file, self._model, e)
+            return None
+
+        log.debug("Shadow classification: %s with accuracy %s in %sms, active %s in %sms",
+                  result.name, result.accuracy, result.time, baseline.name, baseline.time)
+        return result
+
+
+if __name__ == '__main__':
+    import argparse
+    from peewee import SqliteDatabase
+
+    parser = argparse.ArgumentParser(description='Compare the models that classified photos')
+    parser.add_argument('--config', help='configuration file', default="config.ini")
+    args = parser.parse_args()
+
+    config = Config.load(args.config)
+    repository = Repository(SqliteDatabase(config.database_file))
+    names = dict((m.key, m.name) for m in config.models.values())
+    names.setdefault(config.model.key, config.model.name)
+
+    print(f"Active model {config.model}" + (f", shadow {config.shadow_model} on "
+                                            f"{config.classify_shadow_fraction:.0%} of the photos"
+                                            if config.shadow_model is not None else ""))
+    print()
+    print("model".ljust(24) + "photos".rjust(8) + "mean".rjust(10))
+    for row in repository.get_model_stats():
+        print(names.get(row["model"], row["model"])[:23].ljust(24) + str(row["photos"]).rjust(8) +
+              f"{row['time']:.0f}ms".rjust(10))
+
+    print()
+    print("shadow".ljust(24) + "baseline".ljust(24) + "photos".rjust(8) + "agree".rjust(8) + "mean".rjust(10) +
+          "baseline".rjust(10))
+    for row in repository.get_shadow_stats():
+        print(names.get(row["model"], row["model"])[:23].ljust(24) +
+              names.get(row["baseline"], row["baseline"])[:23].ljust(24) +
+              str(row["photos"]).rjust(8) +
+              f"{row['agreement']:.1%}".rjust(8) +
+              f"{row['time']:.0f}ms".rjust(10) +
+              f"{row['baseline_time']:.0f}ms".rjust(10))
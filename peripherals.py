@@ -0,0 +1,19 @@
+from typing import Optional
+
+from reachability import Reachability
+
+
+class Peripherals:
+    """Creates the clients of what a cycle talks to outside the Pi: the cards and the modem.
+    Replaced by cycle_trace to record a cycle or replay it without the hardware."""
+
+    def http_client(self, host: str, source_address: Optional[str] = None):
+        from api import HttpClient
+        return HttpClient(host, source_address=source_address)
+
+    def reachability(self, source_address: Optional[str] = None) -> Reachability:
+        return Reachability(source_address=source_address)
+
+    def serial(self, port: str, baudrate: int, timeout: Optional[float] = None):
+        import serial
+        return serial.Serial(port, baudrate, timeout=timeout)
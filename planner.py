@@ -0,0 +1,113 @@
+import logging
+from typing import Optional, List
+
+import clock
+from config import Config
+from database import Repository
+
+log = logging.getLogger(__name__)
+
+
+class CyclePlan:
+    MODE_FULL = "full"  # Download, classify and upload
+    MODE_CLASSIFY_ONLY = "classify-only"  # Work through the backlog instead of downloading more
+    MODE_UPLOAD_ONLY = "upload-only"  # Not enough energy left for anything but reporting
+
+    def __init__(self, mode: str, deadline: float, upload_reserve: float, max_downloads: Optional[int],
+                 max_classifications: Optional[int]):
+        self.mode = mode
+        # clock.monotonic() by which the cycle has to be finished
+        self.deadline = deadline
+        # Seconds kept free at the end of the cycle for the satellite upload
+        self.upload_reserve = upload_reserve
+        self.max_downloads = max_downloads
+        self.max_classifications = max_classifications
+
+    @property
+    def download(self) -> bool:
+        return self.mode == self.MODE_FULL
+
+    @property
+    def classify(self) -> bool:
+        return self.mode != self.MODE_UPLOAD_ONLY
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - clock.monotonic())
+
+    def __str__(self):
+        return f"mode: {self.mode}, time left: {self.remaining():.0f}s, upload reserve: {self.upload_reserve:.0f}s, " \
+               f"max downloads: {self.max_downloads}, max classifications: {self.max_classifications}"
+
+
+# Splits the time and energy available in a cycle over download, classification and upload, using the
+# per-item costs measured in previous cycles
+class CyclePlanner:
+    # Seconds per item or per stage used until there are measurements
+    DEFAULT_COSTS = {
+        "listing": 10,
+        "download": 5,
+        "classification": 2,
+        "encoding": 1,
+        "satellite_send": 180,
+    }
+    # Seconds, a stage faster than the timer resolution still costs something, the plan divides by costs
+    MIN_COST = 0.001
+
+    def __init__(self, config: Config, repository: Repository):
+        self._config = config
+        self._repository = repository
+
+    def plan(self, pmp_data: dict, started: float) -> CyclePlan:
+        deadline = started + self._config.planner_time_budget
+        energy = self.energy_fraction(pmp_data.get("bridge_volt"))
+        backlog = self._repository.count_photos_to_inference()
+
+        try:
+            rows = self._repository.get_stage_metrics(self._config.planner_history)
+        except Exception as e:
+            log.error("Error reading stage metrics %s", e)
+            rows = []
+
+        upload_reserve = 1.5 * (self.cost(rows, "satellite_send") + self.cost(rows, "encoding"))
+
+        if energy <= 0:
+            return CyclePlan(CyclePlan.MODE_UPLOAD_ONLY, deadline, upload_reserve, 0, 0)
+
+        # With little energy left only part of the time budget is spent
+        available = (deadline - clock.monotonic()) * energy - upload_reserve
+        download_cost = self.cost(rows, "download", per_item=True)
+        classify_cost = self.cost(rows, "classification", per_item=True)
+
+        if backlog >= self._config.planner_backlog_high or energy < 1:
+            mode = CyclePlan.MODE_CLASSIFY_ONLY
+            max_downloads = 0
+        else:
+            mode = CyclePlan.MODE_FULL
+            available -= self.cost(rows, "listing")
+            # Every download also has to be classified within this cycle
+            max_downloads = max(0, int((available - backlog * classify_cost) / (download_cost + classify_cost)))
+
+        max_classifications = max(0, int((available - max_downloads * download_cost) / classify_cost))
+        return CyclePlan(mode, deadline, upload_reserve, max_downloads, max_classifications)
+
+    def energy_fraction(self, voltage: Optional[float]) -> float:
+        """1 when there is enough energy, 0 at or below the critical voltage, linear in between"""
+        low = self._config.planner_low_voltage
+        critical = self._config.planner_critical_voltage
+        if voltage is None or low <= 0:
+            return 1.0
+        if voltage <= critical:
+            return 0.0
+        if voltage >= low or low <= critical:
+            return 1.0
+        return (voltage - critical) / (low - critical)
+
+    def cost(self, rows: List[dict], name: str, per_item: bool = False) -> float:
+        stages = [r for r in rows if r["name"] == name]
+        wall = sum(r["wall_ms"] for r in stages) / 1000
+
+        if per_item:
+            items = sum(r["items"] for r in stages)
+            return max(wall / items, self.MIN_COST) if items > 0 else self.DEFAULT_COSTS[name]
+
+        return max(wall / len(stages), self.MIN_COST) if stages else self.DEFAULT_COSTS[name]
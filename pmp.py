@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+import json
+import logging
+import sys
+import zlib
+from typing import Optional, List
+
+log = logging.getLogger(__name__)
+
+START_TOKEN = "START VALUES"
+END_TOKEN = "END VALUES"
+CHECKSUM_KEY = "checksum"
+
+KEY_TYPES = {
+    "stm32_temp": float,
+    "bridge_temp": float,
+    "bridge_hum": float,
+    "bridge_hpa": int,
+    "bridge_volt": int,
+    "activation": str,
+    "data": str,
+}
+
+
+def _parse_value(key: str, value: str):
+    if key in KEY_TYPES:
+        return KEY_TYPES[key](value)
+
+    # New sensor keys are kept, typed as well as the value allows
+    for key_type in (int, float):
+        try:
+            return key_type(value)
+        except ValueError:
+            pass
+    return value
+
+
+class PmpReading:
+    """Values of one START VALUES/END VALUES frame sent by the PMP"""
+
+    def __init__(self, values: dict, checksum_valid: bool = True):
+        self.values = values
+        self.checksum_valid = checksum_valid
+
+    def to_json(self) -> str:
+        return json.dumps(self.values, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, value: str) -> 'PmpReading':
+        return cls(json.loads(value))
+
+    def __str__(self):
+        return str(self.values)
+
+
+class PmpParser:
+    """Parses the serial lines of the PMP into readings.
+
+    A frame may end with a 'checksum: <crc32>' line, the CRC32 of the preceding value lines joined by newlines.
+    Frames without checksum are accepted as before.
+    """
+
+    def __init__(self):
+        self._lines: Optional[List[str]] = None
+
+    def feed(self, line: str) -> Optional[PmpReading]:
+        """Returns the reading when line completes a frame"""
+        if line == START_TOKEN:
+            self._lines = []
+            return None
+
+        if self._lines is None:
+            return None
+
+        if line == END_TOKEN:
+            lines, self._lines = self._lines, None
+            return self._parse_frame(lines)
+
+        self._lines.append(line)
+        return None
+
+    @staticmethod
+    def _parse_frame(lines: List[str]) -> PmpReading:
+        values = {}
+        checksum = None
+        value_lines = []
+
+        for line in lines:
+            # Split once only, values such as data may contain colons themselves
+            elements = line.split(":", 1)
+            if len(elements) != 2:
+                continue
+
+            key = elements[0].strip()
+            value = elements[1].strip()
+
+            if key == CHECKSUM_KEY:
+                checksum = value
+                continue
+
+            value_lines.append(line)
+            try:
+                values[key] = _parse_value(key, value)
+            except ValueError:
+                log.debug("Ignoring PMP value %s: %s", key, value)
+
+        checksum_valid = True
+        if checksum is not None:
+            try:
+                checksum_valid = int(checksum, 0) == zlib.crc32("\n".join(value_lines).encode('ascii'))
+            except ValueError:
+                checksum_valid = False
+
+        return PmpReading(values, checksum_valid)
+
+
+if __name__ == '__main__':
+    # Parses frames from stdin, for example: cat /dev/ttyAMA0 | python3 pmp.py
+    parser = PmpParser()
+    for line in sys.stdin:
+        reading = parser.feed(line.strip())
+        if reading is not None:
+            print(reading.to_json(), "" if reading.checksum_valid else "(checksum mismatch)")
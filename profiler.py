@@ -0,0 +1,163 @@
+import cProfile
+import itertools
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+
+log = logging.getLogger(__name__)
+
+MODE_SAMPLE = "sample"
+MODE_CPROFILE = "cprofile"
+
+
+class StackSampler(threading.Thread):
+    """Samples the stacks at a fixed interval, counting for every active stage the stack of the thread it runs on,
+    or those of all threads for a process wide stage. A thread is used instead of an interval timer signal, the
+    stages also run in worker threads."""
+
+    def __init__(self, interval: float):
+        super().__init__(name="profiler", daemon=True)
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        # Key -> thread ident (None for every thread) and the stacks counted
+        self._active: Dict[int, Tuple[Optional[int], Counter]] = {}
+
+    def begin(self, key: int, process_wide: bool = False):
+        with self._lock:
+            self._active[key] = (None if process_wide else threading.get_ident(), Counter())
+
+    def end(self, key: int) -> Counter:
+        with self._lock:
+            _, counter = self._active.pop(key, (None, Counter()))
+            return counter
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        names = {}
+        while not self._stopped.wait(self._interval):
+            with self._lock:
+                if not self._active:
+                    continue
+                names.update((t.ident, t.name) for t in threading.enumerate())
+                stacks = dict((ident, self._collapse(names.get(ident, str(ident)), frame))
+                              for ident, frame in sys._current_frames().items() if ident != self.ident)
+                for thread, counter in self._active.values():
+                    if thread is None:
+                        counter.update(stacks.values())
+                    elif thread in stacks:
+                        counter[stacks[thread]] += 1
+
+    @staticmethod
+    def _collapse(thread_name: str, frame) -> str:
+        functions = []
+        while frame is not None:
+            code = frame.f_code
+            functions.append(f"{Path(code.co_filename).stem}:{code.co_name}")
+            frame = frame.f_back
+        functions.append(thread_name)
+        return ";".join(reversed(functions))
+
+
+# Profiles the stages of Metrics when enabled by --profile or [Profile] Enabled. Every stage writes a
+# collapsed stack file (flamegraph.pl format) in sample mode or a pstats dump in cprofile mode, named
+# after the stage and software version, the oldest files are removed beyond max_bytes.
+class StageProfiler:
+    def __init__(self, directory: Path, version: int, mode: str = MODE_SAMPLE, interval_ms: int = 10,
+                 max_bytes: int = 2 * 1024 * 1024, max_stacks: int = 2000):
+        self._directory = Path(directory)
+        self._version = version
+        self._mode = mode
+        self._max_bytes = max_bytes
+        self._max_stacks = max_stacks
+        self._sampler: Optional[StackSampler] = None
+        if mode == MODE_SAMPLE:
+            self._sampler = StackSampler(interval_ms / 1000)
+            self._sampler.start()
+        # Per thread, cProfile only follows the thread that enabled it and one profile at a time
+        self._local = threading.local()
+        # Stages of the same name may run at the same time, e.g. the sync of each camera
+        self._keys = itertools.count()
+
+    @classmethod
+    def create(cls, config: Config, version: int, force: bool = False) -> Optional['StageProfiler']:
+        if not (force or config.profile_enabled):
+            return None
+        directory = config.profile_directory or Path(config.database_file).parent / "profiles"
+        return cls(directory, version, config.profile_mode, config.profile_interval, config.profile_max_kb * 1024)
+
+    @contextmanager
+    def profile(self, name: str, process_wide: bool = False):
+        key = next(self._keys)
+        try:
+            begun = self.__begin(key, process_wide)
+        except Exception as e:
+            log.warning("Could not start profiling %s: %s", name, e)
+            begun = False
+
+        try:
+            yield
+        finally:
+            if begun:
+                try:
+                    self.__end(name, key)
+                except Exception as e:
+                    log.warning("Could not save profile of %s: %s", name, e)
+
+    def close(self):
+        if self._sampler is not None:
+            self._sampler.stop()
+
+    def __begin(self, key: int, process_wide: bool) -> bool:
+        if self._sampler is not None:
+            self._sampler.begin(key, process_wide)
+            return True
+
+        # The innermost stage of a thread is profiled, the outer one is paused meanwhile
+        stack: List[cProfile.Profile] = self._local.__dict__.setdefault("stack", [])
+        if stack:
+            stack[-1].disable()
+        profile = cProfile.Profile()
+        stack.append(profile)
+        profile.enable()
+        return True
+
+    def __end(self, name: str, key: int):
+        self._directory.mkdir(parents=True, exist_ok=True)
+        path = self._directory / f"{name}-v{self._version}-{datetime.now().strftime('%Y%m%dT%H%M%S')}-{key}"
+
+        if self._sampler is not None:
+            stacks = self._sampler.end(key)
+            if stacks:
+                with open(f"{path}.collapsed", 'w') as f:
+                    for stack, count in stacks.most_common(self._max_stacks):
+                        f.write(f"{stack} {count}\n")
+        else:
+            stack = self._local.stack
+            profile = stack.pop()
+            profile.disable()
+            profile.dump_stats(f"{path}.prof")
+            if stack:
+                stack[-1].enable()
+
+        self.__limit_size()
+
+    def __limit_size(self):
+        files = sorted((f for f in self._directory.iterdir() if f.suffix in (".collapsed", ".prof")),
+                       key=lambda f: f.stat().st_mtime, reverse=True)
+        # The newest profile is kept even when it alone exceeds the limit
+        total = files[0].stat().st_size if files else 0
+        for f in files[1:]:
+            total += f.stat().st_size
+            if total > self._max_bytes:
+                os.remove(f)
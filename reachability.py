@@ -0,0 +1,96 @@
+import http.client
+import logging
+import socket
+import threading
+from typing import Dict, Tuple, Optional
+
+import clock
+
+log = logging.getLogger(__name__)
+
+
+class Reachability:
+    """In-process reachability probe of the HTTP server on a host, replacing forked pings.
+
+    Results are shared by every instance for cache_ttl seconds, so repeated checks in one cycle are free.
+    """
+    PROBE_TCP = "tcp"
+    PROBE_HTTP = "http"
+
+    _cache: Dict[Tuple[str, int, str, Optional[str]], Tuple[float, bool]] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, port: int = 80, probe: str = PROBE_TCP, path: str = "/client", timeout: float = 2,
+                 cache_ttl: float = 10, source_address: Optional[str] = None):
+        self._port = port
+        self._source_address = source_address
+        self._probe = probe
+        self._path = path
+        self._timeout = timeout
+        self._cache_ttl = cache_ttl
+
+    def is_reachable(self, host: str, deadline: float = 10, delay: float = 0.5, max_delay: float = 4,
+                     cancel: Optional[threading.Event] = None) -> bool:
+        """Probes until the host answers or deadline seconds have passed, backing off exponentially from delay"""
+        key = (host, self._port, self._probe, self._source_address)
+        with self._lock:
+            cached = self._cache.get(key)
+        if cached is not None and clock.monotonic() - cached[0] < self._cache_ttl:
+            return cached[1]
+
+        log.debug("Testing if %s is reachable...", host)
+        cancel = cancel or threading.Event()
+        end = clock.monotonic() + deadline
+        reachable = False
+
+        while not cancel.is_set():
+            if self._probe_once(host):
+                reachable = True
+                break
+
+            remaining = end - clock.monotonic()
+            if remaining <= 0:
+                break
+
+            clock.wait(cancel, min(delay, remaining))
+            delay = min(delay * 2, max_delay)
+
+        if reachable:
+            log.info("Host %s reached.", host)
+        else:
+            log.warning("Host %s not reachable.", host)
+
+        with self._lock:
+            self._cache[key] = (clock.monotonic(), reachable)
+        return reachable
+
+    @classmethod
+    def invalidate_all(cls):
+        with cls._lock:
+            cls._cache.clear()
+
+    def invalidate(self, host: str):
+        with self._lock:
+            self._cache.pop((host, self._port, self._probe, self._source_address), None)
+
+    def _probe_once(self, host: str) -> bool:
+        source_address = (self._source_address, 0) if self._source_address is not None else None
+        try:
+            if self._probe == self.PROBE_HTTP:
+                connection = http.client.HTTPConnection(host, self._port, timeout=self._timeout,
+                                                        source_address=source_address)
+                try:
+                    connection.request("HEAD", self._path)
+                    connection.getresponse()
+                finally:
+                    connection.close()
+            else:
+                socket.create_connection((host, self._port), timeout=self._timeout,
+                                         source_address=source_address).close()
+            return True
+        except (OSError, http.client.HTTPException):
+            return False
+
+
+if __name__ == '__main__':
+    print(Reachability(probe=Reachability.PROBE_HTTP, path="/").is_reachable("google.com"))
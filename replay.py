@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+import argparse
+import configparser
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+import clock
+from clock import VirtualClock
+from config import Config
+from cycle_trace import TracePlayer, ReplayPeripherals, DATABASE_FILE, STAGED_DIR
+from metrics import boot_clock, totals
+from reachability import Reachability
+
+
+# Runs a cycle recorded with core.py --record again against SmartCameraTrap. The card, probes and modem answer
+# from the trace and a virtual clock skips the sleeps and recorded response times, so the same trace gives
+# the same plan and downloads on every run and only the computation of the Pi is measured for real.
+def restore(player: TracePlayer, directory: Path, config_file: Optional[str] = None) -> Config:
+    """Unpacks the database, staged downloads and config the recorded cycle started from into directory"""
+    header = player.header
+    parser = configparser.ConfigParser()
+    if config_file is not None:
+        parser.read(config_file)
+    else:
+        parser.read_string(header["config"])
+
+    database_file = directory / "cameratrap.db"
+    download_directory = directory / "camdata"
+    downlink_file = directory / "downlink.ini"
+    if header.get("downlink"):
+        downlink_file.write_text(header["downlink"])
+
+    # Everything the cycle writes stays in the work directory
+    for section, key, value in [("Database", "File", database_file), ("SDCard", "DownloadFolder", download_directory),
+                                ("Downlink", "File", downlink_file)]:
+        if not parser.has_section(section):
+            parser.add_section(section)
+        parser.set(section, key, str(value))
+
+    for name in player.members(STAGED_DIR):
+        player.extract(name, download_directory / name[len(STAGED_DIR):])
+
+    if player.has(DATABASE_FILE):
+        from peewee import SqliteDatabase
+        from database import Repository
+
+        player.extract(DATABASE_FILE, database_file)
+        database = SqliteDatabase(str(database_file))
+        Repository(database).move_local_files(header["download_directory"], str(download_directory))
+        database.close()
+
+    return Config(parser)
+
+
+def replay(trace_file: str, directory: Path, config_file: Optional[str] = None, profile: bool = False) -> dict:
+    from core import SmartCameraTrap
+
+    player = TracePlayer(trace_file)
+    try:
+        header = player.header
+        config = restore(player, directory, config_file)
+        virtual = VirtualClock(datetime.fromisoformat(header["started"]))
+        Reachability.invalidate_all()
+        # The modem retry delays are random
+        random.seed(header["started"])
+
+        previous = clock.install(virtual)
+        started = virtual.monotonic()
+        compute = time.monotonic()
+        try:
+            # The cold start marks are measured from the start of the replay
+            trap = SmartCameraTrap(config, header["reachable"], pmp_data=header["pmp"], origin=boot_clock(),
+                                   profile=profile, peripherals=ReplayPeripherals(player, virtual))
+            trap.run_cycle()
+        finally:
+            clock.install(previous)
+
+        return {
+            "cycle_s": virtual.monotonic() - started,
+            "compute_s": time.monotonic() - compute,
+            "skipped_s": virtual.skipped,
+            "stages": [s.to_dict() for s in trap.metrics.stages],
+            "not_replayed": player.remaining(),
+        }
+    finally:
+        player.close()
+
+
+def summarize(runs: List[dict], field: List[dict]) -> List[dict]:
+    """Median per stage over the runs, stages that ran more than once in a cycle are added up"""
+    per_run = [totals(run["stages"]) for run in runs]
+    field_totals = totals(field)
+    rows = []
+    for name in dict.fromkeys(n for t in per_run for n in t):
+        values = [t[name] for t in per_run if name in t]
+        row = dict((key, statistics.median(v[key] for v in values)) for key in values[0])
+        row["name"] = name
+        row["field_wall_ms"] = field_totals[name]["wall_ms"] if name in field_totals else None
+        rows.append(row)
+    return rows
+
+
+def print_report(runs: List[dict], rows: List[dict]):
+    print("stage".ljust(16) + "wall".rjust(10) + "cpu".rjust(10) + "items".rjust(8) + "items/s".rjust(10) +
+          "kB/s".rjust(8) + "field".rjust(10))
+    for row in rows:
+        seconds = row["wall_ms"] / 1000
+        print(row["name"][:15].ljust(16) +
+              f"{seconds:.2f}s".rjust(10) +
+              f"{row['cpu_ms'] / 1000:.2f}s".rjust(10) +
+              f"{row['items']:.0f}".rjust(8) +
+              (f"{row['items'] / seconds:.2f}" if row["items"] and seconds else "-").rjust(10) +
+              (f"{row['bytes'] / 1024 / seconds:.0f}" if row["bytes"] and seconds else "-").rjust(8) +
+              (f"{row['field_wall_ms'] / 1000:.2f}s" if row["field_wall_ms"] is not None else "-").rjust(10))
+
+    print()
+    print(f"Cycle {statistics.median(r['cycle_s'] for r in runs):.1f}s, "
+          f"of which {statistics.median(r['compute_s'] for r in runs):.1f}s computed and "
+          f"{statistics.median(r['skipped_s'] for r in runs):.1f}s skipped waits, median of {len(runs)} run(s)")
+
+    not_replayed = runs[-1]["not_replayed"]
+    if not_replayed:
+        print(f"{sum(not_replayed.values())} recorded interaction(s) were not replayed, the cycle took another path:")
+        for channel, count in not_replayed.items():
+            print(f"  {channel}: {count}")
+
+
+if __name__ == '__main__':
+    import log_buffer
+
+    # The status and modem power pins are not driven during a replay
+    os.environ.setdefault("GPIOZERO_PIN_FACTORY", "mock")
+
+    parser = argparse.ArgumentParser(description='Replay a recorded cycle and report its time per stage')
+    parser.add_argument('trace', help='trace file recorded with core.py --record')
+    parser.add_argument('--config', help='configuration file to use instead of the recorded one', default=None)
+    parser.add_argument('--repeat', help='number of runs the medians are taken over', type=int, default=1)
+    parser.add_argument('--work-dir', help='keep the database and downloads of each run in this folder', default=None)
+    parser.add_argument('--profile', help='profile every stage, the profiles are kept with --work-dir',
+                        action="store_true")
+    parser.add_argument('--json', help='print the runs and summary as JSON', action="store_true")
+    parser.add_argument('--log-level', help='level of the cycle output', default="WARNING")
+    args = parser.parse_args()
+
+    log_buffer.setup_console(args.log_level)
+
+    runs = []
+    for run in range(args.repeat):
+        if args.work_dir is not None:
+            directory = Path(args.work_dir) / f"run-{run + 1}"
+            directory.mkdir(parents=True, exist_ok=True)
+            runs.append(replay(args.trace, directory, args.config, args.profile))
+        else:
+            with tempfile.TemporaryDirectory() as directory:
+                runs.append(replay(args.trace, Path(directory), args.config, args.profile))
+
+    trace = TracePlayer(args.trace)
+    rows = summarize(runs, trace.header.get("stages", []))
+    trace.close()
+
+    if args.json:
+        print(json.dumps({"runs": runs, "summary": rows}, indent=2))
+    else:
+        print_report(runs, rows)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+import argparse
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from labels import unpack_scores
+
+
+# Picks the class of every photo again from the stored scores (Classify StoreScores), without the images.
+# A class is only chosen when its score reaches its threshold, the best of those wins.
+def rescore(matrix: np.ndarray, thresholds: np.ndarray, fallback: Optional[int] = None) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns (class ids, scores, rows that got a class) for a (photos x 256) score matrix"""
+    with np.errstate(invalid='ignore'):
+        passed = np.where(matrix >= thresholds, matrix, -1)
+
+    class_ids = np.argmax(passed, axis=1)
+    scores = passed[np.arange(len(matrix)), class_ids]
+    assigned = scores >= 0
+
+    if fallback is not None:
+        class_ids = np.where(assigned, class_ids, fallback)
+        scores = np.where(assigned, scores, np.nan_to_num(matrix[:, fallback]))
+        assigned = np.ones(len(matrix), dtype=bool)
+
+    return class_ids, scores, assigned
+
+
+def parse_thresholds(values, class_ids: Dict[str, int], default: float) -> np.ndarray:
+    thresholds = np.full(256, default, dtype=np.float32)
+    for value in values:
+        name, _, threshold = value.partition("=")
+        if name.lower() not in class_ids:
+            raise argparse.ArgumentTypeError(f"Unknown class {name}")
+        thresholds[class_ids[name.lower()]] = float(threshold)
+    return thresholds
+
+
+if __name__ == '__main__':
+    from peewee import SqliteDatabase
+    from config import Config
+    from database import Photo, Repository
+
+    parser = argparse.ArgumentParser(description='Re-classify stored photos with new thresholds')
+    parser.add_argument('--config', help='configuration file', default="config.ini")
+    parser.add_argument('--threshold', help='minimum score of a class, as <class>=<score>', action='append', default=[])
+    parser.add_argument('--default-threshold', help='minimum score of the other classes', type=float, default=0)
+    parser.add_argument('--fallback', help='class of photos where no score reaches its threshold', default=None)
+    parser.add_argument('--include-synced', help='also re-classify photos that were uploaded', action='store_true')
+    parser.add_argument('--dry-run', help='only print the changes', action='store_true')
+    args = parser.parse_args()
+
+    config = Config.load(args.config)
+    names = dict((v, k) for k, v in config.mapping.items())
+    thresholds = parse_thresholds(args.threshold, config.class_ids, args.default_threshold)
+    fallback = config.class_ids[args.fallback.lower()] if args.fallback else None
+
+    repository = Repository(SqliteDatabase(config.database_file))
+    statuses = [Photo.Status.INFERENCE_SUCCESS] + ([Photo.Status.SYNCED] if args.include_synced else [])
+    photos = repository.get_photo_scores(statuses)
+    matrix = unpack_scores([blob for _, _, blob in photos])
+    class_ids, scores, assigned = rescore(matrix, thresholds, fallback)
+
+    rows = []
+    changes = Counter()
+    for (photo_id, old_class_id, _), class_id, score, ok in zip(photos, class_ids, scores, assigned):
+        if ok:
+            rows.append((photo_id, names.get(int(class_id), str(class_id)), int(class_id), float(score)))
+            if old_class_id != class_id:
+                changes[(names.get(old_class_id, "unknown"), rows[-1][1])] += 1
+
+    print(f"Rescored {len(rows)} of {len(photos)} photo(s) with scores, {sum(changes.values())} changed")
+    for (before, after), count in changes.most_common():
+        print(f"  {before} -> {after}: {count}")
+
+    if not args.dry_run:
+        repository.update_photos_inference_class(rows)
@@ -0,0 +1,47 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import Optional, Tuple
+
+from database import Repository
+from inferencer import ClassificationResult
+
+try:
+    # Optional, several times faster than blake2b on the Pi
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Bytes hashed from the start and the end of a file, together with its size
+SAMPLE_BYTES = 64 * 1024
+
+
+def hash_file(path: Path) -> str:
+    """Identifies the content of a JPEG from its head, tail and size, independent of its name or folder"""
+    size = os.path.getsize(path)
+    digest = xxhash.xxh64() if xxhash is not None else hashlib.blake2b(digest_size=16)
+    digest.update(size.to_bytes(8, byteorder='little'))
+    with open(path, 'rb') as f:
+        digest.update(f.read(SAMPLE_BYTES))
+        if size > SAMPLE_BYTES:
+            f.seek(max(SAMPLE_BYTES, size - SAMPLE_BYTES))
+            digest.update(f.read(SAMPLE_BYTES))
+    # The algorithm is part of the hash, results cached with the other one are not matched
+    return ("xx64:" if xxhash is not None else "b2b:") + digest.hexdigest()
+
+
+# Classification results by content hash, so an image that shows up again (reformatted card, renumbered
+# folders, copied between cameras) is not classified again. Results are kept per model and the least
+# recently used ones are evicted beyond max_entries.
+class ResultCache:
+    def __init__(self, repository: Repository, model: str, max_entries: int = 5000):
+        self._repository = repository
+        self._model = Path(model).name
+        self._max_entries = max_entries
+
+    def get(self, local_file: Path) -> Tuple[str, Optional[ClassificationResult]]:
+        content_hash = hash_file(local_file)
+        return content_hash, self._repository.get_cached_result(content_hash, self._model)
+
+    def put(self, content_hash: str, result: ClassificationResult):
+        self._repository.insert_cached_result(content_hash, self._model, result, self._max_entries)
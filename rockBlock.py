@@ -1,9 +1,14 @@
 from re import match, Pattern, compile
-from time import sleep
+import asyncio
+import logging
 import serial
 import datetime
 from random import randint
 
+import clock
+
+log = logging.getLogger(__name__)
+
 
 class RockBlockException(Exception):
     pass
@@ -73,7 +78,7 @@ def _assert_match(pattern: Pattern, value):
         raise RockBlockException(f"Expected to match pattern {pattern} but got {value}")
 
 
-class RockBlock(object):
+class AsyncRockBlock(object):
     IRIDIUM_EPOCH = 1399818235000  # May 11, 2014, at 14:23:55 (This will be 're-epoched' every couple of years!)
     _signal_strength_response_pattern = compile(r'\+CSQ:(\d)')
     _network_time_response_pattern = compile(r'-MSSTM: (.*)')
@@ -86,117 +91,210 @@ class RockBlock(object):
     # - between 20..40 for the subsequent attempts
     session_retry_delays = [range(2, 5)] * 3 + [range(5, 15)] * 7 + [range(15, 20)]
 
-    def __init__(self, port_id: str, debug: bool=False, debug_serial: bool=False, session_retry_attempts: int=15):
+    def __init__(self, s: serial.Serial, debug: bool = False, debug_serial: bool = False,
+                 session_retry_attempts: int = 15):
         self._debug = debug
         self._debug_serial = debug_serial
         self._session_retry_attempts = session_retry_attempts
-        self.s = serial.Serial(port_id, 19200, timeout=5)
-        if not self._configure_port():
-            self.close()
+        self._timeout = 5
+        self._reader = asyncio.StreamReader()
+        self._loop = None
+        self.s = s
+
+    @classmethod
+    async def open(cls, port_id: str, debug: bool = False, debug_serial: bool = False,
+                   session_retry_attempts: int = 15, open_serial=serial.Serial) -> 'AsyncRockBlock':
+        # Non-blocking port, reads are driven by the event loop
+        rb = cls(open_serial(port_id, 19200, timeout=0), debug, debug_serial, session_retry_attempts)
+        rb._attach()
+
+        try:
+            configured = await rb._configure_port()
+        except BaseException:
+            rb.close()
+            raise
+
+        if not configured:
+            rb.close()
             raise RockBlockException("Could not communicate with RockBLOCK")
 
-        self.s.timeout = 60
+        rb._timeout = 60
+        return rb
+
+    def _attach(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self.s.fileno(), self._on_readable)
+
+    def _detach(self):
+        if self._loop is not None:
+            self._loop.remove_reader(self.s.fileno())
+            self._loop = None
+
+    def _on_readable(self):
+        try:
+            data = self.s.read(self.s.in_waiting or 1)
+        except serial.SerialException as e:
+            self._detach()
+            self._reader.set_exception(e)
+            return
+
+        if data:
+            self._reader.feed_data(data)
+
+    async def _read_line(self):
+        try:
+            line = await asyncio.wait_for(self._reader.readline(), self._timeout)
+        except asyncio.TimeoutError:
+            # Behave like a serial readline that hit its timeout
+            line = b""
+
+        data = line.decode().strip()
+        if self._debug_serial:
+            log.debug("<- %s", data)
+
+        return data
+
+    async def _read_bytes(self, length: int) -> bytes:
+        try:
+            data = await asyncio.wait_for(self._reader.readexactly(length), self._timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            raise RockBlockException(f"Timeout reading {length} byte(s) from RockBLOCK")
 
-    def _read_line(self):
-        data = self.s.readline().decode().strip()
         if self._debug_serial:
-            print(f"<- {data}")
+            log.debug("<- %s", data)
 
         return data
 
-    def _assert_blank_ok(self):
-        self._assert_read_line("")
-        self._assert_read_line("OK")
+    async def _read_until(self, separator: bytes) -> bytes:
+        try:
+            data = await asyncio.wait_for(self._reader.readuntil(separator), self._timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            raise RockBlockException(f"Timeout reading until {separator} from RockBLOCK")
+
+        if self._debug_serial:
+            log.debug("<- %s", data)
 
-    def _assert_read_line(self, assertion):
-        actual = self._read_line()
+        return data
+
+    async def _assert_blank_ok(self):
+        await self._assert_read_line("")
+        await self._assert_read_line("OK")
+
+    async def _assert_read_line(self, assertion):
+        actual = await self._read_line()
         if actual != assertion:
             raise RockBlockException(f"Expected to read '{assertion}' but got '{actual}'")
         return actual
 
-    def _write_command(self, command: str):
+    async def _write_command(self, command: str):
         self._write(f"{command}\r")
 
         # Assert echo response
-        self._assert_read_line(command)
+        await self._assert_read_line(command)
 
     def _write(self, data: str):
         if self._debug_serial:
-            print(f"-> {data}")
+            log.debug("-> %s", data)
         return self.s.write(data.encode())
 
     def _write_bytes(self, data: bytes):
         if self._debug_serial:
-            print(f"-> {data}")
+            log.debug("-> %s", data)
         return self.s.write(data)
 
-    def _write_command_and_read_line(self, command):
-        self._write_command(command)
-        return self._read_line()
+    async def _write_command_and_read_line(self, command):
+        await self._write_command(command)
+        return await self._read_line()
 
-    def ping(self):
-        return self._write_command_and_read_line("AT") == "OK"
+    async def ping(self):
+        return await self._write_command_and_read_line("AT") == "OK"
 
-    def request_signal_strength(self):
+    async def request_signal_strength(self):
         self._ensure_connection_status()
         result = _assert_match(
             self._signal_strength_response_pattern,
-            self._write_command_and_read_line("AT+CSQ")
+            await self._write_command_and_read_line("AT+CSQ")
         )
-        self._assert_blank_ok()
+        await self._assert_blank_ok()
         return int(result.group(1))
 
-    def network_time(self):
+    async def network_time(self):
         self._ensure_connection_status()
         result = _assert_match(
             self._network_time_response_pattern,
-            self._write_command_and_read_line("AT-MSSTM")
+            await self._write_command_and_read_line("AT-MSSTM")
         )
 
-        self._assert_blank_ok()
+        await self._assert_blank_ok()
 
         if result.group(1) == "no network service":
             return None
         else:
             return datetime.datetime.utcfromtimestamp(int((self.IRIDIUM_EPOCH + (int(result.group(1), 16) * 90)) / 1000))
 
-    def send(self, msg: str):
-        return self.send_bytes(msg.encode("ascii"))
+    async def send(self, msg: str):
+        return await self.send_bytes(msg.encode("ascii"))
 
-    def send_bytes(self, msg: bytes):
-        self._queue_bytes_message(msg)
-        return self._try_extended_sbd_session()
+    async def send_bytes(self, msg: bytes):
+        await self._queue_bytes_message(msg)
+        return await self._try_extended_sbd_session()
 
-    def check_mailbox(self):
-        return self._try_extended_sbd_session()
+    async def check_mailbox(self):
+        return await self._try_extended_sbd_session()
 
-    def get_serial_identifier(self):
+    async def get_serial_identifier(self):
         self._ensure_connection_status()
-        response = self._write_command_and_read_line("AT+GSN")
-        self._assert_blank_ok()
+        response = await self._write_command_and_read_line("AT+GSN")
+        await self._assert_blank_ok()
         return response
 
     def close(self):
         if self.s is not None:
+            self._detach()
             self.s.close()
             self.s = None
 
-    def receive_ascii_message(self):
-        self._write_command("AT+SBDRT")
-        self._assert_read_line("+SBDRT:")
-        response = self._read_line()
-        self._assert_read_line("OK")
+    async def receive_ascii_message(self):
+        await self._write_command("AT+SBDRT")
+        await self._assert_read_line("+SBDRT:")
+        response = await self._read_line()
+        await self._assert_read_line("OK")
         return response
 
-    def _queue_bytes_message(self, msg: bytes):
-        self._clear_mo_buffer()
+    async def receive_bytes_message(self) -> bytes:
+        self._ensure_connection_status()
+        self._write("AT+SBDRB\r")
+
+        # The binary response directly follows the echoed command, without a line feed
+        echo = (await self._read_until(b"\r")).decode().strip()
+        if echo != "AT+SBDRB":
+            raise RockBlockException(f"Expected to read 'AT+SBDRB' but got '{echo}'")
+
+        length = int.from_bytes(await self._read_bytes(2), byteorder='big')
+        msg = await self._read_bytes(length)
+        checksum = int.from_bytes(await self._read_bytes(2), byteorder='big')
+
+        status = await self._read_line()
+        if status == "":
+            status = await self._read_line()
+
+        if status != "OK":
+            raise RockBlockException(f"Expected to read 'OK' but got '{status}'")
+
+        if checksum != sum(msg) & 0xFFFF:
+            raise RockBlockException(f"MT message checksum {checksum} does not match the received {length} byte(s)")
+
+        return msg
+
+    async def _queue_bytes_message(self, msg: bytes):
+        await self._clear_mo_buffer()
         self._ensure_connection_status()
 
         if len(msg) > 340:
             raise RockBlockException(f"_queue_bytes_message bytes should be <= 340 bytes, was {len(msg)} bytes")
 
-        self._write_command("AT+SBDWB=" + str(len(msg)))
-        self._assert_read_line("READY")
+        await self._write_command("AT+SBDWB=" + str(len(msg)))
+        await self._assert_read_line("READY")
 
         checksum = 0
 
@@ -204,13 +302,13 @@ class RockBlock(object):
             checksum = checksum + c
 
         self._write_bytes(msg + bytes([checksum >> 8]) + bytes([checksum & 0xFF]))
-        self._assert_read_line("")  # BLANK
+        await self._assert_read_line("")  # BLANK
 
-        status = self._read_line()
+        status = await self._read_line()
 
         if status == "0":
-            self._assert_read_line("")  # BLANK
-            self._assert_read_line("OK")  # OK
+            await self._assert_read_line("")  # BLANK
+            await self._assert_read_line("OK")  # OK
         elif status == "1":
             raise RockBlockException("SBD message write timeout. An insufficient number of bytes were transferred to "
                                      "ISU during the transfer period of 60 seconds.")
@@ -224,28 +322,29 @@ class RockBlock(object):
         else:
             raise RockBlockException(f"Unknown status writing binary message {status}")
 
-    def _configure_port(self):
-        return self._enable_echo() and self._disable_flow_control() and self._disable_ring_alerts() and self.ping()
+    async def _configure_port(self):
+        return await self._enable_echo() and await self._disable_flow_control() and \
+            await self._disable_ring_alerts() and await self.ping()
 
-    def _enable_echo(self):
-        return self._write_command_and_read_line("ATE1") == "OK"
+    async def _enable_echo(self):
+        return await self._write_command_and_read_line("ATE1") == "OK"
 
-    def _disable_flow_control(self):
-        return self._write_command_and_read_line("AT&K0") == "OK"
+    async def _disable_flow_control(self):
+        return await self._write_command_and_read_line("AT&K0") == "OK"
 
-    def _disable_ring_alerts(self):
-        return self._write_command_and_read_line("AT+SBDMTA=0") == "OK"
+    async def _disable_ring_alerts(self):
+        return await self._write_command_and_read_line("AT+SBDMTA=0") == "OK"
 
     def _get_session_retry_delay(self, i: int) -> int:
         r = self.session_retry_delays[i] if i < len(self.session_retry_delays) else self.session_retry_delays[-1]
         return randint(r.start, r.stop)
 
-    def _try_extended_sbd_session(self) -> SBDStatus:
+    async def _try_extended_sbd_session(self) -> SBDStatus:
         for n in range(self._session_retry_attempts):
             if self._debug:
-                print(f"Trying to create extended SBD session, attempt {n + 1}/{self._session_retry_attempts}")
+                log.debug("Trying to create extended SBD session, attempt %d/%d", n + 1, self._session_retry_attempts)
 
-            status = self._extended_sbd_session()
+            status = await self._extended_sbd_session()
             if status.mo_success:
                 return status
             else:
@@ -256,18 +355,19 @@ class RockBlock(object):
                 delay = self._get_session_retry_delay(n)
 
                 if self._debug:
-                    print(f"No success trying to create extended SBD session, retry in {delay} second(s): {status.mo_status_message()}")
-                sleep(delay)
+                    log.debug("No success trying to create extended SBD session, retry in %d second(s): %s", delay,
+                              status.mo_status_message())
+                await clock.sleep_async(delay)
 
-    def _extended_sbd_session(self) -> SBDStatus:
+    async def _extended_sbd_session(self) -> SBDStatus:
         self._ensure_connection_status()
 
         result = _assert_match(
             self._session_response_pattern,
-            self._write_command_and_read_line("AT+SBDIX")
+            await self._write_command_and_read_line("AT+SBDIX")
         )
 
-        self._assert_blank_ok()
+        await self._assert_blank_ok()
 
         status = SBDStatus(
             int(result.group(1)),
@@ -279,20 +379,68 @@ class RockBlock(object):
         )
 
         if status.mo_success:
-            self._clear_mo_buffer()
+            await self._clear_mo_buffer()
 
         return status
 
-    def _clear_mo_buffer(self):
-        if self._write_command_and_read_line("AT+SBDD0") == "0":
-            self._assert_read_line("")
-            self._assert_read_line("OK")
+    async def _clear_mo_buffer(self):
+        if await self._write_command_and_read_line("AT+SBDD0") == "0":
+            await self._assert_read_line("")
+            await self._assert_read_line("OK")
 
     def _ensure_connection_status(self):
         if self.s is None or self.s.isOpen() is False:
             raise RockBlockException("Serial port not connected")
 
 
+class RockBlock(object):
+    """Blocking wrapper around AsyncRockBlock, every call runs the protocol on a private event loop."""
+
+    def __init__(self, port_id: str, debug: bool=False, debug_serial: bool=False, session_retry_attempts: int=15):
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._rb = self._run(AsyncRockBlock.open(port_id, debug, debug_serial, session_retry_attempts))
+        except BaseException:
+            self._loop.close()
+            raise
+
+    def _run(self, coroutine):
+        return self._loop.run_until_complete(coroutine)
+
+    def ping(self):
+        return self._run(self._rb.ping())
+
+    def request_signal_strength(self):
+        return self._run(self._rb.request_signal_strength())
+
+    def network_time(self):
+        return self._run(self._rb.network_time())
+
+    def send(self, msg: str):
+        return self._run(self._rb.send(msg))
+
+    def send_bytes(self, msg: bytes):
+        return self._run(self._rb.send_bytes(msg))
+
+    def check_mailbox(self):
+        return self._run(self._rb.check_mailbox())
+
+    def get_serial_identifier(self):
+        return self._run(self._rb.get_serial_identifier())
+
+    def receive_ascii_message(self):
+        return self._run(self._rb.receive_ascii_message())
+
+    def receive_bytes_message(self):
+        return self._run(self._rb.receive_bytes_message())
+
+    def close(self):
+        if self._rb is not None:
+            self._rb.close()
+            self._rb = None
+            self._loop.close()
+
+
 if __name__ == '__main__':
 
     def list_ports():
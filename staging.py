@@ -0,0 +1,100 @@
+import logging
+import shutil
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Tuple
+
+from config import Config
+from database import Repository
+
+log = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+# Keeps the downloads waiting for classification within a byte quota and above a free space watermark,
+# so a classification backlog cannot fill the root filesystem the database and logs are written to.
+class StagingArea:
+    def __init__(self, config: Config, repository: Repository):
+        self._directory = config.sd_download_directory
+        self._repository = repository
+        self._quota = config.sd_staging_quota * MB
+        self._min_free = config.sd_min_free_space * MB
+        # Shared by the sync threads of all cameras
+        self._lock = threading.Lock()
+        self._files, self._bytes = repository.get_staged_usage()
+
+    def occupancy(self) -> Tuple[int, int]:
+        """Number of files and bytes staged"""
+        with self._lock:
+            return self._files, self._bytes
+
+    def free_bytes(self) -> int:
+        directory = Path(self._directory)
+        # The folder is created by the first download
+        while not directory.exists() and directory != directory.parent:
+            directory = directory.parent
+        return shutil.disk_usage(directory).free
+
+    def admit(self, size: int, captured: Optional[datetime] = None) -> bool:
+        """Reserves room for a download of size bytes taken at captured (the datetime of the card), False when
+        downloads should pause"""
+        with self._lock:
+            if self._quota > 0 and self._bytes + size > self._quota:
+                log.warning("Staging quota of %sMB reached", self._quota // MB)
+                return False
+
+            missing = self._min_free + size - self.free_bytes()
+            if missing > 0 and self.__evict(missing, captured) < missing:
+                log.warning("Free space below %sMB", self._min_free // MB)
+                return False
+
+            self._files += 1
+            self._bytes += size
+            return True
+
+    def release(self, size: int):
+        """Returns the room of a download that failed"""
+        with self._lock:
+            self._files -= 1
+            self._bytes -= size
+
+    def enforce(self) -> int:
+        """Evicts files until the free space watermark is met, returns the number of bytes evicted"""
+        with self._lock:
+            missing = self._min_free - self.free_bytes()
+            return self.__evict(missing) if missing > 0 else 0
+
+    def __evict(self, needed: int, captured: Optional[datetime] = None) -> int:
+        # The files that would be classified last go first, the next sync downloads them again
+        photos = []
+        room = 0
+        for photo in self._repository.get_photos_to_evict():
+            if room >= needed:
+                break
+            # Only files classified after the download, replacing one it would be classified after only makes
+            # the next sync download it again
+            if captured is not None and (photo.inference_attempt or 0, photo.datetime) <= (0, captured):
+                break
+            photos.append(photo)
+            room += photo.size
+
+        if captured is not None and room < needed:
+            return 0
+
+        evicted = 0
+        files = 0
+        for photo in photos:
+            local_file = Path(photo.local_file)
+            if local_file.is_file():
+                local_file.unlink()
+            self._repository.delete_photo(photo.id)
+            evicted += photo.size
+            files += 1
+
+        if files:
+            log.warning("Evicted %s unclassified file(s) (%sMB) from staging", files, evicted // MB)
+            self._files -= files
+            self._bytes -= evicted
+        return evicted
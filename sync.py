@@ -1,68 +1,171 @@
-from typing import List, Dict
+import logging
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, Dict, Optional
 
+import clock
+import exif
 from api import Api, ApiFile
-from config import Config
-from database import Repository
-from ping import Ping
+from config import Config, DEFAULT_CAMERA
+from database import Photo, Repository
+from metrics import Metrics, StageTimer
+from reachability import Reachability
+from staging import StagingArea
+
+log = logging.getLogger(__name__)
 
 
 class FileSyncManager:
-    def __init__(self, config: Config, repository: Repository, api: Api, ping: Ping):
+    def __init__(self, config: Config, repository: Repository, api: Api, reachability: Reachability, metrics: Metrics = None,
+                 camera_id: str = DEFAULT_CAMERA, staging: Optional[StagingArea] = None,
+                 cancel: Optional[threading.Event] = None):
         self._config = config
+        self._staging = staging
+        # Set by the watchdog of main.py, the signal it sends only reaches the main thread
+        self._cancel = cancel
+        self._camera_id = camera_id
         self._repository = repository
         self._api = api
-        self._ping = ping
+        self._reachability = reachability
+        self._metrics = metrics if metrics is not None else Metrics()
+
+    def run(self, max_downloads: Optional[int] = None, deadline: Optional[float] = None):
+        with self._metrics.stage("listing") as stage:
+            images = self._api.get_files()
+            stage.items = len(images)
 
-    def run(self):
-        images = self._api.get_files()
-        self.download_files(images)
+        with self._metrics.stage("download") as stage:
+            self.download_files(images, stage, max_downloads, deadline)
 
-    def download_files(self, files: List[ApiFile]):
+    def download_files(self, files: List[ApiFile], stage: StageTimer = None, max_downloads: Optional[int] = None,
+                       deadline: Optional[float] = None):
         skipped = {}
         failure_count = 0
+        downloads = 0
         for file in files:
+            if max_downloads is not None and downloads >= max_downloads:
+                log.info("Stop downloading, planned number of downloads (%s) reached", max_downloads)
+                break
+
+            if deadline is not None and clock.monotonic() >= deadline:
+                log.info("Stop downloading, time budget for downloads used")
+                break
+
+            if self._cancel is not None and self._cancel.is_set():
+                log.warning("Stop downloading, cycle cancelled")
+                break
+
             try:
-                if self.should_download_file(file, skipped):
-                    self.download_file(file)
+                # Before the EXIF header is read from the card
+                if self._repository.get_photo_exists(file, self._camera_id):
+                    continue
+
+                captured = self.read_capture_time(file)
+                if self.should_download_file(file, skipped, captured):
+                    if self._staging is not None and not self._staging.admit(file.size, file.datetime):
+                        log.warning("Stop downloading, staging area is full")
+                        break
+
+                    downloads += 1
+                    try:
+                        if self.download_file(file, captured) and stage is not None:
+                            stage.items += 1
+                            stage.bytes += file.size
+                    except Exception:
+                        if self._staging is not None:
+                            self._staging.release(file.size)
+                        raise
             except Exception as e:
                 failure_count += 1
-                print(f"Error downloading file {file.directory}/{file.filename} {e}")
+                log.warning("Error downloading file %s/%s %s", file.directory, file.filename, e)
                 if failure_count >= 3 and not self.is_host_reachable():
-                    print(f"Abort downloading")
+                    log.warning("Abort downloading")
                     break
 
         if skipped:
-            print(f"Skipped downloads because max ({self._config.sd_max_per_day}) per day is reached:")
+            log.info("Skipped downloads of camera %s because max (%s) per day or (%s) per burst is reached:",
+                     self._camera_id, self._config.sd_max_per_day, self._config.sd_burst_max)
             for key, value in skipped.items():
-                print(f" - {key}: {value} download(s) skipped")
+                log.info(" - %s: %s download(s) skipped", key, value)
 
         return failure_count, skipped
 
     def is_host_reachable(self) -> bool:
-        return self._ping.is_reachable(self._api.get_host(), attempts=1)
+        # A single quick probe, the cycle just saw the card answering
+        self._reachability.invalidate(self._api.get_host())
+        return self._reachability.is_reachable(self._api.get_host(), deadline=0)
+
+    def read_capture_time(self, file: ApiFile) -> Optional[datetime]:
+        """Capture time from the EXIF header of the file on the card, without downloading the image"""
+        if not self._config.sd_read_exif:
+            return None
+
+        try:
+            header = exif.read(lambda length: self._api.read_file_prefix(file, length))
+            return header.datetime_original if header is not None else None
+        except Exception as e:
+            log.warning("Error reading EXIF header of %s/%s %s", file.directory, file.filename, e)
+            return None
 
-    def should_download_file(self, file: ApiFile, skipped: Dict[str, int] = None) -> bool:
-        if self._repository.get_photo_exists(file):
-            return False
+    def should_download_file(self, file: ApiFile, skipped: Dict[str, int] = None,
+                             captured: Optional[datetime] = None) -> bool:
+        """Whether the max per day and burst limits allow a file that is not in the database yet"""
+        taken = captured or file.datetime
+        reason = None
 
         if self._config.sd_max_per_day > 0:
-            if self._repository.get_photo_by_day_count(file.datetime) >= self._config.sd_max_per_day:
-                if skipped is not None:
-                    key = file.datetime.strftime('%d-%m-%Y')
-                    skipped[key] = (skipped[key] if key in skipped else 0) + 1
-                return False
-
-        return True
-
-    def download_file(self, file: ApiFile):
-        local_dir = self._config.sd_download_directory / file.directory.strip("/")
-        local_dir.mkdir(parents=True, exist_ok=True)
-        output_file = local_dir / file.filename
-
-        if output_file.is_file() and output_file.stat().st_size == file.size:
-            print(f"File already exists {output_file}...")
-        else:
-            print(f"Downloading file {file.directory}/{file.filename} to {output_file}...")
-            self._api.download_file(file, str(output_file))
-
-        self._repository.insert_photo(file, output_file)
+            # The maximum per day applies to each camera
+            if self._repository.get_photo_by_day_count(taken, self._camera_id) >= self._config.sd_max_per_day:
+                reason = taken.strftime('%d-%m-%Y')
+
+        if reason is None and self._config.sd_burst_gap > 0:
+            gap = timedelta(seconds=self._config.sd_burst_gap)
+            if self._repository.count_photos_captured_between(taken - gap, taken + gap, self._camera_id) \
+                    >= self._config.sd_burst_max:
+                reason = "burst"
+
+        if reason is None:
+            return True
+
+        if skipped is not None:
+            skipped[reason] = skipped.get(reason, 0) + 1
+
+        if captured is not None:
+            # Recorded so the header is not read again in the next cycles
+            self._repository.insert_photo(file, self.local_file(file), Photo.Status.SKIPPED, self._camera_id,
+                                          captured)
+        return False
+
+    def local_file(self, file: ApiFile) -> Path:
+        local_dir = self._config.sd_download_directory
+        if self._camera_id != DEFAULT_CAMERA:
+            local_dir = local_dir / self._camera_id
+        return local_dir / file.directory.strip("/") / file.filename
+
+    # Returns True when the file was transferred from the card
+    def download_file(self, file: ApiFile, captured: Optional[datetime] = None) -> bool:
+        output_file = self.local_file(file)
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+
+        # Checkpoint first, a cycle killed during the transfer is reconciled by the Journal
+        photo_id = self._repository.insert_photo(file, output_file, Photo.Status.DOWNLOADING, self._camera_id,
+                                                 captured)
+
+        downloaded = False
+        try:
+            if output_file.is_file() and output_file.stat().st_size == file.size:
+                log.debug("File already exists %s...", output_file)
+            else:
+                log.debug("Downloading file %s/%s to %s...", file.directory, file.filename, output_file)
+                self._metrics.mark_once("first_download")
+                self._api.download_file(file, str(output_file))
+                downloaded = True
+        except Exception:
+            self._repository.delete_photo(photo_id)
+            if output_file.is_file():
+                output_file.unlink()
+            raise
+
+        self._repository.update_photo_status(photo_id, Photo.Status.TODO)
+        return downloaded
@@ -1,26 +1,41 @@
+import logging
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
 
-from config import Config
+import exif
+from config import Config, ModelConfig
 from inferencer import Inferencer, ClassificationResult
+from labels import LabelRegistry, pack_scores
 import time
 import numpy as np
 from PIL import Image
 import tflite_runtime.interpreter as tflite
 
+log = logging.getLogger(__name__)
+
 
 class TensorFlowLiteInferencer(Inferencer):
-    def __init__(self, config: Config):
-        self._interpreter = tflite.Interpreter(config.tensorflow_lite_model)
-        self._interpreter.allocate_tensors()
+    def __init__(self, config: Config, labels: LabelRegistry, model: Optional[ModelConfig] = None):
+        self._model = model.model if model is not None else config.tensorflow_lite_model
+        self._key = Path(self._model).name
+        self._threads = config.classify_threads
+        self._interpreter = self.__create_interpreter()
         _, height, width, _ = self._interpreter.get_input_details()[0]['shape']
         self._input_tensor_size = (width, height)
-        self._labels = self._load_labels(config.tensorflow_lite_labels)
+        self._labels = labels
+        self._store_scores = min(config.classify_store_scores, len(labels))
+
+    def __create_interpreter(self):
+        interpreter = tflite.Interpreter(self._model, num_threads=self._threads)
+        interpreter.allocate_tensors()
+        return interpreter
 
-    def _load_labels(self, path):
-        with open(path, 'r') as f:
-            return {i: line.strip() for i, line in enumerate(f.readlines())}
+    def set_threads(self, threads: int):
+        # The thread count is fixed when the interpreter is created
+        if threads != self._threads:
+            self._threads = threads
+            self._interpreter = self.__create_interpreter()
 
     def _set_input_tensor(self, image):
         tensor_index = self._interpreter.get_input_details()[0]['index']
@@ -33,7 +48,7 @@ class TensorFlowLiteInferencer(Inferencer):
         return x.resize(self._input_tensor_size, Image.ANTIALIAS)
 
     def _classify_image(self, image, top_k=1):
-        """Returns a sorted array of classification results."""
+        """Returns (class ids, label indexes, scores) of the top_k results."""
         self._set_input_tensor(image)
         self._interpreter.invoke()
         output_details = self._interpreter.get_output_details()[0]
@@ -44,22 +59,29 @@ class TensorFlowLiteInferencer(Inferencer):
             scale, zero_point = output_details['quantization']
             output = scale * (output - zero_point)
 
-        ordered = np.argpartition(-output, top_k)
-        return [(self._labels[i], output[i]) for i in ordered[:top_k]]
+        if top_k >= len(output):
+            ordered = np.argsort(-output)
+        else:
+            ordered = np.argpartition(-output, top_k)[:top_k]
+            ordered = ordered[np.argsort(-output[ordered])]
+        return self._labels.class_ids[ordered], ordered, output[ordered]
 
-    def get_exif_datetime(self, image: Image) -> Optional[datetime]:
+    def get_exif_datetime(self, local_file: Path) -> Optional[datetime]:
         try:
-            return datetime.strptime(image.getexif()[36867], '%Y:%m:%d %H:%M:%S')
+            header = exif.read_file(local_file)
+            return header.datetime_original if header is not None else None
         except Exception as e:
-            print("Error getting exif date", e)
+            log.warning("Error getting exif date %s", e)
             return None
 
     def infer(self, local_file: Path) -> ClassificationResult:
         start = time.time() * 1000
         image = self._open_image(local_file)
-        class_name, accuracy = self._classify_image(image)[0]
+        class_ids, indexes, scores = self._classify_image(image, max(1, self._store_scores))
         duration = time.time() * 1000 - start
-        return ClassificationResult(class_name, accuracy, int(duration), self.get_exif_datetime(image))
+        packed = pack_scores(class_ids, scores) if self._store_scores else None
+        return ClassificationResult(self._labels.labels[indexes[0]], float(scores[0]), int(duration),
+                                    self.get_exif_datetime(local_file), int(class_ids[0]), packed, self._key)
 
 
 if __name__ == '__main__':
@@ -73,9 +95,15 @@ if __name__ == '__main__':
             def __init__(self):
                 self.tensorflow_lite_model = str(modelfile)
                 self.tensorflow_lite_labels = str(modelfile.parent/modelfile.stem) + ".txt"
+                self.classify_store_scores = 0
+                self.classify_threads = 4
 
 
-        rb = TensorFlowLiteInferencer(FakeConfig())
+        fake_config = FakeConfig()
+        with open(fake_config.tensorflow_lite_labels) as f:
+            # Every label maps to its own line number, the real ids come from [Mapping]
+            mapping = {line.strip(): i + 1 for i, line in enumerate(f.readlines()) if line.strip()}
+        rb = TensorFlowLiteInferencer(fake_config, LabelRegistry.load(fake_config.tensorflow_lite_labels, mapping))
         
         for file in path.glob('*.[Jj][Pp][Gg]'):
             print(file.name, rb.infer(file))
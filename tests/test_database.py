@@ -0,0 +1,61 @@
+from datetime import datetime
+
+from peewee import *
+
+from database import Photo, Repository
+
+
+# The photo table as created before any column was added to it
+class BaselinePhoto(Model):
+    id = AutoField()
+    fingerprint = CharField(index=True, null=False)
+    filename = CharField(null=False)
+    directory = CharField(index=True, null=False)
+    size = IntegerField(null=False)
+    date = CharField(index=True, null=False)
+    datetime = DateTimeField(null=False)
+    local_file = CharField(null=False)
+    status = IntegerField(index=True, null=False, default=0)
+    inference_class = CharField(null=True)
+    inference_attempt = IntegerField(null=True)
+    inference_accuracy = FloatField(null=True)
+    inference_error = CharField(null=True)
+    inference_time = IntegerField(null=True)
+    exif_datetime = DateTimeField(null=True)
+
+    class Meta:
+        table_name = "photo"
+
+
+def create_baseline(path) -> SqliteDatabase:
+    db = SqliteDatabase(str(path))
+    db.bind([BaselinePhoto])
+    db.create_tables([BaselinePhoto])
+    BaselinePhoto.create(fingerprint="100MEDIA/IMG0.JPG", filename="IMG0.JPG", directory="100MEDIA", size=1,
+                         date="2021-03-01", datetime=datetime(2021, 3, 1, 12), local_file="/tmp/IMG0.JPG",
+                         inference_class="Elephant")
+    db.close()
+    return SqliteDatabase(str(path))
+
+
+def test_baseline_database_is_upgraded(tmp_path):
+    db = create_baseline(tmp_path / "cameratrap.db")
+    Repository(db)
+
+    columns = {c.name for c in db.get_columns("photo")}
+    assert {f.column_name for f in Photo._meta.sorted_fields} <= columns
+    indexed = {c for i in db.get_indexes("photo") for c in i.columns}
+    assert "inference_class_id" in indexed
+
+    photo = Photo.get()
+    assert photo.filename == "IMG0.JPG"
+    assert photo.status == Photo.Status.TODO
+
+
+def test_upgraded_database_opens_again(tmp_path):
+    db = create_baseline(tmp_path / "cameratrap.db")
+    Repository(db)
+    db.close()
+
+    Repository(db)
+    assert Photo.select().count() == 1
@@ -0,0 +1,89 @@
+import configparser
+from types import SimpleNamespace
+
+import pytest
+
+from config import ModelConfig
+from downlink import DownlinkCommand, DownlinkException, DownlinkStore
+
+
+def test_decode_commands():
+    msg = bytes([1, 0x01, 0x2c, 0x01, 0x02, 3, 15, 0x03, 2]) + b'v2' + bytes([0x04, 60, 0, 0xFF])
+    commands = DownlinkCommand.decode(msg)
+
+    assert [(c.opcode, c.args) for c in commands] == [
+        (DownlinkCommand.SET_MAX_PER_DAY, (300,)),
+        (DownlinkCommand.SET_CLASS_WEIGHT, (3, 1.5)),
+        (DownlinkCommand.SET_MODEL, ('v2',)),
+        (DownlinkCommand.SET_WAKE_INTERVAL, (60,)),
+        (DownlinkCommand.RESET, ()),
+    ]
+
+
+@pytest.mark.parametrize("msg", [b'', bytes([2, 0xFF])])
+def test_decode_unsupported_version(msg):
+    with pytest.raises(DownlinkException, match="Unsupported"):
+        DownlinkCommand.decode(msg)
+
+
+def test_decode_unknown_opcode():
+    with pytest.raises(DownlinkException, match="opcode 0x7f"):
+        DownlinkCommand.decode(bytes([1, 0xFF, 0x7F]))
+
+
+@pytest.mark.parametrize("msg", [
+    bytes([1, 0x01, 0x2c]),
+    bytes([1, 0x02, 3]),
+    bytes([1, 0x03]),
+    bytes([1, 0x03, 5]) + b'v2',
+    bytes([1, 0x04]),
+])
+def test_decode_short_payload(msg):
+    with pytest.raises(DownlinkException, match="truncated"):
+        DownlinkCommand.decode(msg)
+
+
+@pytest.fixture
+def store(tmp_path):
+    (tmp_path / "good.txt").write_text("Elephant\nLion\n")
+    (tmp_path / "bad.txt").write_text("Elephant\nZebra\n")
+    config = SimpleNamespace(
+        downlink_file=str(tmp_path / "downlink.ini"),
+        mapping={"Elephant": 1, "Lion": 2},
+        models={"good": ModelConfig("good", str(tmp_path / "good.tflite"), str(tmp_path / "good.txt")),
+                "bad": ModelConfig("bad", str(tmp_path / "bad.tflite"), str(tmp_path / "bad.txt"))},
+        model=ModelConfig("good", str(tmp_path / "good.tflite"), str(tmp_path / "good.txt")))
+    return DownlinkStore(config)
+
+
+def overrides(store) -> configparser.ConfigParser:
+    parser = configparser.ConfigParser()
+    parser.read(store._config.downlink_file)
+    return parser
+
+
+def test_set_registered_model(store):
+    store.handle_message(bytes([1, 0x03, 4]) + b'good')
+    assert overrides(store).get("Classify", "Model") == "good"
+
+
+def test_set_model_with_unmapped_labels_is_ignored(store):
+    store.handle_message(bytes([1, 0x03, 3]) + b'bad' + bytes([0x01, 10, 0]))
+
+    parser = overrides(store)
+    assert not parser.has_section("Classify")
+    # The other commands of the message still apply
+    assert parser.get("SDCard", "MaxPerDay") == "10"
+
+
+def test_set_model_file_with_unmapped_labels_is_ignored(store, tmp_path):
+    (tmp_path / "other.tflite").write_bytes(b'')
+    (tmp_path / "other.txt").write_text("Zebra\n")
+    store.handle_message(bytes([1, 0x03, 5]) + b'other')
+
+    assert not overrides(store).has_section("TensorFlowLite")
+
+
+def test_bad_message_writes_nothing(store, tmp_path):
+    store.handle_message(bytes([1, 0x01]))
+    assert not (tmp_path / "downlink.ini").exists()
@@ -0,0 +1,70 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import numpy as np
+
+from encoder import SatelliteEncoder
+
+
+def photo(taken, class_id=3, accuracy=0.5, camera_id="cam0", exif=True):
+    return SimpleNamespace(exif_datetime=taken if exif else None, datetime=taken, inference_class_id=class_id,
+                           inference_accuracy=accuracy, camera_id=camera_id)
+
+
+def decode_images(data: bytes, cameras=False) -> np.ndarray:
+    fields = SatelliteEncoder.IMAGE_FIELDS_CAMERAS if cameras else SatelliteEncoder.IMAGE_FIELDS
+    return np.frombuffer(data, dtype=fields)
+
+
+def test_round_trip():
+    encoder = SatelliteEncoder({}, 1)
+    taken = datetime(2021, 3, 1, 12, 0, 5)
+    images = [photo(taken, 3, 0.5), photo(datetime(2010, 1, 1, 0, 1), None, None, exif=False)]
+
+    payload, sent, aggregates = encoder.encode_images(images, {7: 12, 9: 70000})
+
+    assert payload[:2] == b'\x01\x01'
+    assert payload[2] == 2
+    assert payload[3:9] == bytes([7, 12, 0, 9, 0xFF, 0xFF])
+    assert sent == images and aggregates == [7, 9]
+
+    decoded = decode_images(bytes(payload[9:]))
+    assert decoded['seconds'].tolist() == [(taken - SatelliteEncoder.SAT_EPOCH).total_seconds(), 60]
+    assert decoded['class_id'].tolist() == [3, SatelliteEncoder.UNKNOWN_CLASS]
+    assert decoded['accuracy'].tolist() == [128, 0]
+
+
+def test_field_limits():
+    encoder = SatelliteEncoder({}, 1)
+    images = [photo(datetime(2009, 12, 31), accuracy=1.7), photo(datetime(2200, 1, 1), accuracy=-0.2)]
+
+    decoded = decode_images(encoder.encode_image_array(images).tobytes())
+
+    assert decoded['seconds'].tolist() == [0, 0xFFFFFFFF]
+    assert decoded['accuracy'].tolist() == [255, 0]
+
+
+def test_camera_index_only_with_several_cameras():
+    single = SatelliteEncoder({}, 1, camera_ids=["cam0"])
+    payload, _, _ = single.encode_images([photo(datetime(2021, 3, 1))])
+    assert payload[1] == 1 and len(payload) == 3 + SatelliteEncoder.BYTES_PER_IMAGE
+
+    several = SatelliteEncoder({}, 1, camera_ids=["cam0", "cam1"])
+    payload, _, _ = several.encode_images([photo(datetime(2021, 3, 1), camera_id="cam1"),
+                                           photo(datetime(2021, 3, 1), camera_id="gone")])
+    assert payload[1] == 2
+    assert decode_images(bytes(payload[3:]), cameras=True)['camera'].tolist() == [1, 0xFF]
+
+
+def test_payload_limit():
+    encoder = SatelliteEncoder({}, 1)
+    images = [photo(datetime(2021, 3, 1))] * 100
+    aggregates = dict((class_id, 1) for class_id in range(20))
+
+    payload, sent, sent_aggregates = encoder.encode_images(images, aggregates)
+
+    assert len(payload) <= SatelliteEncoder.MAX_PAYLOAD
+    assert len(sent_aggregates) == 20
+    assert len(sent) == (SatelliteEncoder.MAX_PAYLOAD - 3 - 20 * SatelliteEncoder.BYTES_PER_AGGREGATE) \
+        // SatelliteEncoder.BYTES_PER_IMAGE
+    assert len(payload) == 3 + 20 * SatelliteEncoder.BYTES_PER_AGGREGATE + len(sent) * SatelliteEncoder.BYTES_PER_IMAGE
@@ -0,0 +1,103 @@
+import struct
+from datetime import datetime
+
+import pytest
+
+import exif
+
+CAPTURED = b"2021:03:01 12:34:56\x00"
+
+
+def entry(order: str, tag: int, type: int, count: int, value: int) -> bytes:
+    raw = struct.pack(order + 'H', value) + b'\x00\x00' if type == 3 else struct.pack(order + 'I', value)
+    return struct.pack(order + 'HHI', tag, type, count) + raw
+
+
+def ifd(order: str, entries: list, next_ifd: int = 0) -> bytes:
+    return struct.pack(order + 'H', len(entries)) + b"".join(entries) + struct.pack(order + 'I', next_ifd)
+
+
+def tiff(order: str, captured: bool = True, thumbnail: bytes = None) -> bytes:
+    """IFD0 pointing to the Exif IFD, DateTimeOriginal, then IFD1 with the thumbnail"""
+    ifd0 = 8
+    exif_ifd = ifd0 + 2 + 12 + 4
+    exif_count = 1 if captured else 0
+    text = exif_ifd + 2 + 12 * exif_count + 4
+    ifd1 = text + len(CAPTURED) if thumbnail is not None else 0
+    thumb = ifd1 + 2 + 2 * 12 + 4
+
+    data = {'<': b'II', '>': b'MM'}[order] + struct.pack(order + 'HI', 42, ifd0)
+    data += ifd(order, [entry(order, exif.TAG_EXIF_IFD, 4, 1, exif_ifd)], ifd1)
+    data += ifd(order, [entry(order, exif.TAG_DATETIME_ORIGINAL, 2, len(CAPTURED), text)][:exif_count])
+    data += CAPTURED
+    if thumbnail is not None:
+        data += ifd(order, [entry(order, exif.TAG_THUMBNAIL_OFFSET, 4, 1, thumb),
+                            entry(order, exif.TAG_THUMBNAIL_LENGTH, 3, 1, len(thumbnail))])
+        data += thumbnail
+    return data
+
+
+def jpeg(tiff_data: bytes) -> bytes:
+    app1 = b'Exif\x00\x00' + tiff_data
+    return b'\xff\xd8\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 + b'\xff\xda\x00\x02' + b'\x00' * 64
+
+
+@pytest.mark.parametrize("order", ['<', '>'])
+def test_datetime_original_in_both_byte_orders(order):
+    header = exif.parse(jpeg(tiff(order)))
+    assert header.datetime_original == datetime(2021, 3, 1, 12, 34, 56)
+    assert header.thumbnail is None
+
+
+@pytest.mark.parametrize("order", ['<', '>'])
+def test_thumbnail(order):
+    thumbnail = b'\xff\xd8thumbnail\xff\xd9'
+    header = exif.parse(jpeg(tiff(order, thumbnail=thumbnail)))
+    assert header.thumbnail == thumbnail
+
+
+def test_missing_datetime_original():
+    header = exif.parse(jpeg(tiff('<', captured=False)))
+    assert header is not None
+    assert header.datetime_original is None
+
+
+# Cut in the segment header, the TIFF header, IFD0, the Exif IFD and the date text
+@pytest.mark.parametrize("length", [3, 14, 22, 34, 50, 70])
+def test_truncated_segment(length):
+    data = jpeg(tiff('>', thumbnail=b'thumbnail'))
+    header = exif.parse(data[:length])
+    assert header is None or (header.datetime_original is None and header.thumbnail is None)
+
+
+def test_truncated_date_text():
+    data = jpeg(tiff('<'))
+    end = data.index(CAPTURED) + 10
+    assert exif.parse(data[:end]).datetime_original is None
+
+
+def test_not_a_jpeg():
+    assert exif.parse(b'\x89PNG\r\n\x1a\n' + b'\x00' * 64) is None
+
+
+def test_no_app1_before_scan():
+    assert exif.parse(b'\xff\xd8\xff\xda\x00\x02' + b'\x00' * 64) is None
+
+
+def test_unknown_byte_order():
+    data = jpeg(b'XX' + tiff('<')[2:])
+    header = exif.parse(data)
+    assert header.datetime_original is None
+
+
+def test_read_fetches_the_whole_segment_for_the_thumbnail():
+    thumbnail = b'\xff\xd8' + b'\x01' * 200 + b'\xff\xd9'
+    data = jpeg(tiff('<', thumbnail=thumbnail))
+    lengths = []
+
+    def read_prefix(length: int) -> bytes:
+        lengths.append(length)
+        return data[:min(length, 100)] if len(lengths) == 1 else data[:length]
+
+    assert exif.read(read_prefix, thumbnail=True).thumbnail == thumbnail
+    assert len(lengths) == 2
@@ -0,0 +1,72 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from encoder import SatelliteEncoder
+from health import HealthRecord
+
+
+def decode(data: bytes) -> dict:
+    packed = int.from_bytes(data, byteorder='big') >> (len(data) * 8 - sum(f[1] for f in HealthRecord.FIELDS))
+    fields = {}
+    for name, bits, scale, offset in reversed(HealthRecord.FIELDS):
+        fields[name] = packed & ((1 << bits) - 1)
+        packed >>= bits
+    return fields
+
+
+def unknown(name: str) -> int:
+    bits = next(f[1] for f in HealthRecord.FIELDS if f[0] == name)
+    return (1 << bits) - 1
+
+
+def test_size():
+    assert HealthRecord.SIZE == 13
+    assert len(HealthRecord().encode()) == HealthRecord.SIZE
+
+
+def test_round_trip():
+    record = HealthRecord(version=5, stm32_temp=21.5, bridge_temp=-3, bridge_hum=64, bridge_hpa=1013,
+                          bridge_volt=12345, cycle_seconds=95, download_kbps=812, backlog=42, database_mb=3.6,
+                          keep_alive=1)
+
+    assert decode(record.encode()) == {
+        "version": 5, "stm32_temp": 123, "bridge_temp": 74, "bridge_hum": 64, "bridge_hpa": 413,
+        "bridge_volt": 12345, "cycle_seconds": 48, "download_kbps": 812, "backlog": 42, "database_mb": 4,
+        "keep_alive": 1,
+    }
+
+
+def test_missing_values_are_unknown():
+    fields = decode(HealthRecord(version=1, stm32_temp="n/a").encode())
+
+    assert fields["version"] == 1
+    for name, _, _, _ in HealthRecord.FIELDS[1:]:
+        assert fields[name] == unknown(name)
+
+
+@pytest.mark.parametrize("name, value, expected", [
+    ("stm32_temp", -60, 0),
+    ("stm32_temp", 200, unknown("stm32_temp") - 1),
+    ("bridge_hpa", 500, 0),
+    ("bridge_hpa", 1200, unknown("bridge_hpa") - 1),
+    ("backlog", 100000, unknown("backlog") - 1),
+    ("keep_alive", 3, 1),
+])
+def test_field_limits(name, value, expected):
+    assert decode(HealthRecord(**{name: value}).encode())[name] == expected
+
+
+def test_record_follows_message_header():
+    record = HealthRecord(version=2, keep_alive=0)
+    encoder = SatelliteEncoder({}, 2, health=record)
+    image = SimpleNamespace(exif_datetime=None, datetime=datetime(2021, 3, 1), inference_class_id=1,
+                            inference_accuracy=1, camera_id=None)
+
+    payload, _, _ = encoder.encode_images([image])
+
+    assert payload[:2] == b'\x02\x01'
+    assert bytes(payload[2:2 + HealthRecord.SIZE]) == record.encode()
+    assert payload[2 + HealthRecord.SIZE] == 0
+    assert len(payload) == 3 + HealthRecord.SIZE + SatelliteEncoder.BYTES_PER_IMAGE
@@ -0,0 +1,79 @@
+import zlib
+
+import pytest
+
+from pmp import END_TOKEN, START_TOKEN, PmpParser, PmpReading
+
+VALUE_LINES = ["stm32_temp: 21.5", "bridge_hpa: 1013", "activation: PIR", "data: a:b", "solar_ma: 140"]
+
+
+def feed(lines):
+    parser = PmpParser()
+    readings = [parser.feed(line) for line in lines]
+    assert all(reading is None for reading in readings[:-1])
+    return readings[-1]
+
+
+def frame(value_lines, checksum=None):
+    lines = [START_TOKEN] + value_lines
+    if checksum is not None:
+        lines.append(f"checksum: {checksum}")
+    return lines + [END_TOKEN]
+
+
+def crc(value_lines) -> str:
+    return hex(zlib.crc32("\n".join(value_lines).encode('ascii')))
+
+
+def test_values_are_typed():
+    reading = feed(frame(VALUE_LINES))
+
+    assert reading.checksum_valid
+    assert reading.values == {"stm32_temp": 21.5, "bridge_hpa": 1013, "activation": "PIR", "data": "a:b",
+                              "solar_ma": 140}
+
+
+def test_valid_checksum():
+    assert feed(frame(VALUE_LINES, crc(VALUE_LINES))).checksum_valid
+
+
+@pytest.mark.parametrize("checksum", [
+    crc(VALUE_LINES[:-1]),
+    "0",
+    "not a number",
+])
+def test_checksum_mismatch(checksum):
+    assert not feed(frame(VALUE_LINES, checksum)).checksum_valid
+
+
+def test_corrupted_line_fails_checksum():
+    corrupted = ["stm32_temp: 31.5"] + VALUE_LINES[1:]
+    reading = feed(frame(corrupted, crc(VALUE_LINES)))
+
+    assert not reading.checksum_valid
+    assert reading.values["stm32_temp"] == 31.5
+
+
+def test_non_ascii_line_fails_checksum():
+    lines = VALUE_LINES + ["data: é"]
+    assert not feed(frame(lines, crc(VALUE_LINES))).checksum_valid
+
+
+def test_lines_outside_frame_are_ignored():
+    parser = PmpParser()
+    assert parser.feed("stm32_temp: 99") is None
+    assert parser.feed(END_TOKEN) is None
+
+    for line in frame(VALUE_LINES[:1]):
+        reading = parser.feed(line)
+    assert reading.values == {"stm32_temp": 21.5}
+
+
+def test_restarted_frame_drops_partial_values():
+    reading = feed([START_TOKEN, "stm32_temp: 99", START_TOKEN, "bridge_hpa: 1013", END_TOKEN])
+    assert reading.values == {"bridge_hpa": 1013}
+
+
+def test_json_round_trip():
+    reading = feed(frame(VALUE_LINES))
+    assert PmpReading.from_json(reading.to_json()).values == reading.values
@@ -0,0 +1,53 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from peewee import SqliteDatabase
+
+from api import ApiFile
+from database import Photo, Repository
+from staging import StagingArea, MB
+
+
+@pytest.fixture
+def repository():
+    db = SqliteDatabase(":memory:")
+    yield Repository(db)
+    db.close()
+
+
+def stage(repository: Repository, tmp_path, name: str, captured: datetime) -> int:
+    local_file = tmp_path / name
+    local_file.write_bytes(b"\0")
+    file = ApiFile()
+    file.filename, file.directory, file.size, file.datetime = name, "100MEDIA", MB, captured
+    return repository.insert_photo(file, local_file)
+
+
+def staging_area(repository: Repository, tmp_path, free: int) -> StagingArea:
+    config = SimpleNamespace(sd_download_directory=str(tmp_path), sd_staging_quota=0, sd_min_free_space=10)
+    area = StagingArea(config, repository)
+    area.free_bytes = lambda: free
+    return area
+
+
+def test_download_classified_last_is_not_admitted(repository, tmp_path):
+    stage(repository, tmp_path, "IMG0.JPG", datetime(2021, 3, 1, 12))
+    stage(repository, tmp_path, "IMG1.JPG", datetime(2021, 3, 1, 13))
+    area = staging_area(repository, tmp_path, 10 * MB)
+
+    assert not area.admit(MB, datetime(2021, 3, 1, 14))
+    assert Photo.select().count() == 2
+    assert (tmp_path / "IMG1.JPG").is_file()
+    assert area.occupancy() == (2, 2 * MB)
+
+
+def test_download_classified_first_evicts_the_last(repository, tmp_path):
+    stage(repository, tmp_path, "IMG0.JPG", datetime(2021, 3, 1, 12))
+    stage(repository, tmp_path, "IMG1.JPG", datetime(2021, 3, 1, 13))
+    area = staging_area(repository, tmp_path, 10 * MB)
+
+    assert area.admit(MB, datetime(2021, 3, 1, 11))
+    assert [p.filename for p in Photo.select()] == ["IMG0.JPG"]
+    assert not (tmp_path / "IMG1.JPG").exists()
+    assert area.occupancy() == (2, 2 * MB)
@@ -0,0 +1,52 @@
+from typing import List, Mapping, Dict
+
+from database import Photo, Repository
+
+
+class UploadBatch:
+    def __init__(self, photos: List[Photo], aggregates: Dict[int, List[int]]):
+        self.photos = photos
+        # Class id -> ids of the photos folded into its counter
+        self.aggregates = aggregates
+
+    def aggregate_counts(self) -> Dict[int, int]:
+        return {k: len(v) for k, v in self.aggregates.items()}
+
+    def __str__(self):
+        return f"{len(self.photos)} photo(s), aggregates {self.aggregate_counts()}"
+
+
+# Ranks classified photos by class weight, confidence and age. Classes weighted at or below the
+# aggregate weight are not sent one by one but folded into a counter per class.
+class UploadQueue:
+    def __init__(self, repository: Repository, class_weights: Mapping[int, float], age_weight: float = 0,
+                 aggregate_weight: float = 0, batch_size: int = 50):
+        self._repository = repository
+        self._class_weights = dict(class_weights)
+        self._age_weight = age_weight
+        self._batch_size = batch_size
+        self._aggregate_classes = [k for k, v in self._class_weights.items() if v <= aggregate_weight]
+
+    def next_batch(self) -> UploadBatch:
+        photos = self._repository.get_photos_to_sync(self._batch_size, self._class_weights, self._age_weight,
+                                                     self._aggregate_classes)
+        aggregates = self._repository.get_photo_ids_to_sync_by_class(self._aggregate_classes)
+        return UploadBatch(list(photos), aggregates)
+
+    @staticmethod
+    def _photo_ids(batch: UploadBatch, photos: List[Photo], aggregates: List[int]) -> List[int]:
+        photo_ids = [photo.id for photo in photos]
+        for class_id in aggregates:
+            photo_ids.extend(batch.aggregates[class_id])
+        return photo_ids
+
+    def mark_uploading(self, batch: UploadBatch, photos: List[Photo], aggregates: List[int]):
+        """Checkpoint before the payload is handed to a communicator"""
+        self._repository.update_photos_status(self._photo_ids(batch, photos, aggregates), Photo.Status.UPLOADING)
+
+    def mark_failed(self, batch: UploadBatch, photos: List[Photo], aggregates: List[int]):
+        self._repository.update_photos_status(self._photo_ids(batch, photos, aggregates),
+                                              Photo.Status.INFERENCE_SUCCESS, Photo.Status.UPLOADING)
+
+    def mark_synced(self, batch: UploadBatch, photos: List[Photo], aggregates: List[int]):
+        self._repository.update_photos_synced(self._photo_ids(batch, photos, aggregates))
@@ -1,40 +1,72 @@
-from typing import List
+import asyncio
+import logging
+from typing import List, Optional
+
+import clock
 from communication import Communicator
-from database import Repository
 from encoder import SatelliteEncoder
+from metrics import Metrics
+from upload_queue import UploadQueue
+
+log = logging.getLogger(__name__)
 
 
 class Uploader:
-    def __init__(self, communicators: List[Communicator], repository: Repository, encoder: SatelliteEncoder, force_upload: bool):
+    def __init__(self, communicators: List[Communicator], queue: UploadQueue, encoder: SatelliteEncoder, force_upload: bool,
+                 metrics: Metrics = None):
         self._communicators = communicators
         self._force_upload = force_upload
-        self._repository = repository
+        self._queue = queue
         self._encoder = encoder
+        self._metrics = metrics if metrics is not None else Metrics()
 
     def run(self):
+        return asyncio.run(self.run_async())
+
+    async def run_async(self, deadline: Optional[float] = None):
         # For now just send one batch at a time
-        return self._send_batch()
+        if deadline is None:
+            return await self._send_batch()
+
+        try:
+            # Cancelling closes the serial port and powers down the modem before the watchdog hits
+            return await asyncio.wait_for(self._send_batch(), max(0.0, deadline - clock.monotonic()))
+        except asyncio.TimeoutError:
+            log.warning("Upload cancelled, time budget for the cycle used")
+            return False
 
     # Returns True when all the data has been sent, False when images still need to be synced
-    def _send_batch(self) -> bool:
-        images = self._repository.get_photos_to_sync()
-        payload, encoded_images = self._encoder.encode_images(images)
+    async def _send_batch(self) -> bool:
+        with self._metrics.stage("encoding") as stage:
+            batch = self._queue.next_batch()
+            payload, encoded_images, encoded_aggregates = self._encoder.encode_images(batch.photos,
+                                                                                      batch.aggregate_counts())
+            stage.items = len(encoded_images)
+            stage.bytes = len(payload)
 
-        if len(encoded_images) == 0 and not self._force_upload:
+        if len(encoded_images) == 0 and len(encoded_aggregates) == 0 and not self._force_upload:
             return True
 
+        self._queue.mark_uploading(batch, encoded_images, encoded_aggregates)
+        sent = False
         try:
-            print("Sending payload...", payload.hex())
+            log.info("Sending payload (%s)... %s", batch, payload.hex())
             for communicator in self._communicators:
                 if communicator.is_available():
-                    if communicator.send_data(payload):
-                        print("Sending payload succeeded")
-                        for image in encoded_images:
-                            self._repository.update_photo_synced(image.id)
+                    with self._metrics.stage("satellite_send") as stage:
+                        stage.bytes = len(payload)
+                        sent = await communicator.send_data_async(payload)
+
+                    if sent:
+                        log.info("Sending payload succeeded")
+                        self._queue.mark_synced(batch, encoded_images, encoded_aggregates)
                         break
                     else:
-                        print("Sending payload failed")
+                        log.warning("Sending payload failed")
         except Exception as e:
-            print(f"Error sending data {e}")
+            log.error("Error sending data %s", e)
+        finally:
+            if not sent:
+                self._queue.mark_failed(batch, encoded_images, encoded_aggregates)
 
-        return len(images) == len(encoded_images)
+        return len(batch.photos) == len(encoded_images) and len(batch.aggregates) == len(encoded_aggregates)